@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'statement_analyzer.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,6 +78,179 @@ WSGI_APPLICATION = 'bankstatement_project.wsgi.application'
 MONGO_URI = 'mongodb://localhost:27017/' # Your MongoDB connection string
 MONGO_DATABASE_NAME = 'bank_statements_db'
 MONGO_COLLECTION_NAME = 'transactions'
+MONGO_STATEMENTS_COLLECTION_NAME = 'statements'
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+# Writes made during an upload give up sooner, and are skipped for a while
+# after the server was unreachable (see statement_analyzer/mongo_store.py).
+MONGO_REQUEST_TIMEOUT_MS = int(os.getenv('MONGO_REQUEST_TIMEOUT_MS', '1000'))
+MONGO_RETRY_AFTER_S = float(os.getenv('MONGO_RETRY_AFTER_S', '30'))
+MONGO_ENSURE_INDEXES_ON_STARTUP = True
+
+# Extracted statements are stored in chunks of this many rows (see statement_store.py)
+STATEMENT_CHUNK_ROWS = 256
+STATEMENT_COMPRESSION_LEVEL = 6
+
+# LLM calls made by BankStatementParser (see statement_analyzer/llm_backends.py)
+# 'live' talks to OpenAI/Gemini, 'cassette' records/replays responses, and
+# 'standin' sends everything to a local server started with `manage.py llm_standin`.
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'live')
+LLM_CASSETTE_DIR = os.getenv('LLM_CASSETTE_DIR', str(BASE_DIR / 'llm_cassettes'))
+LLM_CASSETTE_MODE = os.getenv('LLM_CASSETTE_MODE', 'replay')
+LLM_STANDIN_URL = os.getenv('LLM_STANDIN_URL', 'http://127.0.0.1:8765/v1')
+
+# LLM rate limiting and retries (see statement_analyzer/rate_limit.py)
+# Requests and tokens per minute per provider are shared by every process on the
+# host through LLM_RATE_LIMIT_DB. They depend on the account's tier, so they are off
+# (0) until set; use values a little below the real limits. At most
+# LLM_RATE_LIMIT_BURST_S seconds of budget is spent at once. Retries with backoff
+# apply either way; a Retry-After header is honoured up to LLM_BACKOFF_MAX_S, and
+# every call gets at least one attempt. LLM_HEDGE sends a duplicate request when a call runs past the
+# model's recent p95 latency.
+LLM_RATE_LIMIT_ENABLED = os.getenv('LLM_RATE_LIMIT_ENABLED', '1') == '1'
+LLM_RATE_LIMIT_DB = os.getenv('LLM_RATE_LIMIT_DB', str(BASE_DIR / 'llm_ratelimit.sqlite3'))
+LLM_RPM = {
+    'openai': int(os.getenv('OPENAI_RPM', '0')),
+    'gemini': int(os.getenv('GEMINI_RPM', '0')),
+}
+LLM_TPM = {
+    'openai': int(os.getenv('OPENAI_TPM', '0')),
+    'gemini': int(os.getenv('GEMINI_TPM', '0')),
+}
+LLM_RATE_LIMIT_BURST_S = float(os.getenv('LLM_RATE_LIMIT_BURST_S', '10'))
+LLM_MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '5'))
+LLM_BACKOFF_BASE_S = float(os.getenv('LLM_BACKOFF_BASE_S', '1'))
+LLM_BACKOFF_MAX_S = float(os.getenv('LLM_BACKOFF_MAX_S', '30'))
+LLM_RATE_LIMIT_MAX_WAIT_S = float(os.getenv('LLM_RATE_LIMIT_MAX_WAIT_S', '120'))
+LLM_HEDGE = os.getenv('LLM_HEDGE', '0') == '1'
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+
+# Parsing of LLM answers (see statement_analyzer/schemas.py and llm_json.py)
+# LLM_STRUCTURED_OUTPUT asks the provider for JSON following the statement schema.
+# When an answer is cut off at max_tokens, its complete transactions are kept and
+# the rest is requested up to LLM_CONTINUATION_ATTEMPTS more times.
+LLM_STRUCTURED_OUTPUT = os.getenv('LLM_STRUCTURED_OUTPUT', '1') == '1'
+LLM_CONTINUATION_ATTEMPTS = int(os.getenv('LLM_CONTINUATION_ATTEMPTS', '2'))
+
+# Routing of statement extraction between providers (see statement_analyzer/llm_router.py)
+# 'fixed' (the default) always uses OpenAI, which replaying cassettes needs. With
+# LLM_ROUTING=auto each statement goes to the route in LLM_ROUTES with the best
+# recent p95 latency, error rate and cost, and falls over to the next one when it
+# fails; LLM_ROUTER_EXPLORE (off unless set) sends a share to another route to keep
+# its numbers current. Statements of at most LLM_RACE_MAX_CHARS characters are sent
+# to the two best routes at once (0 turns racing off; it doubles their cost).
+LLM_ROUTING = os.getenv('LLM_ROUTING', 'fixed')
+LLM_ROUTES = [name.strip() for name in os.getenv('LLM_ROUTES', 'openai,gemini').split(',') if name.strip()]
+LLM_ROUTER_COST_WEIGHT = float(os.getenv('LLM_ROUTER_COST_WEIGHT', '20'))
+LLM_ROUTER_COOLDOWN_S = float(os.getenv('LLM_ROUTER_COOLDOWN_S', '30'))
+LLM_ROUTER_EXPLORE = float(os.getenv('LLM_ROUTER_EXPLORE', '0'))
+LLM_RACE_MAX_CHARS = int(os.getenv('LLM_RACE_MAX_CHARS', '0'))
+
+# Extraction path selection (see statement_analyzer/path_selector.py)
+# 'fixed' (the default) keeps the text-layer heuristic of pdf_extractor. With
+# PIPELINE_SELECTOR=adaptive each PDF goes through the text, ocr or vision path
+# that past runs say is cheapest among those likely to give readable rows
+# (PIPELINE_MIN_PASS_RATE); a second path is tried when the first fails, gives no
+# rows or unreadable ones. PIPELINE_SECONDS_COST prices a second of latency in
+# dollars. PIPELINE_EXPLORE is the share of uploads sent down another path to keep
+# the estimates current; off unless set.
+PIPELINE_SELECTOR = os.getenv('PIPELINE_SELECTOR', 'fixed')
+PIPELINE_PATHS = [name.strip() for name in os.getenv('PIPELINE_PATHS', 'text,ocr,vision').split(',') if name.strip()]
+PIPELINE_MIN_PASS_RATE = float(os.getenv('PIPELINE_MIN_PASS_RATE', '0.7'))
+PIPELINE_SECONDS_COST = float(os.getenv('PIPELINE_SECONDS_COST', '0.001'))
+PIPELINE_MAX_ATTEMPTS = int(os.getenv('PIPELINE_MAX_ATTEMPTS', '2'))
+PIPELINE_EXPLORE = float(os.getenv('PIPELINE_EXPLORE', '0'))
+PIPELINE_HISTORY = int(os.getenv('PIPELINE_HISTORY', '500'))
+PIPELINE_MIN_TEXT_CHARS = int(os.getenv('PIPELINE_MIN_TEXT_CHARS', '50'))
+PIPELINE_VISION_MAX_PAGES = int(os.getenv('PIPELINE_VISION_MAX_PAGES', '10'))
+PIPELINE_VISION_DPI = int(os.getenv('PIPELINE_VISION_DPI', '150'))
+
+# OCR of scanned pages (see statement_analyzer/pdf_extractor.py). 'docling' runs
+# Docling's layout, table-structure and RapidOCR models and exports markdown.
+# 'rapidocr' runs RapidOCR's detector and recognizer directly on the pages
+# rendered at OCR_DPI (statement_analyzer/rapid_ocr.py). Lines are detected
+# on the page scaled to OCR_DETECT_SIDE pixels and recognized OCR_REC_BATCH
+# at a time, pooled across pages. With OCR_ROI only the transaction table and
+# the account header block are recognized; the table regions of the last
+# OCR_LAYOUT_CACHE bank templates are kept, so later pages skip detecting the rest.
+OCR_ENGINE = os.getenv('OCR_ENGINE', 'docling')
+OCR_DPI = int(os.getenv('OCR_DPI', '200'))
+OCR_DETECT_SIDE = int(os.getenv('OCR_DETECT_SIDE', '960'))
+OCR_REC_BATCH = int(os.getenv('OCR_REC_BATCH', '6'))
+OCR_ROI = os.getenv('OCR_ROI', '1') == '1'
+OCR_LAYOUT_CACHE = int(os.getenv('OCR_LAYOUT_CACHE', '64'))
+
+# Statements of PAGE_STREAM_MIN_PAGES pages or more (0 disables) are extracted,
+# checked and stored PAGE_WINDOW pages at a time (see statement_analyzer/page_stream.py).
+PAGE_STREAM_MIN_PAGES = int(os.getenv('PAGE_STREAM_MIN_PAGES', '40'))
+PAGE_WINDOW = int(os.getenv('PAGE_WINDOW', '10'))
+
+# Repair of balance mismatches (see statement_analyzer/repair.py)
+# Up to REPAIR_MAX_PAGES pages holding mismatched rows are re-read with GPT-4o
+# vision on a REPAIR_DPI rendering of the page; fixes are kept only if they help.
+REPAIR_MAX_PAGES = int(os.getenv('REPAIR_MAX_PAGES', '3'))
+REPAIR_DPI = int(os.getenv('REPAIR_DPI', '200'))
+
+# CPU budget (see statement_analyzer/cpu_budget.py). CPU_THREADS cores (0: all
+# available) are shared by CPU_PROCESSES server processes on the node. Each
+# CPU-heavy task (text extraction, OCR, rendering) gets CPU_THREADS_PER_TASK
+# threads in OpenCV, ONNX Runtime and BLAS/OpenMP, and a process runs at most
+# CPU_THREADS / CPU_PROCESSES / CPU_THREADS_PER_TASK of them at once. An upload
+# that waits CPU_QUEUE_TIMEOUT seconds for its turn is told the server is busy;
+# uploads are served before queued bulk-upload work.
+CPU_THREADS = int(os.getenv('CPU_THREADS', '0'))
+CPU_PROCESSES = int(os.getenv('CPU_PROCESSES', os.getenv('WEB_CONCURRENCY', '1')))
+CPU_THREADS_PER_TASK = int(os.getenv('CPU_THREADS_PER_TASK', '1'))
+CPU_QUEUE_TIMEOUT = float(os.getenv('CPU_QUEUE_TIMEOUT', '30'))
+
+# Bulk uploads (see statement_analyzer/batch.py)
+# Text extraction is CPU bound and runs in EXTRACTION_WORKERS processes (threads
+# when EXTRACTION_IN_PROCESSES=0; 0 sizes the pool from the CPU budget); at most
+# LLM_CONCURRENCY LLM calls run at once. Items still unfinished
+# BATCH_ITEM_TIMEOUT_S after they started (or were queued) are marked failed
+# when the batch is next looked at, e.g. after the worker running them restarted.
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '24'))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(200 * 1024 * 1024)))
+BATCH_FILE_WORKERS = int(os.getenv('BATCH_FILE_WORKERS', '12'))
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '0'))
+EXTRACTION_IN_PROCESSES = os.getenv('EXTRACTION_IN_PROCESSES', '1') == '1'
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+BATCH_ITEM_TIMEOUT_S = int(os.getenv('BATCH_ITEM_TIMEOUT_S', '1800'))
+
+# Instrumentation (see statement_analyzer/instrumentation.py)
+# Requests slower than SLOW_REQUEST_MS are logged with their per-stage breakdown.
+# TRACE_STAGE_MEMORY turns on tracemalloc to record peak memory per stage; it slows the pipeline down.
+# The metrics page is off unless METRICS_ENABLED=1, and then only served to staff
+# users or to scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', '5000'))
+TRACE_STAGE_MEMORY = os.getenv('TRACE_STAGE_MEMORY', '0') == '1'
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s %(levelname)s [%(name)s] %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'standard',
+        },
+    },
+    'loggers': {
+        'statement_analyzer': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -0,0 +1,5 @@
+"""
+Offline benchmarks for the statement analysis pipeline.
+
+    python -m benchmarks.run --help
+"""
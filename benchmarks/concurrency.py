@@ -0,0 +1,195 @@
+"""
+Throughput of the CPU-heavy work against the number of concurrent requests,
+with and without the CPU budget (statement_analyzer/cpu_budget.py):
+
+    python -m benchmarks.concurrency
+    python -m benchmarks.concurrency --concurrency 1,2,4,8,16 --duration 20 --output concurrency.json
+
+Each request deskews the pages of a synthetic scanned statement
+(fix_skew_on_images), runs detect_visual_anomalies_opencv on them and does a
+few BLAS matrix products, standing in for OCR model inference. For each
+--concurrency value, that many client threads send requests back to back
+for --duration seconds.
+
+    budget     the app's settings: CPU_THREADS_PER_TASK threads per library
+               and at most task_slots() requests computing at once
+    unbounded  every library uses all cores and every request runs at once,
+               which is what happens without the budget
+
+Every (mode, concurrency) pair runs in a fresh interpreter, because the
+thread pools are sized when the libraries load. Reported per pair:
+requests/s, p50/p95 latency and, for the budget, the time spent queued.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from .run import _csv_list, _git_revision
+
+MODES = ('budget', 'unbounded')
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _workload(pages, dpi, matrix):
+    import numpy as np
+
+    from statement_analyzer import enhancement
+    from statement_analyzer.data_extractor import BankStatementParser
+
+    from .generator import generate_statement, render_pages
+
+    pdf_bytes, _ = generate_statement(pages=pages, rows_per_page=30, layout='scanned', seed=0)
+    images = render_pages(pdf_bytes, dpi=dpi)
+    parser = BankStatementParser()
+    weights = np.random.default_rng(0).standard_normal((matrix, matrix))
+
+    def request():
+        enhancement.fix_skew_on_images(images)
+        for image in images:
+            parser.detect_visual_anomalies_opencv(image)
+        product = weights
+        for _ in range(4):
+            product = np.tanh(product @ weights)
+        return product
+
+    return request
+
+
+def child(args):
+    """
+    One (mode, concurrency) measurement; prints a JSON line.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bankstatement_project.settings')
+    from statement_analyzer import cpu_budget
+
+    if args.mode == 'unbounded':
+        cores = str(cpu_budget.available_cpus())
+        for name in cpu_budget.THREAD_ENV_VARS:
+            os.environ[name] = cores
+    os.environ['CPU_QUEUE_TIMEOUT'] = str(args.duration * 10)
+    import django
+
+    django.setup()
+    import cv2
+
+    request = _workload(args.pages, args.dpi, args.matrix)
+    request()  # warm up: imports, first allocations
+    call = cpu_budget.run if args.mode == 'budget' else (lambda fn: fn())
+
+    latencies, waits = [], []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def client():
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            call(request)
+            with lock:
+                latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    from statement_analyzer.instrumentation import CPU_SLOT_WAIT
+
+    for line in CPU_SLOT_WAIT.collect():
+        if line.startswith('cpu_slot_wait_seconds_sum'):
+            waits.append(float(line.split()[-1]))
+    print(json.dumps({
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_s': statistics.median(latencies),
+        'p95_s': _percentile(latencies, 0.95),
+        'queued_s': (sum(waits) / len(latencies)) if waits and latencies else 0.0,
+        'threads_per_task': cpu_budget.threads_per_task() if args.mode == 'budget' else cpu_budget.available_cpus(),
+        'task_slots': cpu_budget.task_slots() if args.mode == 'budget' else args.concurrency,
+        'cv2_threads': cv2.getNumThreads(),
+    }))
+
+
+def run(args):
+    results = []
+    print(f'{"mode":<10} {"clients":>7} {"req/s":>8} {"p50 ms":>9} {"p95 ms":>9} {"queued ms":>10} '
+          f'{"threads/task":>12} {"slots":>5}')
+    for concurrency in args.concurrency:
+        for mode in args.modes:
+            command = [sys.executable, '-m', 'benchmarks.concurrency', '--child', mode,
+                       '--clients', str(concurrency), '--duration', str(args.duration), '--pages', str(args.pages),
+                       '--dpi', str(args.dpi), '--matrix', str(args.matrix)]
+            completed = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__))))
+            if completed.returncode:
+                print(f'{mode:<10} {concurrency:>7} failed:\n{completed.stderr[-2000:]}')
+                results.append({'mode': mode, 'concurrency': concurrency, 'error': completed.stderr[-2000:]})
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f'{mode:<10} {concurrency:>7} {result["throughput_rps"]:8.2f} {result["p50_s"] * 1000:9.0f} '
+                  f'{result["p95_s"] * 1000:9.0f} {result["queued_s"] * 1000:10.0f} '
+                  f'{result["threads_per_task"]:>12} {result["task_slots"]:>5}')
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git_revision': _git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'child')},
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=lambda v: _csv_list(v, int), default=[1, 2, 4, 8, 16],
+                        help='comma separated numbers of concurrent clients (default: 1,2,4,8,16)')
+    parser.add_argument('--modes', type=_csv_list, default=list(MODES), help=f'from {",".join(MODES)}')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per measurement (default: 15)')
+    parser.add_argument('--pages', type=int, default=2, help='scanned pages per request (default: 2)')
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--matrix', type=int, default=384, help='size of the BLAS matrix products')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--child', choices=MODES, dest='mode', help=argparse.SUPPRESS)
+    parser.add_argument('--clients', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f'unknown modes: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode:
+        args.concurrency = args.clients
+        child(args)
+        return 0
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+Synthetic bank statement PDFs for benchmarking.
+
+Statements are drawn with PyMuPDF in three layouts:
+    text     - a normal text layer, as exported by online banking
+    scanned  - every page is a slightly skewed raster image with no text layer
+    hybrid   - a text first page followed by scanned pages
+Optionally one balance is overwritten in a different font, the way a
+doctored statement looks, so the tamper checks have something to find.
+"""
+import io
+import random
+from datetime import date, timedelta
+
+import fitz
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+LAYOUTS = ('text', 'scanned', 'hybrid')
+DESCRIPTIONS = [
+    'Prepaid electricity', 'SASOL DAVEST 518103XXXXXX0883', 'Instant payment fee',
+    'POS PURCHASE CORGI HARDWARE', 'SALARY ROYAL FINANCE', 'ATM WITHDRAWAL',
+    'DEBIT ORDER INSURANCE', 'EFT PAYMENT RECEIVED', 'MONTHLY ACCOUNT FEE',
+]
+TEMPLATES = {
+    # column x positions: date, details, amount, balance
+    'classic': {'columns': (40, 110, 380, 480), 'font_size': 8, 'row_height': 13},
+    'compact': {'columns': (30, 90, 400, 490), 'font_size': 7, 'row_height': 10},
+    # a bank letterhead on every page, an advert under the table and a legal footer
+    'retail': {'columns': (40, 110, 380, 480), 'font_size': 8, 'row_height': 12, 'boilerplate': True},
+}
+LETTERHEAD = ['Synthetic Bank Ltd', '1 Finance Street', 'Cape Town 8001', 'www.synthetic-bank.example']
+ADVERT = [
+    'Earn more on your savings: open a Synthetic Saver account in minutes on our app,',
+    'with no monthly fees and instant access to your money. Terms apply.',
+]
+LEGAL = [
+    'Synthetic Bank Ltd is an authorised financial services provider and registered credit provider.',
+    'Please check this statement and report any discrepancies within 30 days of the statement date.',
+    'Deposit insurance covers qualifying deposits up to the limits set by the deposit insurance scheme.',
+]
+
+
+def generate_transactions(count, seed=0, opening_balance=2649.13):
+    """
+    Returns ``count`` consistent transactions; the first one is the opening balance.
+    """
+    rng = random.Random(seed)
+    balance = round(opening_balance, 2)
+    day = date(2024, 12, 18)
+    transactions = [{'id': 1, 'details': 'Opening balance', 'date': day.strftime('%d-%m-%Y'),
+                     'amount': 0.0, 'balance': balance}]
+    for i in range(2, count + 1):
+        if rng.random() < 0.3:
+            day += timedelta(days=1)
+        amount = round(rng.uniform(5, 2500), 2) if rng.random() < 0.2 else -round(rng.uniform(1, 600), 2)
+        balance = round(balance + amount, 2)
+        transactions.append({'id': i, 'details': rng.choice(DESCRIPTIONS), 'date': day.strftime('%d-%m-%Y'),
+                             'amount': amount, 'balance': balance})
+    return transactions
+
+
+def _draw_text_page(page, rows, template, header_lines):
+    x_date, x_details, x_amount, x_balance = template['columns']
+    size, row_height = template['font_size'], template['row_height']
+    y = 50
+    if template.get('boilerplate'):
+        for i, line in enumerate(LETTERHEAD):
+            page.insert_text((420, y + i * 11), line, fontsize=8)
+        y += len(LETTERHEAD) * 11 + 10
+    for line in header_lines:
+        page.insert_text((x_date, y), line, fontsize=size + 2)
+        y += row_height + 4
+    y += row_height
+    for label, x in zip(('Date', 'Details', 'Amount', 'Balance'), template['columns']):
+        page.insert_text((x, y), label, fontsize=size, fontname='hebo')
+    page.draw_line((x_date, y + 3), (PAGE_WIDTH - 40, y + 3))
+    y += row_height
+    positions = []
+    for row in rows:
+        page.insert_text((x_date, y), row['date'], fontsize=size)
+        page.insert_text((x_details, y), row['details'][:48], fontsize=size)
+        page.insert_text((x_amount, y), f"{row['amount']:,.2f}", fontsize=size)
+        page.insert_text((x_balance, y), f"{row['balance']:,.2f}", fontsize=size)
+        positions.append(y)
+        y += row_height
+    if template.get('boilerplate'):
+        for i, line in enumerate(ADVERT):
+            page.insert_text((x_date, y + 20 + i * 11), line, fontsize=8)
+        for i, line in enumerate(LEGAL):
+            page.insert_text((x_date, PAGE_HEIGHT - 64 + i * 9), line, fontsize=6)
+    page.insert_text((x_date, PAGE_HEIGHT - 30), 'This is a computer generated statement. Terms and conditions apply.',
+                     fontsize=6)
+    return positions
+
+
+def _tamper(page, y, template, new_balance):
+    """Covers a balance and writes another value in a different font."""
+    x_balance = template['columns'][3]
+    size = template['font_size']
+    page.draw_rect(fitz.Rect(x_balance - 2, y - size - 1, x_balance + 70, y + 3), color=None, fill=(1, 1, 1))
+    page.insert_text((x_balance + 1, y + 0.5), f"{new_balance:,.2f}", fontsize=size + 0.5, fontname='cour')
+
+
+def _rasterize(page_pdf, dpi, skew, rng):
+    """Renders a one-page PDF to a skewed image page, like a scanner would."""
+    from PIL import Image
+
+    pixmap = page_pdf[0].get_pixmap(dpi=dpi)
+    image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    if skew:
+        image = image.rotate(rng.uniform(-skew, skew), expand=False, fillcolor='white')
+    buffer = io.BytesIO()
+    image.convert('L').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def generate_statement(pages=3, rows_per_page=40, layout='text', template='classic', tamper=False,
+                       seed=0, dpi=150, skew=1.5):
+    """
+    Builds a synthetic statement.
+
+    Returns (pdf_bytes, info) where info holds the ground-truth 'account_info'
+    and 'transactions', plus 'tampered_row' (index or None).
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}; expected one of {LAYOUTS}.")
+    rng = random.Random(seed)
+    style = TEMPLATES[template]
+    transactions = generate_transactions(pages * rows_per_page, seed=seed)
+    account_info = {
+        'bank_name': 'Synthetic Bank', 'holder_name': 'MR TEST ACCOUNT', 'account_number': '1285935551',
+        'period': f"{transactions[0]['date']} - {transactions[-1]['date']}",
+        'final_balance': transactions[-1]['balance'],
+    }
+    header = [
+        f"{account_info['bank_name']}  -  Statement of account",
+        f"Account holder: {account_info['holder_name']}    Account number: {account_info['account_number']}",
+        f"Period: {account_info['period']}",
+    ]
+    tampered_row = rng.randrange(1, len(transactions)) if tamper and len(transactions) > 1 else None
+
+    output = fitz.open()
+    for page_number in range(pages):
+        rows = transactions[page_number * rows_per_page:(page_number + 1) * rows_per_page]
+        single = fitz.open()
+        page = single.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        positions = _draw_text_page(page, rows, style, header if page_number == 0 else [])
+        if tampered_row is not None and page_number == tampered_row // rows_per_page:
+            row_offset = tampered_row % rows_per_page
+            _tamper(page, positions[row_offset], style, rows[row_offset]['balance'] + 1000)
+
+        scanned = layout == 'scanned' or (layout == 'hybrid' and page_number > 0)
+        if scanned:
+            image_page = output.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+            image_page.insert_image(image_page.rect, stream=_rasterize(single, dpi, skew, rng))
+        else:
+            output.insert_pdf(single)
+        single.close()
+
+    pdf_bytes = output.tobytes(deflate=True)
+    output.close()
+    return pdf_bytes, {'account_info': account_info, 'transactions': transactions, 'tampered_row': tampered_row}
+
+
+def render_pages(pdf_bytes, dpi=150):
+    """Renders every page to a PIL RGB image without needing poppler."""
+    from PIL import Image
+
+    images = []
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as document:
+        for page in document:
+            pixmap = page.get_pixmap(dpi=dpi)
+            images.append(Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples))
+    return images
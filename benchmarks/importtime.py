@@ -0,0 +1,156 @@
+"""
+Startup cost of the web app and management commands.
+
+Every scenario runs in a fresh interpreter; one extra run with
+``-X importtime`` lists the slowest imports:
+
+    wsgi      load the WSGI application and serve one request (/analyzer/metrics/),
+              which is what a gunicorn worker does before it is useful
+    views     django.setup() and import statement_analyzer.views
+    check     manage.py check (what migrate and runserver pay before working)
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime --repeat 10 --top 20 --output startup.json
+
+"ready" is the time from the first line of the script until the scenario is
+done; "wall" adds interpreter start and shutdown. Exits with status 1 if the
+wsgi scenario is not ready within --budget-ms or if any heavy library
+(statement_analyzer.lazy.HEAVY_MODULES) was imported at startup.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PRELUDE = """
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bankstatement_project.settings')
+"""
+
+_REPORT = """
+from statement_analyzer.lazy import loaded_heavy_modules
+print(json.dumps({'ready_ms': (time.perf_counter() - start) * 1000, 'heavy': loaded_heavy_modules()}))
+"""
+
+SCENARIOS = {
+    'wsgi': _PRELUDE + """
+from wsgiref.util import setup_testing_defaults
+os.environ.update(METRICS_ENABLED='1', METRICS_TOKEN='importtime')
+from bankstatement_project.wsgi import application
+environ = {'PATH_INFO': '/analyzer/metrics/', 'HTTP_AUTHORIZATION': 'Bearer importtime'}
+setup_testing_defaults(environ)
+statuses = []
+body = b''.join(application(environ, lambda status, headers: statuses.append(status)))
+assert statuses[0].startswith('200'), statuses
+""" + _REPORT,
+    'views': _PRELUDE + """
+import django
+django.setup()
+import statement_analyzer.views
+""" + _REPORT,
+    'check': _PRELUDE + """
+from django.core.management import execute_from_command_line
+execute_from_command_line(['manage.py', 'check'])
+""" + _REPORT,
+}
+
+
+def parse_importtime(stderr):
+    """
+    Returns {module: cumulative microseconds} from ``-X importtime`` output.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        modules[name] = max(modules.get(name, 0), int(cumulative_us))
+    return modules
+
+
+def run_scenario(code, env, importtime=False):
+    command = [sys.executable, '-X', 'importtime', '-c', code] if importtime else [sys.executable, '-c', code]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=PROJECT_DIR, env=env, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    report_lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+    if result.returncode != 0 or not report_lines:
+        raise RuntimeError(f'scenario failed (exit {result.returncode}):\n{result.stderr[-2000:]}')
+    report = json.loads(report_lines[-1])
+    report['wall_ms'] = wall_ms
+    report['modules'] = parse_importtime(result.stderr)
+    return report
+
+
+def run(args):
+    env = dict(os.environ)
+    # Startup must not depend on these; drop them to prove it.
+    for name in ('MAX_TOKEN_LIMIT', 'OPEN_AI_MODEL'):
+        env.pop(name, None)
+
+    results = {}
+    for name in args.scenarios:
+        runs = [run_scenario(SCENARIOS[name], env) for _ in range(args.warmup + args.repeat)][args.warmup:]
+        modules = run_scenario(SCENARIOS[name], env, importtime=True)['modules']
+        top_level = {module: us for module, us in modules.items() if '.' not in module}
+        results[name] = {
+            'runs': len(runs),
+            'median_wall_ms': statistics.median(r['wall_ms'] for r in runs),
+            'median_ready_ms': statistics.median(r['ready_ms'] for r in runs),
+            'heavy_modules': sorted({module for r in runs for module in r['heavy']}),
+            'slowest_imports_ms': {
+                module: us / 1000 for module, us in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]
+            },
+        }
+        result = results[name]
+        print(f'{name:<8} median ready {result["median_ready_ms"]:8.1f} ms, wall {result["median_wall_ms"]:8.1f} ms'
+              f'   heavy modules: {", ".join(result["heavy_modules"]) or "none"}')
+        for module, ms in result['slowest_imports_ms'].items():
+            print(f'           {module:<40} {ms:8.1f} ms')
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', type=lambda v: [s.strip() for s in v.split(',') if s.strip()],
+                        default=list(SCENARIOS), help=f'comma separated scenarios from {",".join(SCENARIOS)}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1, help='runs discarded first (fills the bytecode cache)')
+    parser.add_argument('--top', type=int, default=10, help='slowest top-level imports to list per scenario')
+    parser.add_argument('--budget-ms', type=float, default=1000,
+                        help='maximum median ready time of the wsgi scenario (default: 1000)')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nWrote {args.output}')
+
+    failed = False
+    for name, result in results.items():
+        if result['heavy_modules']:
+            print(f'\n{name}: heavy modules imported at startup: {", ".join(result["heavy_modules"])}')
+            failed = True
+    if 'wsgi' in results and results['wsgi']['median_ready_ms'] > args.budget_ms:
+        print(f'\nwsgi startup {results["wsgi"]["median_ready_ms"]:.0f} ms is over the {args.budget_ms:.0f} ms budget.')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+"""
+End-to-end load test of the analyzer over HTTP.
+
+Simulated users arrive at a fixed mean rate (Poisson arrivals, open loop) and
+each one runs a session: upload a statement, open the transaction viewer,
+page through the rows, sometimes revalidate an edit and sometimes open the
+fraud issues page. PDFs are synthetic statements of mixed sizes.
+
+Against a server that is already running (point it at the LLM stand-in with
+LLM_BACKEND=standin, see README):
+
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --server-pid 1234 --rate 0.5,1,2
+
+Or let the tool start the LLM stand-in and the server itself:
+
+    python -m benchmarks.loadtest --start-server runserver --rate 0.5,1,2,4 --duration 60
+    python -m benchmarks.loadtest --start-server gunicorn --workers 4 --rate 1,2,4,8
+    python -m benchmarks.loadtest --start-server gunicorn --workers 4 --rate 1,2,4,8 --no-preload
+
+Each rate is run for --duration seconds and reported separately, so the step
+where latency or errors take off is the saturation point. With --baseline the
+run exits with status 1 if a step's p95 got slower than the threshold allows.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from .generator import LAYOUTS, generate_statement, generate_transactions
+
+STEPS = ('upload_form', 'upload', 'transactions', 'rows', 'revalidate', 'issues')
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+# --- Server memory ---
+def _rss_bytes(pid):
+    """
+    Proportional set size of a process where the kernel reports it, else its
+    RSS. Pages shared between the gunicorn master and its workers (see
+    gunicorn.conf.py) are split between them rather than counted once per
+    process, so the sum over the tree is the memory really used.
+    """
+    for path, field in ((f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return 0
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the ppid follows the closing parenthesis.
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+def process_tree_rss(pid):
+    """
+    Memory of a process and all its descendants (gunicorn master plus
+    workers), in bytes; see _rss_bytes. Returns None where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        total += _rss_bytes(current)
+        pending.extend(_children(current))
+    return total
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        mb = 1024 * 1024
+        return {
+            'start_mb': self.samples[0] / mb,
+            'end_mb': self.samples[-1] / mb,
+            'peak_mb': max(self.samples) / mb,
+            'mean_mb': sum(self.samples) / len(self.samples) / mb,
+        }
+
+
+# --- Client session ---
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode()
+        )
+        parts.append(content)
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class UserSession:
+    """
+    One simulated user with its own cookies (session id and CSRF token).
+    """
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def _cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    def request(self, step, path, data=None, headers=None, ok=None):
+        """
+        Sends one request, records its latency under ``step`` and returns
+        (status, body). ``ok`` can reject a 200 whose body reports a failure.
+        """
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        start = time.perf_counter()
+        status, body, error = None, b'', None
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+            error = f'HTTP {e.code}'
+        except (urllib.error.URLError, OSError) as e:
+            error = type(e).__name__
+        elapsed = time.perf_counter() - start
+        if error is None and ok is not None and not ok(body):
+            error = 'failed response'
+        self.recorder.record(step, elapsed, error)
+        return status, body
+
+    def run(self, pdf, options, rng):
+        self.request('upload_form', '/analyzer/upload/')
+        token = self._cookie('csrftoken') or ''
+        body, content_type = _multipart(
+            {'csrfmiddlewaretoken': token},
+            {'file': (pdf['name'], pdf['bytes'], 'application/pdf')},
+        )
+        status, _ = self.request(
+            'upload', '/analyzer/upload/', data=body,
+            headers={'Content-Type': content_type, 'X-CSRFToken': token, 'Referer': self.base_url + '/'},
+            ok=lambda page: b'class="message-box error"' not in page,
+        )
+        if status != 200:
+            return
+
+        self.request('transactions', '/analyzer/transactions/')
+        rows = None
+        for page in range(rng.randint(1, options.max_row_pages)):
+            status, body = self.request('rows', f'/analyzer/transactions/rows/?offset={page * 200}&limit=200')
+            if status != 200:
+                return
+            if rows is None:
+                rows = json.loads(body)
+
+        if rows and rows['rows'] and rng.random() < options.revalidate_ratio:
+            row = rng.choice(rows['rows'])
+            edit = {key: row[key] for key in ('index', 'date', 'details', 'amount', 'balance')}
+            self.request(
+                'revalidate', '/analyzer/revalidate/',
+                data=json.dumps({'edits': [edit], 'version': rows['version']}).encode(),
+                headers={'Content-Type': 'application/json'},
+            )
+
+        if rng.random() < options.issues_ratio:
+            self.request('issues', '/analyzer/issues/')
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sessions = 0
+
+    def record(self, step, elapsed, error):
+        with self.lock:
+            self.latencies.setdefault(step, []).append(elapsed)
+            if error:
+                self.errors.setdefault(step, {}).setdefault(error, 0)
+                self.errors[step][error] += 1
+
+    def summary(self, wall_time):
+        steps = {}
+        total_requests = total_errors = 0
+        for step in STEPS:
+            timings = sorted(self.latencies.get(step, []))
+            if not timings:
+                continue
+            errors = sum(self.errors.get(step, {}).values())
+            total_requests += len(timings)
+            total_errors += errors
+            steps[step] = {
+                'requests': len(timings),
+                'errors': errors,
+                'error_kinds': self.errors.get(step, {}),
+                'p50_s': percentile(timings, 0.50),
+                'p95_s': percentile(timings, 0.95),
+                'p99_s': percentile(timings, 0.99),
+                'max_s': timings[-1],
+            }
+        return {
+            'sessions': self.sessions,
+            'requests': total_requests,
+            'errors': total_errors,
+            'error_rate': total_errors / total_requests if total_requests else 0.0,
+            'throughput_rps': total_requests / wall_time if wall_time else 0.0,
+            'sessions_per_s': self.sessions / wall_time if wall_time else 0.0,
+            'wall_time_s': wall_time,
+            'steps': steps,
+        }
+
+
+# --- Workload ---
+def build_pdf_mix(mix, rows_per_page, layouts, seed):
+    """
+    Pre-generates one statement per (pages, layout) so PDF rendering is not
+    part of the measured load. Returns [(weight, pdf dict)].
+    """
+    pdfs = []
+    for pages, weight in mix:
+        for layout in layouts:
+            pdf_bytes, _ = generate_statement(pages=pages, rows_per_page=rows_per_page, layout=layout, seed=seed)
+            pdfs.append((weight / len(layouts), {
+                'name': f'statement-{layout}-{pages}p.pdf',
+                'bytes': pdf_bytes,
+                'pages': pages,
+            }))
+    return pdfs
+
+
+def run_rate(options, rate, pdfs, server_pid):
+    """
+    Runs sessions arriving at ``rate`` per second for options.duration seconds
+    and waits for the stragglers. Returns the summary for that rate.
+    """
+    recorder = Recorder()
+    rng = random.Random(options.seed)
+    weights = [weight for weight, _ in pdfs]
+    sampler = RSSSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+
+    def session(session_seed):
+        pdf = random.Random(session_seed).choices(pdfs, weights=weights)[0][1]
+        UserSession(options.url, recorder, options.timeout).run(pdf, options, random.Random(session_seed))
+        with recorder.lock:
+            recorder.sessions += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        next_arrival = start
+        while next_arrival - start < options.duration:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(session, rng.getrandbits(32))
+            next_arrival += rng.expovariate(rate)
+    wall_time = time.perf_counter() - start
+
+    result = recorder.summary(wall_time)
+    result['rate'] = rate
+    if sampler:
+        sampler.stop()
+    result['server_rss'] = sampler.summary() if sampler else None
+    return result
+
+
+def print_result(result):
+    rss = result['server_rss']
+    rss_text = f'   rss peak {rss["peak_mb"]:.0f} MB' if rss else ''
+    print(f'\nrate {result["rate"]}/s: {result["sessions"]} sessions, {result["requests"]} requests, '
+          f'{result["throughput_rps"]:.2f} req/s, error rate {result["error_rate"]:.1%}{rss_text}')
+    print(f'  {"step":<14} {"requests":>8} {"errors":>7} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10}')
+    for step, stats in result['steps'].items():
+        print(f'  {step:<14} {stats["requests"]:>8} {stats["errors"]:>7} {stats["p50_s"] * 1000:10.1f} '
+              f'{stats["p95_s"] * 1000:10.1f} {stats["p99_s"] * 1000:10.1f}')
+
+
+def compare(current, baseline, threshold):
+    """
+    Prints the p95 change per (rate, step) against a baseline report and
+    returns the regressions beyond ``threshold`` (a fraction).
+    """
+    previous = {
+        (result['rate'], step): stats
+        for result in baseline['results'] for step, stats in result['steps'].items()
+    }
+    regressions = []
+    print(f'\n{"rate":>6} {"step":<14} {"baseline p95":>13} {"current p95":>12} {"change":>8}')
+    for result in current['results']:
+        for step, stats in result['steps'].items():
+            key = (result['rate'], step)
+            if key not in previous:
+                continue
+            before, after = previous[key]['p95_s'], stats['p95_s']
+            change = (after - before) / before if before else 0.0
+            marker = ''
+            if change > threshold:
+                regressions.append({'rate': key[0], 'step': step, 'change': change})
+                marker = '  REGRESSION'
+            print(f'{key[0]:>6} {step:<14} {before * 1000:13.1f} {after * 1000:12.1f} {change:+8.1%}{marker}')
+    return regressions
+
+
+# --- Local server management ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return True
+        except urllib.error.HTTPError:
+            return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    return False
+
+
+def start_llm_standin(options):
+    from statement_analyzer.llm_standin import StandInConfig, make_server
+
+    transactions = generate_transactions(options.canned_rows, seed=options.seed)
+    extraction = {
+        'account_info': {
+            'bank_name': 'Load Test Bank', 'branch_code': 'null', 'branch_address': 'null',
+            'holder_name': 'MR LOAD TEST', 'account_number': '0000000000',
+            'period': f'{transactions[0]["date"]} - {transactions[-1]["date"]}',
+            'final_balance': transactions[-1]['balance'],
+        },
+        'transactions': transactions,
+    }
+    config = StandInConfig(latency_ms=options.llm_latency_ms, jitter_ms=options.llm_jitter_ms,
+                           error_rate=options.llm_error_rate, extraction_response=json.dumps(extraction),
+                           seed=options.seed)
+    server = make_server('127.0.0.1', _free_port(), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(options, standin_url):
+    port = _free_port()
+    env = dict(os.environ, LLM_BACKEND='standin', LLM_STANDIN_URL=standin_url)
+    if options.no_preload:
+        env['OCR_PRELOAD'] = '0'
+    if options.start_server == 'gunicorn':
+        command = ['gunicorn', 'bankstatement_project.wsgi', '--workers', str(options.workers),
+                   '--bind', f'127.0.0.1:{port}', '--timeout', str(int(options.timeout))]
+    else:
+        command = [sys.executable, 'manage.py', 'runserver', f'127.0.0.1:{port}', '--noreload']
+    log = open(options.server_log, 'ab') if options.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=PROJECT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    if not _wait_for(url + '/analyzer/upload/', options.startup_timeout):
+        process.terminate()
+        raise SystemExit(f'Server did not come up within {options.startup_timeout}s: {" ".join(command)}')
+    return process, url
+
+
+def run(options):
+    pdfs = build_pdf_mix(options.mix, options.rows, options.layouts, options.seed)
+    process = standin = None
+    server_pid = options.server_pid
+    if options.start_server:
+        standin = start_llm_standin(options)
+        process, options.url = start_server(options, f'http://127.0.0.1:{standin.server_address[1]}/v1')
+        server_pid = process.pid
+    try:
+        results = []
+        for rate in options.rate:
+            result = run_rate(options, rate, pdfs, server_pid)
+            print_result(result)
+            results.append(result)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        if standin:
+            standin.shutdown()
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pdfs': [{'name': pdf['name'], 'pages': pdf['pages'], 'bytes': len(pdf['bytes']), 'weight': weight}
+                     for weight, pdf in pdfs],
+            'args': {key: value for key, value in vars(options).items() if key not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+
+
+def _csv_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def _mix(value):
+    """'1:0.6,5:0.3,20:0.1' -> [(1, 0.6), (5, 0.3), (20, 0.1)]"""
+    mix = []
+    for item in _csv_list(value):
+        pages, _, weight = item.partition(':')
+        mix.append((int(pages), float(weight or 1)))
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_argument_group('target')
+    target.add_argument('--url', default='http://127.0.0.1:8000', help='base URL of a running server')
+    target.add_argument('--server-pid', type=int, help='pid of the running server, to sample its RSS')
+    target.add_argument('--start-server', choices=('runserver', 'gunicorn'),
+                        help='start the LLM stand-in and this server locally instead of using --url')
+    target.add_argument('--workers', type=int, default=2, help='gunicorn workers (default: 2)')
+    target.add_argument('--no-preload', action='store_true',
+                        help='let each gunicorn worker load the app and OCR models itself (OCR_PRELOAD=0)')
+    target.add_argument('--server-log', help='append the started server output to this file')
+    target.add_argument('--startup-timeout', type=float, default=60)
+
+    load = parser.add_argument_group('load')
+    load.add_argument('--rate', type=lambda v: _csv_list(v, float), default=[1.0],
+                      help='comma separated session arrival rates per second, run one after another')
+    load.add_argument('--duration', type=float, default=30, help='seconds of arrivals per rate (default: 30)')
+    load.add_argument('--concurrency', type=int, default=64, help='maximum sessions in flight (default: 64)')
+    load.add_argument('--timeout', type=float, default=120, help='per request timeout in seconds')
+    load.add_argument('--mix', type=_mix, default=[(1, 0.5), (5, 0.35), (20, 0.15)],
+                      help='PDF page counts and weights, e.g. 1:0.5,5:0.35,20:0.15')
+    load.add_argument('--rows', type=int, default=40, help='transaction rows per page (default: 40)')
+    load.add_argument('--layouts', type=_csv_list, default=['text'],
+                      help=f'comma separated layouts from {",".join(LAYOUTS)} (default: text)')
+    load.add_argument('--max-row-pages', type=int, default=3, help='row pages a user scrolls through, at most')
+    load.add_argument('--revalidate-ratio', type=float, default=0.5, help='fraction of sessions that edit a row')
+    load.add_argument('--issues-ratio', type=float, default=0.2, help='fraction of sessions that open issues')
+    load.add_argument('--seed', type=int, default=0)
+
+    llm = parser.add_argument_group('LLM stand-in (with --start-server)')
+    llm.add_argument('--llm-latency-ms', type=float, default=800)
+    llm.add_argument('--llm-jitter-ms', type=float, default=300)
+    llm.add_argument('--llm-error-rate', type=float, default=0.0)
+    llm.add_argument('--canned-rows', type=int, default=200, help='transactions in the canned extraction reply')
+
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help='allowed p95 slowdown before flagging a regression (default: 0.20)')
+    args = parser.parse_args(argv)
+    unknown = set(args.layouts) - set(LAYOUTS)
+    if unknown:
+        parser.error(f'unknown layouts: {", ".join(sorted(unknown))}')
+    if any(rate <= 0 for rate in args.rate):
+        parser.error('rates must be positive')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} step(s) regressed by more than {args.threshold:.0%}.')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Speed and accuracy of the OCR engines on scanned statements:
+
+    python -m benchmarks.ocr
+    python -m benchmarks.ocr --pages 1,5 --templates classic,compact --output ocr.json
+    python -m benchmarks.ocr --corpus /data/scanned-statements
+
+Engines:
+
+    rapidocr           OCR_ENGINE=rapidocr: detection per page, recognition
+                       batched across pages, rows rebuilt from the boxes;
+                       only the table and the account header are recognized
+                       (OCR_ROI), and table regions are cached per template
+    rapidocr-no-roi    the same with OCR_ROI=0: every line on the page
+    rapidocr-per-page  RapidOCR's usual call on one page at a time (angle
+                       classifier on, its default recognition batch), with
+                       the same row rebuilding; what batching is measured against
+    docling            OCR_ENGINE=docling: layout, table structure and OCR, as markdown
+
+By default the statements are synthetic (benchmarks.generator, layout
+"scanned"), whose transactions are known; the "retail" template adds a
+letterhead, an advert and a legal footer for OCR_ROI to leave out. The
+template cache is kept between cases, so each template's first statement
+learns its table region and the later ones reuse it. With --corpus, every PDF in the
+directory is used; a ``<name>.json`` next to it holding {"transactions":
+[...]} (for instance a verified extraction) gives its ground truth,
+otherwise only the speed is reported.
+
+Accuracy is measured on the text the LLM would get:
+    cells  share of the amounts and balances that appear in the text
+    rows   share of transactions whose amount and balance appear on one line,
+           i.e. the row was rebuilt in one piece
+Engines whose package is not installed are reported as skipped.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from .generator import TEMPLATES, generate_statement
+from .run import _csv_list, _git_revision, _setup_django
+
+ENGINES = ('rapidocr', 'rapidocr-no-roi', 'rapidocr-per-page', 'docling')
+MONEY = re.compile(r'-?\d[\d,]*\.\d{2}\b')
+
+
+def _cents(text):
+    return round(float(text.replace(',', '')) * 100)
+
+
+def _line_amounts(line):
+    return Counter(_cents(match) for match in MONEY.findall(line))
+
+
+def score(text, transactions):
+    """
+    {'cells': ..., 'rows': ...} recall of the transactions in ``text``.
+    """
+    lines = [_line_amounts(line) for line in text.splitlines()]
+    found = sum(lines, Counter())
+    expected = Counter()
+    rows = 0
+    for transaction in transactions:
+        amount, balance = _cents(str(transaction['amount'])), _cents(str(transaction['balance']))
+        expected.update((amount, balance))
+        pair = Counter((amount, balance))
+        if any(not pair - line for line in lines):
+            rows += 1
+    cells = sum(min(count, found[value]) for value, count in expected.items())
+    return {
+        'cells': cells / max(sum(expected.values()), 1),
+        'rows': rows / max(len(transactions), 1),
+    }
+
+
+def _per_page():
+    """
+    RapidOCR's own call on each page, for comparison with the batched engine.
+    """
+    import fitz
+    from django.conf import settings
+    from rapidocr import RapidOCR
+
+    from statement_analyzer import cpu_budget, rapid_ocr
+
+    threads = cpu_budget.threads_per_task()
+    engine = RapidOCR(params={
+        'EngineConfig.onnxruntime.intra_op_num_threads': threads,
+        'EngineConfig.onnxruntime.inter_op_num_threads': threads,
+    })
+
+    def extract(path):
+        pages = []
+        with fitz.open(path) as doc:
+            for page in doc:
+                result = engine(rapid_ocr.render_page(page, settings.OCR_DPI))
+                lines = list(zip(result.boxes.tolist(), result.txts)) if result.boxes is not None else []
+                pages.append(rapid_ocr.layout_text(lines))
+        return '\n'.join(pages)
+
+    return extract
+
+
+def _without_roi(path):
+    from django.conf import settings
+
+    from statement_analyzer import rapid_ocr
+
+    roi, settings.OCR_ROI = settings.OCR_ROI, False
+    try:
+        return rapid_ocr.extract_text(path)
+    finally:
+        settings.OCR_ROI = roi
+
+
+def _engine(name):
+    """
+    fn(path) -> text for an engine; raises ImportError when it is not installed.
+    """
+    from pathlib import Path
+
+    from statement_analyzer import pdf_extractor, rapid_ocr
+
+    if name == 'docling':
+        if not pdf_extractor.DOCLING_AVAILABLE:
+            raise ImportError('docling is not installed')
+        pdf_extractor.get_docling_converter()
+        return lambda path: pdf_extractor.convert_with_docling(Path(path))
+    if not pdf_extractor.RAPIDOCR_AVAILABLE:
+        raise ImportError('rapidocr is not installed')
+    if name in ('rapidocr', 'rapidocr-no-roi'):
+        rapid_ocr.preload()
+        return rapid_ocr.extract_text if name == 'rapidocr' else _without_roi
+    return _per_page()
+
+
+def _cases(args):
+    """
+    (case name, PDF path, transactions or None, pages) for every statement.
+    """
+    import fitz
+
+    if args.corpus:
+        for path in sorted(glob.glob(os.path.join(args.corpus, '*.pdf'))):
+            truth = os.path.splitext(path)[0] + '.json'
+            transactions = None
+            if os.path.exists(truth):
+                with open(truth) as f:
+                    transactions = json.load(f).get('transactions')
+            with fitz.open(path) as doc:
+                yield os.path.basename(path), path, transactions, doc.page_count
+        return
+    for template in args.templates:
+        for pages in args.pages:
+            pdf_bytes, info = generate_statement(pages=pages, rows_per_page=args.rows, layout='scanned',
+                                                 template=template, seed=args.seed)
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as f:
+                f.write(pdf_bytes)
+            try:
+                yield f'{template}-{pages}p', f.name, info['transactions'], pages
+            finally:
+                os.unlink(f.name)
+
+
+def run(args):
+    _setup_django()
+    from django.conf import settings
+
+    if args.dpi:
+        settings.OCR_DPI = args.dpi
+    if args.rec_batch:
+        settings.OCR_REC_BATCH = args.rec_batch
+
+    engines = {}
+    for name in args.engines:
+        try:
+            start = time.perf_counter()
+            engines[name] = _engine(name)
+            print(f'{name:<18} ready in {time.perf_counter() - start:.1f}s')
+        except ImportError as e:
+            engines[name] = e
+            print(f'{name:<18} skipped ({e})')
+
+    results = []
+    print(f'\n{"engine":<18} {"case":<24} {"s/page":>8} {"cells":>7} {"rows":>7}')
+    for case, path, transactions, pages in _cases(args):
+        for name, extract in engines.items():
+            if isinstance(extract, Exception):
+                results.append({'engine': name, 'case': case, 'skipped': str(extract)})
+                continue
+            timings, text = [], ''
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                text = extract(path) or ''
+                timings.append(time.perf_counter() - start)
+            result = {'engine': name, 'case': case, 'pages': pages, 'characters': len(text),
+                      'seconds': statistics.median(timings),
+                      'seconds_per_page': statistics.median(timings) / max(pages, 1)}
+            if transactions:
+                result.update(score(text, transactions))
+            results.append(result)
+            accuracy = (f'{result["cells"]:7.1%} {result["rows"]:7.1%}' if transactions
+                        else f'{"-":>7} {"-":>7}')
+            print(f'{name:<18} {case:<24} {result["seconds_per_page"]:8.2f} {accuracy}')
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git_revision': _git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', type=_csv_list, default=list(ENGINES), help=f'from {",".join(ENGINES)}')
+    parser.add_argument('--corpus', help='directory of scanned PDFs to use instead of synthetic ones')
+    parser.add_argument('--pages', type=lambda v: _csv_list(v, int), default=[1, 5],
+                        help='comma separated page counts of the synthetic statements (default: 1,5)')
+    parser.add_argument('--rows', type=int, default=40, help='transaction rows per page (default: 40)')
+    parser.add_argument('--templates', type=_csv_list, default=sorted(TEMPLATES),
+                        help=f'comma separated templates from {",".join(sorted(TEMPLATES))}')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--dpi', type=int, help='OCR_DPI for the RapidOCR engines')
+    parser.add_argument('--rec-batch', type=int, help='OCR_REC_BATCH for the batched engine')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args(argv)
+    unknown = set(args.engines) - set(ENGINES)
+    if unknown:
+        parser.error(f'unknown engines: {", ".join(sorted(unknown))}')
+    unknown = set(args.templates) - set(TEMPLATES)
+    if unknown:
+        parser.error(f'unknown templates: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
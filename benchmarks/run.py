@@ -0,0 +1,232 @@
+"""
+Per-stage micro-benchmarks of the statement analysis pipeline.
+
+Every stage runs on synthetic statements from benchmarks.generator, so no
+uploads, network or API keys are needed. Examples:
+
+    python -m benchmarks.run --pages 1,5 --layouts text,scanned --output bench.json
+    python -m benchmarks.run --output new.json --baseline bench.json --threshold 0.15
+
+With --baseline the run exits with status 1 if any stage got slower than the
+threshold allows.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from .generator import LAYOUTS, TEMPLATES, generate_statement, render_pages
+
+STAGES = (
+    'is_image_based_pdf',
+    'extract_using_pdfplumber',
+    'extract_data_from_pdf',
+    'fix_skew_on_images',
+    'detect_visual_anomalies_opencv',
+    'verify_transactions',
+)
+
+
+def _setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bankstatement_project.settings')
+    import django
+
+    django.setup()
+
+
+# --- Stage runners: each returns a zero-argument callable timed per repeat ---
+def _stage_is_image_based_pdf(pdf_bytes, info, images):
+    from statement_analyzer import pdf_extractor
+
+    return lambda: pdf_extractor.is_image_based_pdf(io.BytesIO(pdf_bytes))
+
+
+def _stage_extract_using_pdfplumber(pdf_bytes, info, images):
+    from statement_analyzer import pdf_extractor
+
+    return lambda: pdf_extractor.extract_using_pdfplumber(io.BytesIO(pdf_bytes))
+
+
+def _stage_extract_data_from_pdf(pdf_bytes, info, images):
+    from statement_analyzer import pdf_extractor
+
+    return lambda: pdf_extractor.extract_data_from_pdf(io.BytesIO(pdf_bytes))
+
+
+def _stage_fix_skew_on_images(pdf_bytes, info, images):
+    from statement_analyzer import enhancement
+
+    return lambda: enhancement.fix_skew_on_images(images)
+
+
+def _stage_detect_visual_anomalies_opencv(pdf_bytes, info, images):
+    from statement_analyzer.data_extractor import BankStatementParser
+
+    parser = BankStatementParser()
+    return lambda: [parser.detect_visual_anomalies_opencv(image) for image in images]
+
+
+def _stage_verify_transactions(pdf_bytes, info, images):
+    from statement_analyzer import transaction_verifier
+
+    transactions = info['transactions']
+    return lambda: transaction_verifier.verify_transactions([dict(entry) for entry in transactions])
+
+
+STAGE_RUNNERS = {name: globals()[f'_stage_{name}'] for name in STAGES}
+
+
+def time_stage(stage, pdf_bytes, info, images, repeat, warmup):
+    """
+    Times one stage. Returns a result dict, with 'skipped' set when the stage
+    cannot run here (missing optional dependency or configuration).
+    """
+    try:
+        func = STAGE_RUNNERS[stage](pdf_bytes, info, images)
+    except Exception as e:
+        return {'skipped': f'{type(e).__name__}: {e}'}
+
+    timings = []
+    # The pipeline prints a lot; keep the benchmark output readable.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        try:
+            for i in range(warmup + repeat):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                if i >= warmup:
+                    timings.append(elapsed)
+        except Exception as e:
+            return {'skipped': f'{type(e).__name__}: {e}'}
+
+    timings.sort()
+    return {
+        'runs': len(timings),
+        'min_s': timings[0],
+        'median_s': statistics.median(timings),
+        'p95_s': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+        'mean_s': statistics.fmean(timings),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    _setup_django()
+    results = []
+    for layout in args.layouts:
+        for pages in args.pages:
+            pdf_bytes, info = generate_statement(pages=pages, rows_per_page=args.rows, layout=layout,
+                                                 template=args.template, tamper=args.tamper, seed=args.seed)
+            images = render_pages(pdf_bytes, dpi=args.dpi)
+            case = f'{layout}-{pages}p-{args.rows}r{"-tampered" if args.tamper else ""}'
+            for stage in args.stages:
+                result = time_stage(stage, pdf_bytes, info, images, args.repeat, args.warmup)
+                result.update({'case': case, 'stage': stage, 'pages': pages, 'layout': layout,
+                               'pdf_bytes': len(pdf_bytes)})
+                results.append(result)
+                if 'skipped' in result:
+                    print(f'{case:<28} {stage:<32} skipped ({result["skipped"]})')
+                else:
+                    print(f'{case:<28} {stage:<32} median {result["median_s"] * 1000:10.2f} ms'
+                          f'   p95 {result["p95_s"] * 1000:10.2f} ms')
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git_revision': _git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    Prints the median change per (case, stage) against a baseline report and
+    returns the list of regressions beyond ``threshold`` (a fraction).
+    """
+    previous = {(r['case'], r['stage']): r for r in baseline['results'] if 'skipped' not in r}
+    regressions = []
+    print(f'\n{"case":<28} {"stage":<32} {"baseline ms":>12} {"current ms":>12} {"change":>8}')
+    for result in current['results']:
+        key = (result['case'], result['stage'])
+        if 'skipped' in result or key not in previous:
+            continue
+        before, after = previous[key]['median_s'], result['median_s']
+        change = (after - before) / before if before else 0.0
+        marker = ''
+        if change > threshold:
+            regressions.append({'case': key[0], 'stage': key[1], 'change': change})
+            marker = '  REGRESSION'
+        print(f'{key[0]:<28} {key[1]:<32} {before * 1000:12.2f} {after * 1000:12.2f} {change:+8.1%}{marker}')
+    return regressions
+
+
+def _csv_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=lambda v: _csv_list(v, int), default=[1, 5],
+                        help='comma separated page counts (default: 1,5)')
+    parser.add_argument('--rows', type=int, default=40, help='transaction rows per page (default: 40)')
+    parser.add_argument('--layouts', type=_csv_list, default=list(LAYOUTS),
+                        help=f'comma separated layouts from {",".join(LAYOUTS)}')
+    parser.add_argument('--template', choices=sorted(TEMPLATES), default='classic')
+    parser.add_argument('--tamper', action='store_true', help='overwrite one balance in a different font')
+    parser.add_argument('--stages', type=_csv_list, default=list(STAGES),
+                        help=f'comma separated stages from {",".join(STAGES)}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--dpi', type=int, default=150, help='render DPI for the image stages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed median slowdown before flagging a regression (default: 0.10)')
+    args = parser.parse_args(argv)
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    unknown = set(args.layouts) - set(LAYOUTS)
+    if unknown:
+        parser.error(f'unknown layouts: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}.')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
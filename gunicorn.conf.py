@@ -0,0 +1,49 @@
+"""
+gunicorn settings for running several workers per node:
+
+    gunicorn bankstatement_project.wsgi          (picked up from this directory)
+
+The app is loaded once in the master (preload_app) and, with OCR_PRELOAD=1,
+so are PyMuPDF, pdfplumber, OpenCV and the Docling layout, table-structure
+and RapidOCR models (pdf_extractor.preload_ocr_models). The garbage
+collector is off in the master. gc.freeze() before the workers are forked
+keeps it from ever writing to those objects in a worker. The pages holding
+the models therefore stay shared copy-on-write, and a worker only adds the
+memory it allocates itself. OCR_PRELOAD=0 gives the usual per-worker loading.
+"""
+import gc
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+preload_app = os.getenv('OCR_PRELOAD', '1') == '1'
+
+# The workers split the node's CPU budget between them (statement_analyzer/cpu_budget.py).
+os.environ.setdefault('CPU_PROCESSES', str(workers))
+
+if preload_app:
+    gc.disable()
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from django.db import connections
+
+    from statement_analyzer import pdf_extractor
+
+    loaded = pdf_extractor.preload_ocr_models()
+    server.log.info("Loaded before forking workers: %s", ", ".join(loaded) or "nothing")
+    # Connections opened in the master must not be shared with the workers.
+    connections.close_all()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from statement_analyzer import mongo_store
+
+    mongo_store.set_mongo_client(None)
+    gc.enable()
@@ -1,3 +1,15 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import PipelineRun
+
+
+@admin.register(PipelineRun)
+class PipelineRunAdmin(admin.ModelAdmin):
+    """
+    The extraction path decisions of path_selector, for reviewing how it learns.
+    """
+    list_display = ('created_at', 'path', 'reason', 'attempt', 'layout', 'template', 'page_count',
+                    'seconds', 'cost', 'row_count', 'mismatch_count', 'passed')
+    list_filter = ('path', 'reason', 'passed', 'layout')
+    search_fields = ('document_hash', 'template')
+    readonly_fields = [field.name for field in PipelineRun._meta.fields]
@@ -1,6 +1,61 @@
+import logging
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+
+logger = logging.getLogger(__name__)
 
 
 class StatementAnalyzerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'statement_analyzer'
+
+    def ready(self):
+        from . import cpu_budget
+
+        # Before OpenCV, ONNX Runtime or BLAS load, so they start with the budgeted thread count.
+        cpu_budget.configure_process()
+        checks.register(check_analyzer_config, 'statement_analyzer')
+        if getattr(settings, 'MONGO_ENSURE_INDEXES_ON_STARTUP', False):
+            # Run in the background so a slow or missing mongod never delays startup.
+            threading.Thread(target=_ensure_mongo_indexes, name='mongo-indexes', daemon=True).start()
+
+
+def check_analyzer_config(app_configs, **kwargs):
+    """
+    Validates the LLM configuration (see config.py) when manage.py runs its
+    checks, instead of failing at import time.
+    """
+    from pydantic import ValidationError
+
+    from .config import get_config
+
+    try:
+        config = get_config()
+    except ValidationError as e:
+        return [
+            checks.Error(
+                f"Invalid value for {'.'.join(str(part) for part in error['loc']).upper()}: {error['msg']}",
+                hint="Fix it in the environment or the .env file next to manage.py.",
+                id='statement_analyzer.E001',
+            )
+            for error in e.errors()
+        ]
+    if getattr(settings, 'LLM_BACKEND', 'live') == 'live' and not config.openai_api_key:
+        return [checks.Warning(
+            "KEY_OPENAI is not set; statement extraction will fail with LLM_BACKEND=live.",
+            hint="Set KEY_OPENAI, or use LLM_BACKEND=standin / cassette for local runs.",
+            id='statement_analyzer.W001',
+        )]
+    return []
+
+
+def _ensure_mongo_indexes():
+    from . import mongo_store
+
+    try:
+        mongo_store.ensure_indexes()
+    except Exception as e:
+        logger.warning("Could not create MongoDB indexes: %s", e)
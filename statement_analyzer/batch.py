@@ -0,0 +1,251 @@
+"""
+Bulk uploads: several PDF statements, or a ZIP of them, analysed in parallel.
+
+Every file gets a worker thread that runs it through the pipeline
+(extract text -> LLM -> store) and records its progress on a BatchItem:
+
+- text extraction is CPU bound (pdfplumber, OCR) and runs in a pool of
+  EXTRACTION_WORKERS processes, so it does not contend for the GIL; each
+  extraction holds a CPU slot (cpu_budget.py) shared with interactive
+  uploads, and batches wait for one rather than being turned away;
+- the LLM call is I/O bound; at most LLM_CONCURRENCY of them run at once
+  to stay within the provider's rate limits.
+
+A batch therefore takes about as long as its slowest statement, not the sum
+of all of them. Workers only talk to the database, so any web worker can
+report a batch's progress.
+
+The worker threads live in the web process that accepted the upload; if it
+restarts, its items are never finished. expire_stale_items() marks them
+failed once BATCH_ITEM_TIMEOUT_S has passed so the batch page stops waiting.
+"""
+import logging
+import multiprocessing
+import threading
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import cpu_budget, pipeline
+from .llm_backends import LLMUnavailableError
+from .models import BatchItem, StatementBatch
+
+logger = logging.getLogger(__name__)
+
+_pools_lock = threading.Lock()
+_extraction_pool = None
+_file_pool = None
+_llm_slots = None
+
+
+class BatchError(ValueError):
+    """
+    An upload that cannot be accepted as a batch; the message is shown to the user.
+    """
+
+
+def expand_uploads(uploaded_files):
+    """
+    Returns [(filename, bytes)] for the uploaded PDFs, with the PDFs inside
+    any ZIP archive expanded in place. Enforces BATCH_MAX_FILES and
+    BATCH_MAX_BYTES before reading archive members.
+    """
+    files = []
+    total_bytes = 0
+
+    def add(name, size, read):
+        nonlocal total_bytes
+        if len(files) >= settings.BATCH_MAX_FILES:
+            raise BatchError(f"A batch can contain at most {settings.BATCH_MAX_FILES} statements.")
+        total_bytes += size
+        if total_bytes > settings.BATCH_MAX_BYTES:
+            raise BatchError(f"A batch can be at most {settings.BATCH_MAX_BYTES // (1024 * 1024)} MB.")
+        files.append((name, read()))
+
+    for uploaded_file in uploaded_files:
+        name = uploaded_file.name
+        if name.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(uploaded_file)
+            except zipfile.BadZipFile:
+                raise BatchError(f"{name} is not a valid ZIP archive.")
+            with archive:
+                for info in archive.infolist():
+                    member = info.filename
+                    if info.is_dir() or member.startswith('__MACOSX/') or not member.lower().endswith('.pdf'):
+                        continue
+                    add(member.rsplit('/', 1)[-1], info.file_size, lambda info=info: archive.read(info))
+        elif name.lower().endswith('.pdf'):
+            add(name, uploaded_file.size, uploaded_file.read)
+        else:
+            raise BatchError(f"{name} is not a PDF or ZIP file.")
+
+    if not files:
+        raise BatchError("No PDF statements found in the upload.")
+    return files
+
+
+def get_extraction_pool():
+    """
+    The process-wide pool for text extraction, created on first use.
+    """
+    global _extraction_pool
+    with _pools_lock:
+        if _extraction_pool is None:
+            workers = settings.EXTRACTION_WORKERS or cpu_budget.task_slots()
+            if settings.EXTRACTION_IN_PROCESSES:
+                # spawn, not fork: the parent has DB connections and threads
+                _extraction_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            else:
+                _extraction_pool = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='extract',
+                )
+        return _extraction_pool
+
+
+def _get_file_pool():
+    global _file_pool, _llm_slots
+    with _pools_lock:
+        if _file_pool is None:
+            _file_pool = ThreadPoolExecutor(max_workers=settings.BATCH_FILE_WORKERS, thread_name_prefix='batch')
+            _llm_slots = threading.BoundedSemaphore(settings.LLM_CONCURRENCY)
+        return _file_pool
+
+
+def create_batch(files):
+    """
+    Creates a StatementBatch with one pending BatchItem per (filename, bytes).
+    """
+    with transaction.atomic():
+        batch = StatementBatch.objects.create(file_count=len(files))
+        BatchItem.objects.bulk_create(
+            BatchItem(batch=batch, index=index, filename=filename[:255])
+            for index, (filename, _) in enumerate(files)
+        )
+    return batch
+
+
+def submit_batch(batch, files):
+    """
+    Queues every file of the batch for processing and returns immediately.
+    """
+    pool = _get_file_pool()
+    for index, (filename, file_bytes) in enumerate(files):
+        pool.submit(process_item, batch.pk, index, filename, file_bytes)
+
+
+def _update_item(batch_id, index, **fields):
+    BatchItem.objects.filter(batch_id=batch_id, index=index).update(**fields)
+
+
+def process_item(batch_id, index, filename, file_bytes):
+    """
+    Runs one file of a batch through the pipeline. Never raises: failures are
+    recorded on the item.
+    """
+    close_old_connections()
+    try:
+        _update_item(batch_id, index, status=BatchItem.EXTRACTING, started_at=timezone.now())
+
+        @contextmanager
+        def llm_slot():
+            _update_item(batch_id, index, status=BatchItem.ANALYZING)
+            with _llm_slots:
+                yield
+
+        def offload(fn, *args):
+            with cpu_budget.cpu_slot():
+                return get_extraction_pool().submit(fn, *args).result()
+
+        with cpu_budget.background():
+            statement = pipeline.analyze_and_store(file_bytes, filename=filename, offload=offload, llm_gate=llm_slot)
+        if not statement:
+            raise BatchError("Failed to extract transaction data.")
+
+        _update_item(
+            batch_id, index,
+            status=BatchItem.DONE,
+            statement=statement,
+            mismatch_count=pipeline.count_mismatches(statement),
+            finished_at=timezone.now(),
+        )
+        logger.info("Batch %s: %s done (%d rows)", batch_id, filename, statement.row_count)
+    except Exception as e:
+        if not isinstance(e, (BatchError, LLMUnavailableError)):
+            logger.exception("Batch %s: %s failed", batch_id, filename)
+        _update_item(batch_id, index, status=BatchItem.FAILED, error=str(e) or type(e).__name__,
+                     finished_at=timezone.now())
+    finally:
+        connection.close()
+
+
+def expire_stale_items(batch):
+    """
+    Marks the items of the batch that have been pending or running for longer
+    than BATCH_ITEM_TIMEOUT_S as failed. Returns how many were expired.
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.BATCH_ITEM_TIMEOUT_S)
+    stale = batch.items.filter(status__in=[BatchItem.PENDING, BatchItem.EXTRACTING, BatchItem.ANALYZING]).filter(
+        Q(started_at__lt=cutoff) | Q(started_at__isnull=True, batch__created_at__lt=cutoff)
+    )
+    expired = stale.update(status=BatchItem.FAILED, error="Timed out; please upload this statement again.",
+                           finished_at=now)
+    if expired:
+        logger.warning("Batch %s: %d item(s) timed out", batch.key, expired)
+    return expired
+
+
+def batch_summary(batch):
+    """
+    Per-file status and combined totals of a batch, for the status endpoint.
+    """
+    items = []
+    totals = {'files': batch.file_count, 'done': 0, 'failed': 0, 'transactions': 0, 'mismatches': 0}
+    accounts = set()
+    for item in batch.items.select_related('statement').defer('statement__source_pdf'):
+        statement = item.statement
+        account_info = statement.account_info if statement else {}
+        seconds = None
+        if item.started_at and item.finished_at:
+            seconds = round((item.finished_at - item.started_at).total_seconds(), 2)
+        items.append({
+            'index': item.index,
+            'filename': item.filename,
+            'status': item.status,
+            'status_label': item.get_status_display(),
+            'error': item.error,
+            'statement_key': str(statement.key) if statement else None,
+            'bank_name': account_info.get('bank_name'),
+            'account_number': account_info.get('account_number'),
+            'holder_name': account_info.get('holder_name'),
+            'period': account_info.get('period'),
+            'row_count': statement.row_count if statement else None,
+            'mismatch_count': item.mismatch_count,
+            'seconds': seconds,
+        })
+        if item.status == BatchItem.DONE:
+            totals['done'] += 1
+            totals['transactions'] += statement.row_count if statement else 0
+            totals['mismatches'] += item.mismatch_count or 0
+            if account_info.get('account_number'):
+                accounts.add(account_info['account_number'])
+        elif item.status == BatchItem.FAILED:
+            totals['failed'] += 1
+
+    totals['accounts'] = sorted(accounts)
+    return {
+        'key': str(batch.key),
+        'finished': totals['done'] + totals['failed'] == batch.file_count,
+        'items': items,
+        'totals': totals,
+    }
@@ -0,0 +1,47 @@
+"""
+Validated configuration for the LLM side of the analyzer.
+
+Values come from the environment or the ``.env`` file next to manage.py
+(see README). They are read and validated on first use by get_config(), and
+checked at startup by the "statement_analyzer" system check, so importing a
+module never fails because a variable is missing.
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+class AnalyzerConfig(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=BASE_DIR / ".env",
+        env_file_encoding="utf-8",
+        env_ignore_empty=True,
+        extra="ignore",
+    )
+
+    key_openai: Optional[SecretStr] = None
+    gemini_api_key: Optional[SecretStr] = None
+    open_ai_model: str = "gpt-4o"
+    max_token_limit: int = Field(4096, gt=0)
+
+    @property
+    def openai_api_key(self):
+        return self.key_openai.get_secret_value() if self.key_openai else None
+
+    @property
+    def gemini_key(self):
+        return self.gemini_api_key.get_secret_value() if self.gemini_api_key else None
+
+
+@lru_cache(maxsize=None)
+def get_config():
+    """
+    Returns the process-wide AnalyzerConfig. Raises pydantic.ValidationError
+    on invalid values; call get_config.cache_clear() to re-read.
+    """
+    return AnalyzerConfig()
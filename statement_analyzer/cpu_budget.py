@@ -0,0 +1,218 @@
+"""
+One CPU budget per deployment: how many threads the native libraries start
+and how many CPU-heavy tasks a process runs at once.
+
+OpenCV (deskewing, the visual anomaly check), ONNX Runtime (RapidOCR, via
+Docling), OpenBLAS/MKL and OpenMP each start one thread per core. A few
+concurrent uploads then have several times more runnable threads than there
+are cores, and throughput drops as they preempt each other. Instead:
+
+- CPU_THREADS cores (default: those this process may run on, counting a
+  cgroup quota) are shared by the CPU_PROCESSES server processes on the node;
+- every CPU-heavy task (text extraction, OCR, page rendering) gets
+  CPU_THREADS_PER_TASK threads in each native library (configure_process);
+- a process runs at most task_slots() such tasks at once (cpu_slot); the
+  others queue, and an upload that waits more than CPU_QUEUE_TIMEOUT seconds
+  is turned away with ServerBusyError instead of slowing everyone down.
+  Interactive uploads are served before background() work (bulk uploads),
+  which waits as long as it takes, so a large batch cannot push them past
+  the timeout.
+
+configure_process() runs in AppConfig.ready, before any of those libraries
+is loaded. The limits are set as environment variables, so the extraction
+processes started later inherit them.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .instrumentation import CPU_SLOT_REJECTIONS, CPU_SLOT_WAIT, CPU_SLOTS_IN_USE
+
+logger = logging.getLogger(__name__)
+
+# Read by OpenMP, OpenBLAS, MKL, Accelerate, numexpr and OpenCV when they load.
+THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS', 'OPENCV_FOR_THREADS_NUM',
+)
+
+_slots_lock = threading.Lock()
+_slots = None
+_in_use = 0
+_local = threading.local()
+
+
+class ServerBusyError(Exception):
+    """
+    No CPU slot came free within CPU_QUEUE_TIMEOUT seconds.
+    """
+
+
+def available_cpus():
+    """
+    Cores this process may run on: its CPU affinity, lowered to the cgroup v2 quota if there is one.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def process_threads(processes=None):
+    """
+    This process's share of CPU_THREADS, with ``processes`` (default CPU_PROCESSES) sharing the node.
+    """
+    total = settings.CPU_THREADS or available_cpus()
+    return max(1, total // max(1, processes or settings.CPU_PROCESSES))
+
+
+def threads_per_task(processes=None):
+    return max(1, min(settings.CPU_THREADS_PER_TASK, process_threads(processes)))
+
+
+def task_slots(processes=None):
+    """
+    CPU-heavy tasks one process runs at once; also the default size of its extraction pool.
+    """
+    return max(1, process_threads(processes) // threads_per_task(processes))
+
+
+def configure_process():
+    """
+    Caps the thread pools of the native libraries at threads_per_task().
+    Variables already set in the environment are left alone. Returns the
+    number of threads per library.
+    """
+    threads = threads_per_task()
+    for name in THREAD_ENV_VARS:
+        os.environ.setdefault(name, str(threads))
+    cv2 = sys.modules.get('cv2')
+    if cv2 is not None:
+        # Loaded already (e.g. imported by a script before django.setup()); the variable came too late.
+        cv2.setNumThreads(int(os.environ['OPENCV_FOR_THREADS_NUM']))
+    logger.debug("CPU budget: %d threads per task, %d tasks at once", threads, task_slots())
+    return threads
+
+
+class _Slots:
+    """
+    A semaphore that serves waiters in arrival order, interactive waiters
+    before background ones. A released slot is handed straight to the
+    longest waiting thread, so a request that just finished cannot take it
+    back ahead of the queue (threading.Semaphore lets it, which leaves
+    unlucky uploads waiting far longer than the rest).
+    """
+
+    def __init__(self, count):
+        self._free = count
+        self._waiters = deque()
+        self._background = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None, background=False):
+        with self._lock:
+            if self._free and not self._waiters and not self._background:
+                self._free -= 1
+                return True
+            waiter = threading.Lock()
+            waiter.acquire()
+            queue = self._background if background else self._waiters
+            queue.append(waiter)
+        if waiter.acquire(timeout=-1 if timeout is None else timeout):
+            return True
+        with self._lock:
+            try:
+                queue.remove(waiter)
+            except ValueError:
+                return True  # handed a slot just as the wait timed out
+        return False
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().release()
+            elif self._background:
+                self._background.popleft().release()
+            else:
+                self._free += 1
+
+
+def _get_slots():
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = _Slots(task_slots())
+        return _slots
+
+
+def _count(delta):
+    global _in_use
+    with _slots_lock:
+        _in_use += delta
+        CPU_SLOTS_IN_USE.set(_in_use)
+
+
+@contextmanager
+def background():
+    """
+    Within the block, this thread waits for CPU slots as long as it takes,
+    behind any interactive upload (bulk uploads, where nobody is waiting for
+    a response).
+    """
+    previous = getattr(_local, 'background', False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+
+@contextmanager
+def cpu_slot():
+    """
+    Holds one of the process's task_slots() while a CPU-heavy task runs.
+    Raises ServerBusyError after CPU_QUEUE_TIMEOUT seconds without a free
+    slot, except inside background(). A thread that already holds a slot
+    does not take a second one.
+    """
+    if getattr(_local, 'held', False):
+        yield
+        return
+    slots = _get_slots()
+    background = getattr(_local, 'background', False)
+    timeout = None if background else settings.CPU_QUEUE_TIMEOUT
+    start = time.monotonic()
+    if not slots.acquire(timeout=timeout, background=background):
+        CPU_SLOT_REJECTIONS.inc()
+        raise ServerBusyError(f"All {task_slots()} CPU slots stayed busy for {timeout:g}s.")
+    CPU_SLOT_WAIT.observe(time.monotonic() - start)
+    _count(1)
+    _local.held = True
+    try:
+        yield
+    finally:
+        _local.held = False
+        _count(-1)
+        slots.release()
+
+
+def run(fn, *args):
+    """
+    fn(*args) in a CPU slot; the default ``offload`` of the pipeline.
+    """
+    with cpu_slot():
+        return fn(*args)
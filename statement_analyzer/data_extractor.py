@@ -1,44 +1,73 @@
 #!/usr/bin/env python3
 """
 Bank Statement Transaction Extractor
-This script uses Claude API to extract transaction data from bank statements
-and generates an HTML interface with Excel download functionality.
+BankStatementParser sends statement text or page images to the OpenAI and
+Gemini models (through the backend chosen in llm_backends.py) to extract the
+account details and transactions, and to look for signs of tampering.
 """
-import cv2
-import numpy as np
-from PIL import Image
+from __future__ import annotations
+
 import json
-import ast
-import re
-import os
 import base64
 import io
+import logging
 from typing import List, Dict, Any, Tuple
-from openai import OpenAI
-import google.generativeai as genai
-from tiktoken import encoding_for_model
 
+from django.conf import settings
+
+from .instrumentation import LLM_PARSE_OUTCOMES, record_llm_call, span
+from .lazy import lazy_import
+from .llm_backends import LLMUnavailableError, get_llm_backend, is_gemini_model
+from .llm_json import StatementStreamParser, loads_lenient, parse_statement
+
+# Loaded on first use; see lazy.py
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
 
-from PIL import Image
+logger = logging.getLogger(__name__)
 
-from dotenv import load_dotenv
+CONTINUATION_PROMPT = """
+Your previous answer was cut off before the end of the statement. The last transaction you returned was:
+{last_row}
+
+Continue with the transactions that come after it, up to the end of the statement, following the same rules.
+Respond only with a JSON object of the form {{"transactions": [...]}} and do not repeat earlier transactions.
+"""
 
-load_dotenv()
-OPENAI_KEY=os.getenv("KEY_OPENAI")
-GEMINI_KEY=os.getenv("GEMINI_API_KEY")
-OPEN_AI_MODEL = os.getenv("OPEN_AI_MODEL")
-MAX_TOKEN_LIMIT = int(os.getenv("MAX_TOKEN_LIMIT"))  # Default to 4096 if not set
 
+def _row_key(row):
+    return row.get("date"), row.get("amount"), row.get("balance")
 
-client = OpenAI(api_key=OPENAI_KEY)
-genai.configure(api_key=GEMINI_KEY)
+
+def continuation_rows(rows, tail):
+    """
+    The rows of a continuation answer that follow ``rows``: any the model
+    repeated from before the cut are dropped and integer ids that restarted
+    are renumbered.
+    """
+    last = rows[-1]
+    for i in range(len(tail) - 1, -1, -1):
+        if _row_key(tail[i]) == _row_key(last):
+            tail = tail[i + 1:]
+            break
+    if tail and isinstance(last.get("id"), int) and isinstance(tail[0].get("id"), int) and tail[0]["id"] <= last["id"]:
+        offset = last["id"] + 1 - tail[0]["id"]
+        for row in tail:
+            if isinstance(row.get("id"), int):
+                row["id"] += offset
+    return tail
 
 
 class BankStatementParser:
-    def __init__(self):
+    def __init__(self, backend=None):
         """
         Initialize the BankStatementParser.
+        Args:
+            backend: LLMBackend used for every model call; defaults to the one
+                     configured by the LLM_BACKEND setting (see llm_backends.py).
         """
+        self.backend = backend or get_llm_backend()
         self.combined_prompt = """
         You are a financial auditing and data extraction AI.
 
@@ -99,9 +128,143 @@ class BankStatementParser:
         Ensure the JSON is valid and does not contain markdown or explanations.
         """
 
-    def extract_transactions_gemini(self, statement_text: str):
+    def _complete(self, stage, **kwargs):
         """
-        Extracts transaction data from bank statement text using the Gemini API and returns cleaned float values.
+        One call to the LLM backend, timed as ``stage`` and counted with its token usage.
+        """
+        model = kwargs.get("model")
+        with span(stage) as s:
+            try:
+                response = self.backend.complete(**kwargs)
+            except Exception:
+                record_llm_call("gemini" if is_gemini_model(model) else "openai", model, outcome="error")
+                raise
+            s.add(llm_calls=1, prompt_tokens=response.prompt_tokens, completion_tokens=response.completion_tokens)
+            record_llm_call(response.provider, model, response.prompt_tokens, response.completion_tokens)
+        return response
+
+    def _statement_format(self):
+        from .schemas import STATEMENT_FORMAT  # pydantic is only loaded when a statement is parsed
+
+        return STATEMENT_FORMAT if getattr(settings, "LLM_STRUCTURED_OUTPUT", True) else None
+
+    def _stream(self, stage, **kwargs):
+        """
+        Streaming _complete: yields the answer's text as it arrives and records
+        the call the same way once it ends.
+        """
+        model = kwargs.get("model")
+        provider = "gemini" if is_gemini_model(model) else "openai"
+        prompt_tokens = completion_tokens = 0
+        with span(stage) as s:
+            try:
+                for piece in self.backend.stream(**kwargs):
+                    provider = piece.provider
+                    prompt_tokens = max(prompt_tokens, piece.prompt_tokens)
+                    completion_tokens = max(completion_tokens, piece.completion_tokens)
+                    if piece.text:
+                        yield piece.text
+            except Exception:
+                record_llm_call(provider, model, outcome="error")
+                raise
+            s.add(llm_calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            record_llm_call(provider, model, prompt_tokens, completion_tokens)
+
+    def _statement_events(self, model, messages, max_tokens=None, stream=True):
+        """
+        Runs a statement extraction prompt. Yields ("account_info", dict) and
+        ("transaction", dict), validated, as soon as each is parsed (with
+        stream=False only once the whole answer is in), then ("done", statement),
+        where statement is None if nothing usable came back. The statement is
+        built from the rows already yielded, so a caller showing them as they
+        arrive shows exactly what ends up stored.
+        If the answer was cut off, its complete rows are kept and only the rest
+        is asked for again, up to LLM_CONTINUATION_ATTEMPTS times.
+        """
+        from .schemas import validate_account_info, validate_statement, validate_transaction
+
+        call = dict(model=model, messages=messages, max_tokens=max_tokens, response_format=self._statement_format())
+        data, complete = None, False
+        if stream:
+            parser = StatementStreamParser()
+            account_info, transactions = {}, []
+            for text in self._stream("llm_extraction", **call):
+                for kind, value in parser.feed(text):
+                    if kind == "account_info":
+                        account_info = validate_account_info(value)
+                        yield kind, account_info
+                    else:
+                        transactions.append(validate_transaction(value))
+                        yield kind, transactions[-1]
+            if parser.account_info is not None or parser.transactions:
+                data = {"account_info": account_info, "transactions": transactions}
+                complete = parser.complete
+            text = parser.text
+        else:
+            text = self._complete("llm_extraction", **call).text
+
+        if data is None:
+            # Not streamed, or not parseable incrementally (e.g. Python-style quoting).
+            data, complete = parse_statement(text)
+            data = validate_statement(data)
+            if data is None:
+                LLM_PARSE_OUTCOMES.inc(outcome="failed")
+                logger.error("No statement JSON in the %s answer (%d characters)", model, len(text))
+                yield "done", None
+                return
+            yield "account_info", data["account_info"]
+            for row in data["transactions"]:
+                yield "transaction", row
+
+        outcome = "complete" if complete else "partial"
+        attempts = getattr(settings, "LLM_CONTINUATION_ATTEMPTS", 2)
+        while not complete and data["transactions"] and attempts > 0:
+            attempts -= 1
+            rows, complete = self._request_rest(call, data["transactions"])
+            data["transactions"] += rows
+            for row in rows:
+                yield "transaction", row
+            outcome = "continued" if complete else "partial"
+            if not rows:
+                break
+        if not complete:
+            logger.warning("Keeping %d transactions of a truncated %s answer", len(data["transactions"]), model)
+        LLM_PARSE_OUTCOMES.inc(outcome=outcome)
+        yield "done", data
+
+    def _request_rest(self, call, rows):
+        """
+        Asks for the transactions after the last of ``rows``, which ended a
+        cut-off answer. Returns (new rows, validated, complete).
+        """
+        from .schemas import validate_transaction
+
+        logger.warning("The %s answer was cut off after %d transactions; requesting the rest",
+                       call["model"], len(rows))
+        last_row = json.dumps(rows[-1], ensure_ascii=False)
+        response = self._complete(
+            "llm_continuation",
+            **dict(call, messages=call["messages"] + [
+                {"role": "user", "content": CONTINUATION_PROMPT.format(last_row=last_row)},
+            ]),
+        )
+        tail, complete = parse_statement(response.text)
+        if not tail or not isinstance(tail.get("transactions"), list):
+            return [], False
+        tail = [validate_transaction(row) for row in tail["transactions"] if isinstance(row, dict)]
+        return continuation_rows(rows, tail), complete
+
+    def _extract_statement(self, model, messages, max_tokens=None):
+        """
+        The validated statement from an extraction prompt, or None; see _statement_events.
+        """
+        for kind, value in self._statement_events(model, messages, max_tokens, stream=False):
+            if kind == "done":
+                return value
+
+    def _gemini_text_messages(self, statement_text: str):
+        """
+        The prompt of extract_transactions_gemini.
         """
         prompt = f"""
         You are an intelligent financial data extraction engine. Your task is to extract structured transaction data from the provided bank statement text.
@@ -147,32 +310,19 @@ class BankStatementParser:
         ---
         """
 
-        model = genai.GenerativeModel(model_name="gemini-1.5-flash")
+        return [{"role": "user", "content": prompt}]
 
+    def extract_transactions_gemini(self, statement_text: str):
+        """
+        Extracts transaction data from bank statement text using the Gemini API and returns cleaned float values.
+        """
         try:
-            response = model.generate_content(prompt)
-            content = response.text
-
-            # Robust cleanup: Remove any leading/trailing whitespace and common markdown enclosures
-            content = content.strip()
-            if content.startswith("```json"):
-                content = content[len("```json"):].strip()
-            if content.endswith("```"):
-                content = content[:-len("```")].strip()
-
-            # Attempt to parse the JSON. This is where your error usually occurs.
-            data = json.loads(content)
-
-            return data
-
-        except json.JSONDecodeError as e:
-            print(f"JSON Decoding Error in extract_transactions_gemini: {e}")
-            print(f"Problematic content around error: {content[max(0, e.pos-50):min(len(content), e.pos+50)]}")
-            print("Full problematic content:")
-            print(content)
-            return None
+            return self._extract_statement("gemini-1.5-flash", self._gemini_text_messages(statement_text))
+
+        except LLMUnavailableError:
+            raise
         except Exception as e:
-            print(f"An unexpected error occurred in extract_transactions_gemini: {e}")
+            logger.error("An unexpected error occurred in extract_transactions_gemini: %s", e)
             return None
 
     def process_bank_statement(self, images: List[Image.Image]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
@@ -191,32 +341,29 @@ class BankStatementParser:
                     }
                 })
 
-            response = client.chat.completions.create(
+            response = self._complete(
+                "llm_extraction",
                 model="gpt-4o",
                 messages=messages,
                 max_tokens=4000,
                 temperature=0.2
             )
 
-            content = response.choices[0].message.content.strip()
-            if content.startswith("```json"):
-                content = re.sub(r"^```(?:json)?", "", content, flags=re.IGNORECASE).strip()
-                content = re.sub(r"```$", "", content).strip()
+            from .schemas import validate_fraud_issues, validate_statement
 
-            result = json.loads(content)
-            fraud_details = result.get("fraud_details", [])
-            extracted_data = result.get("extracted_data", {})
+            result = self.safe_parse_json(response.text)
+            fraud_details = validate_fraud_issues(result.get("fraud_details", []))
+            extracted_data = validate_statement(result.get("extracted_data")) or {}
 
             return fraud_details, extracted_data
 
+        except LLMUnavailableError:
+            raise
         except Exception as e:
-            print(f"Error during unified processing: {e}")
+            logger.error("Error during unified processing: %s", e)
             return [], {}
 
     def detect_visual_anomalies_opencv(self, img_pil: Image.Image) -> List[Dict[str, Any]]:
-        import base64
-        from io import BytesIO
-
         img_gray = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2GRAY)
         edges = cv2.Canny(img_gray, 50, 150)
         contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -232,7 +379,7 @@ class BankStatementParser:
                 snippet_pil = Image.fromarray(snippet_np)
 
                 # Convert cropped region to base64
-                buffered = BytesIO()
+                buffered = io.BytesIO()
                 snippet_pil.save(buffered, format="PNG")
                 encoded_snippet = base64.b64encode(buffered.getvalue()).decode("utf-8")
                 base64_image = f"data:image/png;base64,{encoded_snippet}"
@@ -329,24 +476,22 @@ class BankStatementParser:
                 })
 
             # Send to GPT-4o
-            response = client.chat.completions.create(
+            response = self._complete(
+                "llm_fraud_detection",
                 model="gpt-4o",
                 messages=messages,
                 max_tokens=4096,
                 temperature=0.2
             )
 
-            content = response.choices[0].message.content.strip()
+            from .schemas import validate_fraud_issues
 
-            # Clean JSON output (in case GPT wraps it in ```json)
-            if content.startswith("```json"):
-                content = re.sub(r"^```json", "", content)
-                content = re.sub(r"```$", "", content).strip()
-
-            return json.loads(content)
+            return validate_fraud_issues(loads_lenient(response.text))
 
+        except LLMUnavailableError:
+            raise
         except Exception as e:
-            print(f"Error during fraud detection: {e}")
+            logger.error("Error during fraud detection: %s", e)
             return []
 
     def image_to_base64_data_uri(self, image: Image.Image) -> str:
@@ -387,23 +532,23 @@ class BankStatementParser:
 
 
         Respond only in this strict JSON format (no markdown or explanations):
-        {
-        "account_info": {
+        {{
+        "account_info": {{
             "holder_name": "string",
             "account_number": "string",
             "period": "string",
             "final_balance": float
-        },
+        }},
         "transactions": [
-            {
+            {{
             "id": "string or integer",
             "details": "string",
             "date": "DD-MM-YYYY",
             "amount": "float",
             "balance": "float"
-            }
+            }}
         ]
-        }
+        }}
         """
         try:
             # Encode all images to base64 image_url format
@@ -418,31 +563,30 @@ class BankStatementParser:
                     "image_url": {"url": f"data:image/png;base64,{b64_img}"}
                 })
 
-            response = client.chat.completions.create(
+            response = self._complete(
+                "llm_extraction",
                 model="gpt-4o",
                 messages=[
                     {"role": "user", "content": [{"type": "text", "text": prompt}] + image_messages}
                 ],
                 max_tokens=4000,
-                temperature=0.2
+                temperature=0.2,
+                response_format=self._statement_format()
             )
 
-            content = response.choices[0].message.content.strip()
-
-            if content.startswith("```json"):
-                content = re.sub(r"^```json", "", content)
-                content = re.sub(r"```$", "", content).strip()
+            from .schemas import validate_statement
 
-            data = json.loads(content)
-            return data
+            return validate_statement(loads_lenient(response.text))
 
+        except LLMUnavailableError:
+            raise
         except Exception as e:
-            print(f"Error in extract_transactions_gpt: {e}")
+            logger.error("Error in extract_transactions_gpt: %s", e)
             return None
 
-    def extract__from_text_transactions_gpt(self, statement_text: str) -> Dict[str, Any]:
+    def _gpt_text_messages(self, statement_text: str):
         """
-        Extracts transaction data from bank statement text using the OpenAI GPT API and returns cleaned float values.
+        The prompt of extract__from_text_transactions_gpt.
         """
         prompt = """
         - All monetary values must be parsed as clean float numbers, using proper positive or negative signs (e.g., 1200.50, -450.75), and must not include any symbols, commas, or placeholders like '-' or 'Rs.'.
@@ -499,70 +643,54 @@ class BankStatementParser:
                         f"Ensure the response is strictly a dictionary. The bank statement text is: {statement_text}."
             }
         ]
+        return messages
 
+    def extract__from_text_transactions_gpt(self, statement_text: str) -> Dict[str, Any]:
+        """
+        Extracts transaction data from bank statement text using the OpenAI GPT API and returns cleaned float values.
+        """
+        from .config import get_config  # pydantic-settings is only loaded when a statement is parsed
 
         try:
-            response = {}
-            # try:
-            #     tokenizer = encoding_for_model(OPEN_AI_MODEL)
-            #     print(f"Loaded tokenizer: {type(tokenizer)}")  # Debug line
-            # except KeyError:
-            #     raise ValueError(f"Tokenizer for {OPEN_AI_MODEL} is not available.")
-
-            # input_tokens = sum(len(tokenizer.encode(message["content"])) for message in messages)
-
-
-            # if MAX_TOKEN_LIMIT - input_tokens - 50  >0:
-            #     max_tokens=input_tokens + 50
-
-            response = client.chat.completions.create(
-                model=OPEN_AI_MODEL,
-                messages=messages,
-                max_tokens=MAX_TOKEN_LIMIT
+            config = get_config()
+            return self._extract_statement(
+                model=config.open_ai_model,
+                messages=self._gpt_text_messages(statement_text),
+                max_tokens=config.max_token_limit
             )
-            
-            if not response:
-                print("No response received from OpenAI API.")
-                return {}
-
-            content = response.choices[0].message.content
-            print("content", content)
-
-            # Handle JSON wrapped in markdown
-            if content.startswith("```json"):
-                content = content.replace("```json", "").replace("```", "").strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "").strip()
-
-            
-            # try:
-            #     response_dict = response.model_dump()
-            #     content =  response_dict['choices'][0]['message']['content']
-            #     data =  self.safe_parse_json(content)
-            # except Exception:
-            #     print("here")
-            #     data = eval(response.choices[0].message.content)  # Fallback
-
 
+        except LLMUnavailableError:
+            raise
         except Exception as e:
-            print(f"Error in extract_transactions_gpt: {e}")
+            logger.error("Error in extract_transactions_gpt: %s", e)
             return None
-    
-        return json.loads(content)
+
+    def stream_transactions_gpt(self, statement_text: str):
+        """
+        extract__from_text_transactions_gpt with the answer streamed: yields
+        ("account_info" | "transaction" | "done", value) events as they are
+        parsed (see _statement_events). Errors are raised, not logged.
+        """
+        from .config import get_config
+
+        config = get_config()
+        return self._statement_events(
+            config.open_ai_model, self._gpt_text_messages(statement_text), config.max_token_limit,
+        )
+
+    def stream_transactions_gemini(self, statement_text: str):
+        """
+        extract_transactions_gemini with the answer streamed; see stream_transactions_gpt.
+        """
+        return self._statement_events("gemini-1.5-flash", self._gemini_text_messages(statement_text))
 
     def safe_parse_json(self, content: str) -> dict:
         """
-        Safely parses a JSON-like string from OpenAI responses, even if wrapped in markdown.
+        Safely parses a JSON-like string from OpenAI responses, even if wrapped in markdown
+        or cut off (see llm_json.loads_lenient).
         """
-        # Remove markdown code block if present
-        print("in safe parse_json")
-        content = re.sub(r"^```(?:json)?|```$", "", content.strip(), flags=re.MULTILINE)
-        
-        try:
-            return json.loads(content)
-        except json.JSONDecodeError:
-            try:
-                return ast.literal_eval(content)
-            except Exception:
-                print(" Failed to parse GPT response as JSON.")
-                return {}
+        data = loads_lenient(content)
+        if data is None:
+            logger.error("Failed to parse GPT response as JSON.")
+            return {}
+        return data
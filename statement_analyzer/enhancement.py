@@ -1,12 +1,16 @@
 import io
-from PIL import Image
-import cv2
-import numpy as np
-from pdf2image import convert_from_bytes # Ensure poppler is installed for pdf2image
-from PyPDF2 import PdfReader # Use PdfReader for reading PDF documents
-import io
+import logging
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from PIL import Image
+
+from .lazy import lazy_import
+
+# Loaded on first use; see lazy.py
+Image = lazy_import("PIL.Image")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+pdf2image = lazy_import("pdf2image")  # Ensure poppler is installed for pdf2image
+
+logger = logging.getLogger(__name__)
 
 # --- Core Functions ---
 
@@ -23,8 +27,8 @@ def convert_pdf_to_images(pdf_object_bytesio):
     # Important: Always seek to the beginning of the BytesIO object before reading its content.
     pdf_object_bytesio.seek(0)
     # convert_from_bytes reads the entire byte stream of the PDF.
-    images = convert_from_bytes(pdf_object_bytesio.read())
-    print(f"  -> Converted {len(images)} pages from PDF to images.")
+    images = pdf2image.convert_from_bytes(pdf_object_bytesio.read())
+    logger.debug("Converted %d pages from PDF to images.", len(images))
     return images
 
 
@@ -40,7 +44,7 @@ def fix_skew_on_images(images):
 
         if coords.size == 0:
             fixed_images.append(image)
-            print(f"[Skipped deskew] Blank page detected at index {i}")
+            logger.debug("Skipped deskew: blank page detected at index %d", i)
             continue
 
         angle = cv2.minAreaRect(coords)[-1]
@@ -64,7 +68,7 @@ def fix_skew_on_images(images):
 
         fixed_images.append(result_image)
 
-    print(f"✅ Fixed skew on {len(fixed_images)} images.")
+    logger.debug("Fixed skew on %d images.", len(fixed_images))
     return fixed_images
 
 
@@ -120,7 +124,7 @@ def save_images_to_pdf_object(images):
 
     # Handle case where no images are provided.
     if not images:
-        print("  -> Warning: No images provided to convert to PDF. Returning an empty buffer.")
+        logger.warning("No images provided to convert to PDF. Returning an empty buffer.")
         return pdf_buffer
 
     try:
@@ -132,14 +136,14 @@ def save_images_to_pdf_object(images):
         #   as new pages to the PDF document.
         images[0].save(pdf_buffer, format='PDF', save_all=True, append_images=images[1:])
     except Exception as e:
-        print(f"  -> Error converting images to PDF: {e}")
-        raise # Re-raise the exception after printing for visibility.
+        logger.error("Error converting images to PDF: %s", e)
+        raise # Re-raise the exception after logging for visibility.
 
     # Rewind the buffer's pointer to the beginning. This is essential so that
     # any subsequent read operations (like by PyPDF2 or for saving to file)
     # can access the entire PDF content from the start.
     pdf_buffer.seek(0)
-    print(f"  -> Saved {len(images)} images to a new PDF BytesIO object.")
+    logger.debug("Saved %d images to a new PDF BytesIO object.", len(images))
     return pdf_buffer
 
 
@@ -153,7 +157,7 @@ def enhancement_logic(pdf_object_bytesio):
     Returns:
         io.BytesIO: A new BytesIO object containing the enhanced (deskewed) PDF data.
     """
-    print("\n--- Starting enhancement logic ---")
+    logger.debug("Starting enhancement logic")
     # Convert PDF to images. This function handles seeking the input pdf_object_bytesio.
     images = convert_pdf_to_images(pdf_object_bytesio)
 
@@ -164,5 +168,5 @@ def enhancement_logic(pdf_object_bytesio):
     # It's important to understand this function returns a completely new BytesIO object,
     # leaving the original input pdf_object_bytesio as it was (though its pointer might be at end).
     enhanced_pdf_object = create_pdf_from_images(fixed_images)
-    print("--- Enhancement logic completed ---")
+    logger.debug("Enhancement logic completed")
     return enhanced_pdf_object
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Streaming CSV and Excel export of stored statements.
+
+Rows are read one stored chunk at a time and verified on the fly with
+RunningBalanceCheck, so memory use does not grow with the statement.
+"""
+import csv
+import re
+import tempfile
+
+from . import statement_store
+from .transaction_table import NO_BALANCE, from_cents
+from .transaction_verifier import RunningBalanceCheck
+
+COLUMNS = ['#', 'Date', 'Details', 'Credit (Cr)', 'Debit (Dr)', 'Balance', 'Mismatch']
+ACCOUNT_FIELDS = [
+    ('bank_name', 'Bank Name'),
+    ('branch_code', 'Branch Code'),
+    ('branch_address', 'Address'),
+    ('holder_name', 'Holder Name'),
+    ('account_number', 'Account Number'),
+    ('period', 'Statement Period'),
+    ('final_balance', 'Final Balance'),
+]
+XLSX_BLOCK_SIZE = 64 * 1024
+
+
+def iter_export_rows(statement):
+    """
+    Yields one list of cell values per transaction, in COLUMNS order.
+    """
+    check = RunningBalanceCheck()
+    for first_row, table in statement_store.iter_chunks(statement):
+        for offset in range(len(table)):
+            amount = table.amounts[offset]
+            balance = table.balances[offset]
+            is_mismatch = check.feed(amount, balance)[0] or table.unreadable(offset)
+            yield [
+                first_row + offset + 1,
+                table.date_string(offset),
+                table.strings[table.details[offset]],
+                from_cents(amount) if amount >= 0 else None,
+                from_cents(amount) if amount < 0 else None,
+                None if balance == NO_BALANCE else from_cents(balance),
+                'YES' if is_mismatch else '',
+            ]
+
+
+class _Echo:
+    """File-like object whose write() hands the value back, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(statement):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for row in iter_export_rows(statement):
+        yield writer.writerow(['' if value is None else value for value in row])
+
+
+def iter_batch_csv(named_statements):
+    """
+    One CSV for several statements, [(filename, statement)], with a leading
+    File column.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['File'] + COLUMNS)
+    for filename, statement in named_statements:
+        for row in iter_export_rows(statement):
+            yield writer.writerow([filename] + ['' if value is None else value for value in row])
+
+
+def iter_xlsx(statement):
+    """
+    Builds the workbook in openpyxl write-only mode, which spills rows to a
+    temporary file instead of keeping cells in memory, then yields the file.
+
+    An .xlsx is a zip whose directory is written last, so unlike the CSV its
+    bytes can only be sent once the workbook has been saved.
+    """
+    from openpyxl import Workbook  # imported here to keep it out of worker startup
+
+    workbook = Workbook(write_only=True)
+
+    account_sheet = workbook.create_sheet('Account')
+    for field, label in ACCOUNT_FIELDS:
+        account_sheet.append([label, statement.account_info.get(field)])
+    account_sheet.append(['Transactions', statement.row_count])
+
+    transactions_sheet = workbook.create_sheet('Transactions')
+    transactions_sheet.append(COLUMNS)
+    for row in iter_export_rows(statement):
+        transactions_sheet.append(row)
+
+    with tempfile.TemporaryFile(suffix='.xlsx') as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            block = output.read(XLSX_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+
+def export_filename(statement, extension):
+    base = (statement.filename or 'statement').rsplit('.', 1)[0]
+    base = re.sub(r'[^A-Za-z0-9_.-]+', '_', base) or 'statement'
+    return f"{base}_transactions.{extension}"
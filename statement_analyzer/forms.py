@@ -1,4 +1,28 @@
 from django import forms
 
 class UploadFileForm(forms.Form):
-    file = forms.FileField()
\ No newline at end of file
+    file = forms.FileField()
+
+
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """
+    A FileField that accepts several files; cleans to a list.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("widget", MultipleFileInput(attrs={"accept": ".pdf,.zip"}))
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(d, initial) for d in data]
+        return [single_file_clean(data, initial)]
+
+
+class BatchUploadForm(forms.Form):
+    files = MultipleFileField(label="PDF statements or a ZIP archive")
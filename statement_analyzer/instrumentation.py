@@ -0,0 +1,353 @@
+"""
+Per-stage timing, memory and LLM usage metrics.
+
+Wrap a pipeline stage in ``span``:
+
+    with span('text_extraction') as s:
+        text = ...
+        s.add(pages=len(pdf.pages), bytes=len(file_bytes))
+
+Every span is observed in the ``statement_stage_seconds`` histogram and its
+counts (pages, bytes, tokens, ...) go to ``statement_stage_<name>_total``.
+Spans opened while a request is handled are also collected by
+RequestTimingMiddleware, which logs a per-stage breakdown for slow requests.
+The metrics view renders everything in the Prometheus text format.
+
+Metrics are kept per process; with several gunicorn workers each one is
+scraped (or summed) separately.
+"""
+import contextvars
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_PROCESS_START = time.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, (('le', bound),))
+                lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def set_max(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = max(value, self._values.get(key, value))
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def render(self):
+        _update_process_metrics()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'statement_stage_seconds', 'Time spent in one pipeline stage.', ('stage', 'outcome'))
+STAGE_PEAK_MEMORY = REGISTRY.gauge(
+    'statement_stage_peak_memory_bytes', 'Largest Python heap growth seen during one stage (TRACE_STAGE_MEMORY).',
+    ('stage',))
+LLM_REQUESTS = REGISTRY.counter(
+    'llm_requests_total', 'LLM calls by provider, model and outcome.', ('provider', 'model', 'outcome'))
+LLM_TOKENS = REGISTRY.counter(
+    'llm_tokens_total', 'LLM tokens by provider, model and kind (prompt/completion).', ('provider', 'model', 'kind'))
+LLM_RETRIES = REGISTRY.counter(
+    'llm_retries_total', 'LLM calls retried after a 429/5xx/timeout, by provider and status.', ('provider', 'status'))
+LLM_RATE_LIMIT_WAIT = REGISTRY.histogram(
+    'llm_rate_limit_wait_seconds', 'Time spent waiting for the shared LLM rate limit.', ('provider',))
+LLM_HEDGES = REGISTRY.counter(
+    'llm_hedged_requests_total', 'Hedged duplicate LLM requests sent, and how many answered first.',
+    ('provider', 'outcome'))
+LLM_PARSE_OUTCOMES = REGISTRY.counter(
+    'llm_parse_outcomes_total',
+    'Statement answers parsed complete, completed by re-requesting a cut-off tail, kept partial, or unusable.',
+    ('outcome',))
+LLM_ROUTE_DECISIONS = REGISTRY.counter(
+    'llm_route_decisions_total', 'Statements sent to each extraction route, by reason (best/explore/race/failover).',
+    ('route', 'reason'))
+PIPELINE_PATH_DECISIONS = REGISTRY.counter(
+    'pipeline_path_decisions_total', 'Extraction paths tried, by reason (prior/model/explore/fallback).',
+    ('path', 'reason'))
+REPAIR_PAGES = REGISTRY.counter(
+    'statement_repair_pages_total', 'Pages re-extracted to fix balance mismatches, by outcome (fixed/unchanged/failed).',
+    ('outcome',))
+OCR_TABLE_REGIONS = REGISTRY.counter(
+    'ocr_table_region_pages_total',
+    'Scanned pages OCRed in a cached table region (hit), or detected whole: no region yet (miss) or the '
+    'table did not fit it (stale).', ('result',))
+CPU_SLOTS_IN_USE = REGISTRY.gauge(
+    'cpu_task_slots_in_use', 'CPU-heavy tasks running in this process (see CPU_THREADS).')
+CPU_SLOT_WAIT = REGISTRY.histogram('cpu_slot_wait_seconds', 'Time tasks waited for a CPU slot.')
+CPU_SLOT_REJECTIONS = REGISTRY.counter(
+    'cpu_slot_rejections_total', 'Uploads turned away after waiting CPU_QUEUE_TIMEOUT for a CPU slot.')
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'Request latency by view and status class.', ('view', 'status'), REQUEST_BUCKETS)
+SLOW_REQUESTS = REGISTRY.counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', ('view',))
+PROCESS_RSS = REGISTRY.gauge('process_resident_memory_bytes', 'Resident memory of this process.')
+PROCESS_PEAK_RSS = REGISTRY.gauge('process_peak_resident_memory_bytes', 'Peak resident memory of this process.')
+PROCESS_UPTIME = REGISTRY.gauge('process_uptime_seconds', 'Seconds since this process imported the app.')
+_stage_counters = {}
+_stage_counters_lock = threading.Lock()
+
+
+def _stage_counter(name):
+    with _stage_counters_lock:
+        counter = _stage_counters.get(name)
+        if counter is None:
+            counter = REGISTRY.counter(f'statement_stage_{name}_total', f'Sum of {name} recorded by stage.', ('stage',))
+            _stage_counters[name] = counter
+        return counter
+
+
+def _update_process_metrics():
+    # The RSS gauges need POSIX; elsewhere only uptime is reported.
+    if resource is not None:
+        try:
+            with open('/proc/self/statm') as f:
+                PROCESS_RSS.set(int(f.read().split()[1]) * resource.getpagesize())
+        except OSError:
+            pass
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        PROCESS_PEAK_RSS.set(peak if sys.platform == 'darwin' else peak * 1024)
+    PROCESS_UPTIME.set(round(time.time() - _PROCESS_START, 3))
+
+
+# --- Spans ---
+_current_trace = contextvars.ContextVar('statement_trace', default=None)
+_span_stack = threading.local()
+
+
+class Span:
+    __slots__ = ('stage', 'counts', 'duration', 'peak_memory', 'outcome', '_start', '_memory_start', '_child_peak')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.counts = {}
+        self.duration = 0.0
+        self.peak_memory = None
+        self.outcome = 'ok'
+
+    def add(self, **counts):
+        """Adds to the span's counters, e.g. s.add(pages=3, bytes=12000)."""
+        for name, value in counts.items():
+            if value:
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self):
+        data = {'stage': self.stage, 'ms': round(self.duration * 1000, 1), **self.counts}
+        if self.peak_memory is not None:
+            data['peak_memory'] = self.peak_memory
+        if self.outcome != 'ok':
+            data['outcome'] = self.outcome
+        return data
+
+
+def _trace_memory():
+    return getattr(settings, 'TRACE_STAGE_MEMORY', False)
+
+
+def _memory_enter(s):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stack = getattr(_span_stack, 'spans', None)
+    if stack is None:
+        stack = _span_stack.spans = []
+    current, peak = tracemalloc.get_traced_memory()
+    # The peak is about to be reset; keep what the enclosing spans have seen so far.
+    for outer in stack:
+        outer._child_peak = max(outer._child_peak, peak)
+    tracemalloc.reset_peak()
+    s._memory_start = current
+    s._child_peak = 0
+    stack.append(s)
+
+
+def _memory_exit(s):
+    stack = _span_stack.spans
+    _, peak = tracemalloc.get_traced_memory()
+    peak = max(peak, s._child_peak)
+    s.peak_memory = max(0, peak - s._memory_start)
+    stack.remove(s)
+    for outer in stack:
+        outer._child_peak = max(outer._child_peak, peak)
+
+
+@contextmanager
+def span(stage, **counts):
+    """
+    Times a pipeline stage; see the module docstring. Exceptions propagate
+    and are recorded with outcome="error".
+    """
+    s = Span(stage)
+    s.add(**counts)
+    trace_memory = _trace_memory()
+    if trace_memory:
+        _memory_enter(s)
+    s._start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        s.outcome = 'error'
+        raise
+    finally:
+        s.duration = time.perf_counter() - s._start
+        if trace_memory:
+            _memory_exit(s)
+        _record_span(s)
+
+
+def _record_span(s):
+    STAGE_SECONDS.observe(s.duration, stage=s.stage, outcome=s.outcome)
+    for name, value in s.counts.items():
+        _stage_counter(name).inc(value, stage=s.stage)
+    if s.peak_memory is not None:
+        STAGE_PEAK_MEMORY.set_max(s.peak_memory, stage=s.stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append(s)
+    logger.debug("stage %s took %.1f ms %s", s.stage, s.duration * 1000, s.counts)
+
+
+def record_llm_call(provider, model, prompt_tokens=0, completion_tokens=0, outcome='ok'):
+    LLM_REQUESTS.inc(provider=provider, model=model or '', outcome=outcome)
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, provider=provider, model=model or '', kind='prompt')
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, provider=provider, model=model or '', kind='completion')
+
+
+def start_trace():
+    """Starts collecting spans for the current request; returns a token for end_trace."""
+    return _current_trace.set([])
+
+
+def end_trace(token):
+    spans = _current_trace.get() or []
+    _current_trace.reset(token)
+    return spans
+
+
+def render_metrics():
+    return REGISTRY.render()
@@ -0,0 +1,60 @@
+"""
+Deferred imports for the heavy PDF, OCR, imaging and spreadsheet libraries.
+
+    cv2 = lazy_import("cv2")
+
+binds a stand-in module object; the real import happens on the first
+attribute access (``cv2.cvtColor``). Web workers and management commands
+that never touch a PDF therefore never load OpenCV, PyMuPDF or pdfplumber.
+"""
+import importlib
+import sys
+import threading
+import types
+
+# Libraries that must not be imported when the app starts; see benchmarks/importtime.py.
+HEAVY_MODULES = (
+    "cv2", "numpy", "fitz", "pdfplumber", "pdf2image", "PyPDF2", "openpyxl",
+    "docling", "rapidocr", "openai", "google.generativeai", "tiktoken",
+)
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_lock"] = threading.Lock()
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with self.__dict__["_lazy_lock"]:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy_import(name):
+    """
+    Returns the module if it is already imported, otherwise a LazyModule.
+    """
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def loaded_heavy_modules():
+    """
+    Names from HEAVY_MODULES that are currently imported.
+    """
+    return [name for name in HEAVY_MODULES if name in sys.modules]
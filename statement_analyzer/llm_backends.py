@@ -0,0 +1,387 @@
+"""
+Pluggable backends for the LLM calls made by BankStatementParser.
+
+    live     - OpenAI and Gemini over the network (the default)
+    cassette - record/replay of responses keyed by a hash of the prompt
+    standin  - every model, Gemini included, sent to a local chat-completions
+               server such as ``python manage.py llm_standin``
+
+The backend is picked with the LLM_BACKEND setting; see get_llm_backend().
+"""
+import hashlib
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from django.conf import settings
+
+
+@dataclass
+class LLMResponse:
+    text: str
+    model: str
+    provider: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # 'stop', or 'length' when the answer was cut off at max_tokens
+    finish_reason: Optional[str] = None
+
+
+class CassetteMissError(LookupError):
+    """Raised in replay mode when no recording exists for a prompt."""
+
+
+class LLMUnavailableError(RuntimeError):
+    """Raised when a provider stays rate limited or failing after every retry (see rate_limit.py)."""
+
+
+def prompt_key(model, messages, max_tokens=None, temperature=None):
+    """
+    Stable hash identifying a request, shared by the cassette store and the stand-in server.
+    """
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'max_tokens': max_tokens, 'temperature': temperature},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _gemini_finish_reason(response):
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError):
+        return None
+    name = getattr(reason, 'name', str(reason))
+    return 'length' if name == 'MAX_TOKENS' else name.lower()
+
+
+def is_gemini_model(model):
+    return bool(model) and model.startswith('gemini')
+
+
+def messages_to_text(messages):
+    """
+    Flattens chat messages into one prompt, keeping only the text parts.
+    """
+    parts = []
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part['text'] for part in content if part.get('type') == 'text')
+    return '\n\n'.join(parts)
+
+
+class LLMBackend:
+    """
+    Interface: one chat completion in, one LLMResponse out.
+    """
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        """
+        ``response_format`` is an OpenAI response_format (see schemas.py);
+        backends that cannot enforce it ask for plain JSON or ignore it.
+        """
+        raise NotImplementedError
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        """
+        Yields the answer as LLMResponse pieces: text deltas, with usage and
+        finish_reason on the last ones (see join_pieces). Backends that cannot
+        stream yield the whole answer as one piece.
+        """
+        yield self.complete(model, messages, max_tokens, temperature, response_format)
+
+
+def join_pieces(pieces):
+    """
+    One LLMResponse from the pieces of a streamed answer.
+    """
+    first = pieces[0]
+    return LLMResponse(
+        text=''.join(piece.text for piece in pieces),
+        model=first.model,
+        provider=first.provider,
+        prompt_tokens=max(piece.prompt_tokens for piece in pieces),
+        completion_tokens=max(piece.completion_tokens for piece in pieces),
+        finish_reason=next((piece.finish_reason for piece in reversed(pieces) if piece.finish_reason), None),
+    )
+
+
+class LiveBackend(LLMBackend):
+    """
+    Calls OpenAI for GPT models and Gemini for gemini-* models.
+    Clients are created on first use, not at import.
+    """
+
+    def __init__(self, openai_api_key=None, gemini_api_key=None, openai_base_url=None, max_retries=2):
+        self.openai_api_key = openai_api_key
+        self.gemini_api_key = gemini_api_key
+        self.openai_base_url = openai_base_url
+        self.max_retries = max_retries
+        self._openai_client = None
+        self._gemini_configured = False
+        self._lock = threading.Lock()
+
+    def _openai(self):
+        if self._openai_client is None:
+            with self._lock:
+                if self._openai_client is None:
+                    from openai import OpenAI
+
+                    self._openai_client = OpenAI(
+                        api_key=self.openai_api_key, base_url=self.openai_base_url, max_retries=self.max_retries,
+                    )
+        return self._openai_client
+
+    def _openai_kwargs(self, model, messages, max_tokens, temperature, response_format):
+        kwargs = {'model': model, 'messages': messages}
+        if max_tokens is not None:
+            kwargs['max_tokens'] = max_tokens
+        if temperature is not None:
+            kwargs['temperature'] = temperature
+        if response_format is not None:
+            kwargs['response_format'] = response_format
+        return kwargs
+
+    def _complete_openai(self, model, messages, max_tokens, temperature, response_format):
+        kwargs = self._openai_kwargs(model, messages, max_tokens, temperature, response_format)
+        response = self._openai().chat.completions.create(**kwargs)
+        usage = getattr(response, 'usage', None)
+        return LLMResponse(
+            text=response.choices[0].message.content or '',
+            model=model,
+            provider='openai',
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+            finish_reason=response.choices[0].finish_reason,
+        )
+
+    def _stream_openai(self, model, messages, max_tokens, temperature, response_format, provider='openai'):
+        kwargs = self._openai_kwargs(model, messages, max_tokens, temperature, response_format)
+        chunks = self._openai().chat.completions.create(**kwargs, stream=True, stream_options={'include_usage': True})
+        for chunk in chunks:
+            choice = chunk.choices[0] if chunk.choices else None
+            usage = getattr(chunk, 'usage', None)
+            yield LLMResponse(
+                text=(choice.delta.content or '') if choice else '',
+                model=model,
+                provider=provider,
+                prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                finish_reason=choice.finish_reason if choice else None,
+            )
+
+    def _gemini_model(self, model):
+        import google.generativeai as genai
+
+        if not self._gemini_configured:
+            genai.configure(api_key=self.gemini_api_key)
+            self._gemini_configured = True
+        return genai.GenerativeModel(model_name=model)
+
+    def _gemini_config(self, max_tokens, temperature, response_format):
+        generation_config = {}
+        if max_tokens is not None:
+            generation_config['max_output_tokens'] = max_tokens
+        if temperature is not None:
+            generation_config['temperature'] = temperature
+        if response_format is not None:
+            # Gemini's response_schema takes a narrower dialect than JSON Schema; JSON mode is enough here.
+            generation_config['response_mime_type'] = 'application/json'
+        return generation_config or None
+
+    def _complete_gemini(self, model, messages, max_tokens, temperature, response_format):
+        response = self._gemini_model(model).generate_content(
+            messages_to_text(messages), generation_config=self._gemini_config(max_tokens, temperature, response_format),
+        )
+        usage = getattr(response, 'usage_metadata', None)
+        return LLMResponse(
+            text=response.text,
+            model=model,
+            provider='gemini',
+            prompt_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+            completion_tokens=getattr(usage, 'candidates_token_count', 0) or 0,
+            finish_reason=_gemini_finish_reason(response),
+        )
+
+    def _stream_gemini(self, model, messages, max_tokens, temperature, response_format):
+        chunks = self._gemini_model(model).generate_content(
+            messages_to_text(messages), generation_config=self._gemini_config(max_tokens, temperature, response_format),
+            stream=True,
+        )
+        for chunk in chunks:
+            try:
+                text = chunk.text
+            except ValueError:
+                # A chunk without text parts (e.g. only the finish reason).
+                text = ''
+            usage = getattr(chunk, 'usage_metadata', None)
+            yield LLMResponse(
+                text=text,
+                model=model,
+                provider='gemini',
+                prompt_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+                completion_tokens=getattr(usage, 'candidates_token_count', 0) or 0,
+                finish_reason=_gemini_finish_reason(chunk),
+            )
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        if is_gemini_model(model):
+            return self._complete_gemini(model, messages, max_tokens, temperature, response_format)
+        return self._complete_openai(model, messages, max_tokens, temperature, response_format)
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        if is_gemini_model(model):
+            return self._stream_gemini(model, messages, max_tokens, temperature, response_format)
+        return self._stream_openai(model, messages, max_tokens, temperature, response_format)
+
+
+class StandInBackend(LiveBackend):
+    """
+    Sends every model, Gemini included, to an OpenAI-compatible local server.
+    """
+
+    def __init__(self, base_url, max_retries=2):
+        super().__init__(openai_api_key='stand-in', openai_base_url=base_url, max_retries=max_retries)
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        response = self._complete_openai(model, messages, max_tokens, temperature, response_format)
+        response.provider = 'gemini' if is_gemini_model(model) else 'openai'
+        return response
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        provider = 'gemini' if is_gemini_model(model) else 'openai'
+        return self._stream_openai(model, messages, max_tokens, temperature, response_format, provider=provider)
+
+
+class CassetteBackend(LLMBackend):
+    """
+    Record/replay store of responses, one JSON file per prompt hash.
+
+    mode 'replay' never touches the network and raises CassetteMissError for
+    unknown prompts; 'record' always calls ``inner`` and (re)writes the file;
+    'once' replays when a recording exists and records otherwise.
+    """
+
+    MODES = ('replay', 'record', 'once')
+
+    def __init__(self, directory, inner=None, mode='replay'):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}; expected one of {self.MODES}.")
+        if mode != 'replay' and inner is None:
+            raise ValueError("Recording needs an inner backend.")
+        self.directory = directory
+        self.inner = inner
+        self.mode = mode
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def load(self, key):
+        try:
+            with open(self.path_for(key), encoding='utf-8') as f:
+                return LLMResponse(**json.load(f)['response'])
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, model, response):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'model': model, 'response': asdict(response)}, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, path)
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        # response_format is not part of the key: it shapes the answer, not the question.
+        key = prompt_key(model, messages, max_tokens, temperature)
+        if self.mode != 'record':
+            recorded = self.load(key)
+            if recorded is not None:
+                return recorded
+            if self.mode == 'replay':
+                raise CassetteMissError(f"No recording for prompt {key[:12]} ({model}) in {self.directory}.")
+        response = self.inner.complete(model, messages, max_tokens, temperature, response_format)
+        self.save(key, model, response)
+        return response
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        """
+        Replays a recording as a single piece; records the joined pieces of a live stream.
+        """
+        key = prompt_key(model, messages, max_tokens, temperature)
+        if self.mode != 'record':
+            recorded = self.load(key)
+            if recorded is not None:
+                yield recorded
+                return
+            if self.mode == 'replay':
+                raise CassetteMissError(f"No recording for prompt {key[:12]} ({model}) in {self.directory}.")
+        pieces = []
+        for piece in self.inner.stream(model, messages, max_tokens, temperature, response_format):
+            pieces.append(piece)
+            yield piece
+        if pieces:
+            self.save(key, model, join_pieces(pieces))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def build_llm_backend(name=None):
+    """
+    Builds the backend named by ``name`` (default: the LLM_BACKEND setting).
+    Network backends are wrapped in rate_limit.ResilientBackend unless
+    LLM_RATE_LIMIT_ENABLED is off; the OpenAI client's own retries are then
+    turned off so attempts do not multiply.
+    """
+    from .config import get_config
+
+    name = name or getattr(settings, 'LLM_BACKEND', 'live')
+    resilient = getattr(settings, 'LLM_RATE_LIMIT_ENABLED', False)
+    client_retries = 0 if resilient else 2
+
+    def wrap(backend):
+        if not resilient:
+            return backend
+        from .rate_limit import ResilientBackend
+
+        return ResilientBackend.from_settings(backend)
+
+    if name == 'standin':
+        return wrap(StandInBackend(settings.LLM_STANDIN_URL, max_retries=client_retries))
+    config = get_config()
+    live = wrap(LiveBackend(
+        openai_api_key=config.openai_api_key, gemini_api_key=config.gemini_key, max_retries=client_retries,
+    ))
+    if name == 'live':
+        return live
+    if name == 'cassette':
+        return CassetteBackend(settings.LLM_CASSETTE_DIR, inner=live, mode=settings.LLM_CASSETTE_MODE)
+    raise ValueError(f"Unknown LLM_BACKEND {name!r}; expected 'live', 'cassette' or 'standin'.")
+
+
+def get_llm_backend():
+    """
+    Returns the process-wide backend, building it on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_llm_backend()
+    return _backend
+
+
+def set_llm_backend(backend):
+    """
+    Replaces the process-wide backend (tests, benchmarks). None rebuilds from settings.
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,207 @@
+"""
+Tolerant parsing of JSON written by an LLM.
+
+Answers arrive wrapped in markdown fences, followed by chatter, with Python
+quoting, or cut off when the completion hits max_tokens. loads_lenient
+copes with all of these. StatementStreamParser reads a statement answer
+incrementally and hands out account_info and each transaction as soon as
+its closing brace arrives. A truncated answer therefore still yields every
+complete row, and only the rest has to be asked for again.
+"""
+import ast
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+_FENCE = re.compile(r'^\s*```[a-zA-Z]*\s*|\s*```\s*$')
+
+
+def strip_code_fences(text):
+    return _FENCE.sub('', text or '')
+
+
+def close_truncated(text):
+    """
+    ``text`` cut back to its last complete object or array, with the
+    brackets still open at that point closed. Returns None if nothing
+    complete was found.
+    """
+    stack = []
+    in_string = escape = False
+    cut = None
+    for i, c in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+        elif c in '}]':
+            if not stack:
+                break
+            stack.pop()
+            cut = (i + 1, ''.join(reversed(stack)))
+            if not stack:
+                break
+    if cut is None:
+        return None
+    end, closers = cut
+    return text[:end] + closers
+
+
+def loads_lenient(text):
+    """
+    The first JSON object or array in an LLM answer, or None.
+    """
+    text = strip_code_fences(text)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        return None
+    start = min(starts)
+    try:
+        return json.JSONDecoder().raw_decode(text, start)[0]
+    except ValueError:
+        pass
+    repaired = close_truncated(text[start:])
+    if repaired:
+        try:
+            value = json.loads(repaired)
+            logger.warning("Recovered truncated JSON: kept %d of %d characters", len(repaired), len(text) - start)
+            return value
+        except ValueError:
+            pass
+    try:
+        # Some answers use Python literals: single quotes, True/None.
+        return ast.literal_eval(text[start:])
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+class StatementStreamParser:
+    """
+    Incremental parser for {"account_info": {...}, "transactions": [{...}, ...]}.
+
+        parser = StatementStreamParser()
+        for chunk in chunks:
+            for kind, value in parser.feed(chunk):   # 'account_info' or 'transaction'
+                ...
+        parser.complete   # False if the answer was cut off
+
+    Only complete objects are parsed, each with json.loads, so a malformed
+    row is skipped (and counted) without losing the rows around it.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.account_info = None
+        self.transactions = []
+        self.skipped = 0
+        self.started = False
+        self.complete = False
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key = None
+        self._value_start = None
+        self._value_depth = None
+
+    def feed(self, chunk):
+        """
+        Adds the next piece of the answer; returns the (kind, value) pairs it completed.
+        """
+        self.text += chunk
+        text = self.text
+        stack = self._stack
+        events = []
+        i = self._pos
+        while i < len(text) and not self.complete:
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._expect_key and len(stack) == 1:
+                        try:
+                            self._key = json.loads(text[self._string_start:i + 1])
+                        except ValueError:
+                            self._key = None
+                        self._expect_key = False
+            elif not self.started:
+                if c == '{':
+                    self.started = True
+                    self._expect_key = True
+                    stack.append(c)
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in '{[':
+                depth = len(stack)
+                if c == '{' and self._value_start is None and (
+                    (depth == 1 and self._key == 'account_info')
+                    or (depth == 2 and stack[-1] == '[' and self._key == 'transactions')
+                ):
+                    self._value_start = i
+                    self._value_depth = depth
+                stack.append(c)
+            elif c in '}]':
+                if stack:
+                    stack.pop()
+                if self._value_start is not None and len(stack) == self._value_depth:
+                    event = self._emit(text[self._value_start:i + 1])
+                    if event:
+                        events.append(event)
+                    self._value_start = None
+                if not stack:
+                    self.complete = True
+            elif c == ',' and len(stack) == 1:
+                self._expect_key = True
+            i += 1
+        self._pos = i
+        return events
+
+    def _emit(self, fragment):
+        try:
+            value = json.loads(fragment)
+        except ValueError:
+            self.skipped += 1
+            logger.warning("Skipping a malformed %s in the LLM answer", self._key)
+            return None
+        if self._key == 'account_info':
+            self.account_info = value
+            return 'account_info', value
+        self.transactions.append(value)
+        return 'transaction', value
+
+    def result(self):
+        return {'account_info': self.account_info or {}, 'transactions': self.transactions}
+
+
+def parse_statement(text):
+    """
+    (data, complete) for a statement answer. ``data`` is None when nothing
+    usable was found; ``complete`` is False when it was cut off, in which case
+    ``data`` holds the rows before the cut.
+    """
+    parser = StatementStreamParser()
+    parser.feed(strip_code_fences(text))
+    if parser.complete:
+        data = loads_lenient(text)
+        if isinstance(data, dict):
+            return data, True
+    if parser.account_info is not None or parser.transactions:
+        return parser.result(), parser.complete
+    data = loads_lenient(text)
+    return (data, True) if isinstance(data, dict) else (None, False)
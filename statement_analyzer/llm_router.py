@@ -0,0 +1,401 @@
+"""
+Latency-aware routing of statement extraction between OpenAI and Gemini.
+
+Each route is one BankStatementParser method on one provider. The router
+keeps rolling statistics per route (latency, error rate, cost) and sends
+each statement to the route with the best score:
+
+    score = p95 latency * (1 + 4 * error rate) + LLM_ROUTER_COST_WEIGHT * mean cost
+
+A route that keeps failing is taken out of rotation for
+LLM_ROUTER_COOLDOWN_S, and a failed or empty extraction falls over to the
+next route. A small share of requests (LLM_ROUTER_EXPLORE) goes to a random
+healthy route so the statistics of the others stay fresh. Statements of at
+most LLM_RACE_MAX_CHARS characters are sent to the two best routes at once
+and the first usable answer wins.
+
+Routing is opt-in (LLM_ROUTING=auto); by default every statement goes to
+OpenAI. Statistics are per process.
+"""
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .data_extractor import BankStatementParser
+from .instrumentation import LLM_ROUTE_DECISIONS
+from .llm_backends import LLMBackend, LLMUnavailableError, get_llm_backend
+
+logger = logging.getLogger(__name__)
+
+# USD per million (prompt, completion) tokens, from the providers' public price lists.
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gemini-1.5-flash': (0.075, 0.30),
+    'gemini-1.5-pro': (1.25, 5.00),
+}
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class CostMeter:
+    def __init__(self):
+        self.cost = 0.0
+
+
+_cost_meter = contextvars.ContextVar('llm_cost_meter', default=None)
+
+
+@contextlib.contextmanager
+def track_cost():
+    """
+    Adds up the cost of the metered LLM calls made inside the block, in this
+    thread (routed extractions and metered_parser()).
+
+        with track_cost() as meter:
+            ...
+        meter.cost
+    """
+    meter = CostMeter()
+    token = _cost_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _cost_meter.reset(token)
+
+
+class _MeteredBackend(LLMBackend):
+    """
+    Passes calls through and adds up their cost, for one routed extraction.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.cost = 0.0
+
+    def _add(self, response):
+        cost = call_cost(response.model, response.prompt_tokens, response.completion_tokens)
+        self.cost += cost
+        meter = _cost_meter.get()
+        if meter is not None:
+            meter.cost += cost
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        response = self.inner.complete(model, messages, max_tokens, temperature, response_format)
+        self._add(response)
+        return response
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        last = None
+        for piece in self.inner.stream(model, messages, max_tokens, temperature, response_format):
+            last = piece
+            yield piece
+        if last is not None:
+            self._add(last)
+
+
+class RouteStats:
+    """
+    Outcome, latency and cost of a route's recent calls.
+    """
+
+    def __init__(self, window=50, max_age=600):
+        self.max_age = max_age
+        self._calls = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._last_failure = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, ok, seconds, cost=0.0):
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, ok, seconds, cost))
+            if ok:
+                self._consecutive_failures = 0
+            else:
+                self._consecutive_failures += 1
+                self._last_failure = now
+
+    def snapshot(self):
+        cutoff = time.monotonic() - self.max_age
+        with self._lock:
+            calls = [call for call in self._calls if call[0] >= cutoff]
+            consecutive_failures = self._consecutive_failures
+            last_failure = self._last_failure
+        latencies = sorted(seconds for _, ok, seconds, _ in calls if ok)
+        costs = [cost for _, ok, _, cost in calls if ok]
+        return {
+            'calls': len(calls),
+            'error_rate': sum(1 for _, ok, _, _ in calls if not ok) / len(calls) if calls else 0.0,
+            'p50': latencies[len(latencies) // 2] if latencies else None,
+            'p95': latencies[max(0, -(-len(latencies) * 95 // 100) - 1)] if latencies else None,
+            'mean_cost': sum(costs) / len(costs) if costs else None,
+            'consecutive_failures': consecutive_failures,
+            'seconds_since_failure': time.monotonic() - last_failure if last_failure else None,
+        }
+
+
+class Route:
+    def __init__(self, name, provider, extract, stream=None):
+        self.name = name
+        self.provider = provider
+        self.extract = extract
+        self.stream = stream or ROUTE_STREAMS[provider]
+        self.stats = RouteStats()
+
+
+def _extract_openai(parser, text):
+    return parser.extract__from_text_transactions_gpt(text)
+
+
+def _extract_gemini(parser, text):
+    return parser.extract_transactions_gemini(text)
+
+
+ROUTE_EXTRACTORS = {
+    'openai': _extract_openai,
+    'gemini': _extract_gemini,
+}
+
+ROUTE_STREAMS = {
+    'openai': lambda parser, text: parser.stream_transactions_gpt(text),
+    'gemini': lambda parser, text: parser.stream_transactions_gemini(text),
+}
+
+
+class Router:
+    def __init__(self, routes, backend=None, cost_weight=20.0, cooldown=30.0, explore=0.05,
+                 race_max_chars=0, min_samples=3, rng=None):
+        self.routes = routes
+        self.backend = backend
+        self.cost_weight = cost_weight
+        self.cooldown = cooldown
+        self.explore = explore
+        self.race_max_chars = race_max_chars
+        self.min_samples = min_samples
+        self.random = rng or random.Random()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def healthy(self, route):
+        stats = route.stats.snapshot()
+        failing = stats['consecutive_failures'] >= 3 or (stats['calls'] >= 4 and stats['error_rate'] >= 0.5)
+        return not failing or stats['seconds_since_failure'] is None or stats['seconds_since_failure'] >= self.cooldown
+
+    def score(self, route):
+        """
+        Lower is better; None until the route has min_samples successful calls.
+        """
+        stats = route.stats.snapshot()
+        if stats['p95'] is None or stats['calls'] < self.min_samples:
+            return None
+        return stats['p95'] * (1 + 4 * stats['error_rate']) + self.cost_weight * (stats['mean_cost'] or 0.0)
+
+    def ranked(self):
+        """
+        Routes in the order they should be tried: healthy before cooling down,
+        then by score. Routes without enough samples keep their configured
+        order behind the first configured route, so they are only tried
+        first through exploration or failover.
+        """
+        def key(indexed):
+            index, route = indexed
+            score = self.score(route)
+            if score is None:
+                score = 0.0 if index == 0 else float('inf')
+            return (not self.healthy(route), score, index)
+
+        return [route for _, route in sorted(enumerate(self.routes), key=key)]
+
+    def _run(self, route, text):
+        metered = _MeteredBackend(self.backend or get_llm_backend())
+        start = time.monotonic()
+        try:
+            result = route.extract(BankStatementParser(backend=metered), text)
+        except Exception:
+            route.stats.record(False, time.monotonic() - start)
+            raise
+        route.stats.record(bool(result), time.monotonic() - start, metered.cost)
+        return result
+
+    def extract(self, text):
+        """
+        {'account_info': ..., 'transactions': [...]} from the best route, or
+        None when every route returned nothing. Raises LLMUnavailableError if
+        every route was unavailable.
+        """
+        order = self.ranked()
+        reason = 'best'
+        healthy = [route for route in order if self.healthy(route)]
+        if len(healthy) > 1 and self.random.random() < self.explore:
+            pick = self.random.choice(healthy[1:])
+            order = [pick] + [route for route in order if route is not pick]
+            reason = 'explore'
+
+        if self.race_max_chars and len(text) <= self.race_max_chars and len(healthy) > 1:
+            result = self._race(healthy[:2], text)
+            if result:
+                return result
+            order = [route for route in order if route not in healthy[:2]]
+            reason = 'failover'
+
+        unavailable = None
+        for route in order:
+            LLM_ROUTE_DECISIONS.inc(route=route.name, reason=reason)
+            try:
+                result = self._run(route, text)
+            except LLMUnavailableError as e:
+                unavailable = e
+                result = None
+            if result:
+                return result
+            logger.warning("LLM route %s failed or returned no data; trying the next one", route.name)
+            reason = 'failover'
+        if unavailable is not None:
+            raise unavailable
+        return None
+
+    def stream(self, text):
+        """
+        extract with the answer streamed: yields the events of
+        BankStatementParser.stream_transactions_gpt from the best route. A
+        route is only fallen over from before it produced anything, so rows
+        are never sent twice. Exploration applies, racing does not.
+        """
+        order = self.ranked()
+        reason = 'best'
+        healthy = [route for route in order if self.healthy(route)]
+        if len(healthy) > 1 and self.random.random() < self.explore:
+            pick = self.random.choice(healthy[1:])
+            order = [pick] + [route for route in order if route is not pick]
+            reason = 'explore'
+
+        unavailable = None
+        for route in order:
+            LLM_ROUTE_DECISIONS.inc(route=route.name, reason=reason)
+            metered = _MeteredBackend(self.backend or get_llm_backend())
+            start = time.monotonic()
+            started = False
+            try:
+                for kind, value in route.stream(BankStatementParser(backend=metered), text):
+                    if kind == 'done':
+                        route.stats.record(bool(value), time.monotonic() - start, metered.cost)
+                        if value or started:
+                            yield kind, value
+                            return
+                        break
+                    started = True
+                    yield kind, value
+            except LLMUnavailableError as e:
+                route.stats.record(False, time.monotonic() - start)
+                if started:
+                    raise
+                unavailable = e
+            except Exception:
+                route.stats.record(False, time.monotonic() - start)
+                raise
+            logger.warning("LLM route %s failed or returned no data; trying the next one", route.name)
+            reason = 'failover'
+        if unavailable is not None:
+            raise unavailable
+        yield 'done', None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='llm-race')
+            return self._pool
+
+    def _race(self, routes, text):
+        pool = self._get_pool()
+        pending = set()
+        for route in routes:
+            LLM_ROUTE_DECISIONS.inc(route=route.name, reason='race')
+            # In a copy of this context, so the calls count towards the caller's track_cost().
+            pending.add(pool.submit(contextvars.copy_context().run, self._run, route, text))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("Raced LLM route failed: %s", e)
+                    continue
+                if result:
+                    # The slower call finishes in the background and still updates its stats.
+                    return result
+        return None
+
+    def describe(self):
+        return {
+            route.name: dict(route.stats.snapshot(), healthy=self.healthy(route), score=self.score(route))
+            for route in self.routes
+        }
+
+
+def available_routes(names):
+    """
+    Routes for the configured provider names, skipping Gemini without a key
+    when calls go to the real providers.
+    """
+    from .config import get_config
+
+    routes = []
+    for name in names:
+        if name not in ROUTE_EXTRACTORS:
+            raise ValueError(f"Unknown LLM route {name!r}; expected one of {', '.join(ROUTE_EXTRACTORS)}.")
+        if name == 'gemini' and settings.LLM_BACKEND == 'live' and not get_config().gemini_key:
+            continue
+        routes.append(Route(name, name, ROUTE_EXTRACTORS[name]))
+    return routes
+
+
+def metered_parser():
+    """
+    A BankStatementParser on the configured backend whose calls count
+    towards track_cost().
+    """
+    return BankStatementParser(backend=_MeteredBackend(get_llm_backend()))
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """
+    Returns the process-wide Router built from the LLM_ROUTES settings.
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router(
+                    available_routes(settings.LLM_ROUTES),
+                    cost_weight=settings.LLM_ROUTER_COST_WEIGHT,
+                    cooldown=settings.LLM_ROUTER_COOLDOWN_S,
+                    explore=settings.LLM_ROUTER_EXPLORE,
+                    race_max_chars=settings.LLM_RACE_MAX_CHARS,
+                )
+    return _router
+
+
+def set_router(router):
+    """
+    Replaces the process-wide router (tests, benchmarks). None rebuilds from settings.
+    """
+    global _router
+    with _router_lock:
+        _router = router
@@ -0,0 +1,204 @@
+"""
+A local stand-in for the OpenAI chat-completions API.
+
+It answers POST /v1/chat/completions (and /chat/completions) with recorded
+responses from a cassette directory when the prompt hash matches, or with a
+small canned statement otherwise, streamed in chunks when the request asks for
+stream=True. Latency, error rate and a requests-per-minute
+limit (answered with 429 and Retry-After) are configurable so load tests see
+realistic provider behaviour without network access.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .llm_backends import CassetteBackend, messages_to_text, prompt_key
+
+DEFAULT_EXTRACTION_RESPONSE = {
+    "account_info": {
+        "bank_name": "Stand-in Bank",
+        "branch_code": "null",
+        "branch_address": "null",
+        "holder_name": "MR STAND IN",
+        "account_number": "0000000000",
+        "period": "01-01-2025 - 31-01-2025",
+        "final_balance": 1400.0,
+    },
+    "transactions": [
+        {"id": 1, "details": "Opening balance", "date": "01-01-2025", "amount": 0.0, "balance": 1500.0},
+        {"id": 2, "details": "Instant payment fee", "date": "02-01-2025", "amount": -10.0, "balance": 1490.0},
+        {"id": 3, "details": "POS PURCHASE", "date": "03-01-2025", "amount": -90.0, "balance": 1400.0},
+    ],
+}
+
+
+class StandInConfig:
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, cassette_dir=None,
+                 extraction_response=None, fraud_response=None, seed=None, rpm_limit=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rpm_limit = rpm_limit
+        self.accepted = deque()
+        self.rate_limited = 0
+        self.cassettes = CassetteBackend(cassette_dir) if cassette_dir else None
+        self.extraction_response = extraction_response or json.dumps(DEFAULT_EXTRACTION_RESPONSE)
+        self.fraud_response = fraud_response or '[]'
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def over_rpm_limit(self, now):
+        """
+        Seconds until the next request fits a sliding one-minute window, or 0.
+        Call with the lock held.
+        """
+        if not self.rpm_limit:
+            return 0
+        while self.accepted and self.accepted[0] <= now - 60:
+            self.accepted.popleft()
+        if len(self.accepted) >= self.rpm_limit:
+            return self.accepted[0] + 60 - now
+        self.accepted.append(now)
+        return 0
+
+    def canned_text(self, body):
+        model = body.get('model', '')
+        messages = body.get('messages', [])
+        if self.cassettes:
+            key = prompt_key(model, messages, body.get('max_tokens'), body.get('temperature'))
+            recorded = self.cassettes.load(key)
+            if recorded is not None:
+                return recorded.text
+        prompt = messages_to_text(messages).lower()
+        if 'fraud' in prompt or 'tampering' in prompt:
+            return self.fraud_response
+        return self.extraction_response
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_version = 'LLMStandIn/1.0'
+    config = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, body, text, seconds, usage):
+        """
+        Answers a stream=True request the way the API does: chat.completion.chunk
+        events spread over ``seconds``, then [DONE].
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        base = {
+            'id': f'chatcmpl-standin-{uuid.uuid4().hex[:12]}',
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': body.get('model', 'standin'),
+        }
+
+        def send(choices, **extra):
+            chunk = dict(base, choices=choices, **extra)
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+
+        pieces = [text[i:i + 40] for i in range(0, len(text), 40)] or ['']
+        for piece in pieces:
+            time.sleep(seconds / len(pieces))
+            send([{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+        send([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            send([], usage=usage)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('/health', '/v1/models'):
+            self._send_json(200, {'status': 'ok', 'requests': self.config.requests,
+                                  'rate_limited': self.config.rate_limited})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON body'}})
+            return
+
+        config = self.config
+        with config.lock:
+            config.requests += 1
+            retry_after = config.over_rpm_limit(time.monotonic())
+            if retry_after:
+                config.rate_limited += 1
+        if retry_after:
+            self._send_json(429, {'error': {'message': 'Stand-in rate limit reached', 'type': 'rate_limit_error',
+                                            'code': 429}}, headers={'Retry-After': f'{retry_after:.2f}'})
+            return
+        with config.lock:
+            delay = max(0.0, config.latency_ms + config.random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000
+            fail = config.random.random() < config.error_rate
+            status = config.random.choice((429, 500, 503)) if fail else 200
+        streamed = bool(body.get('stream'))
+        # A streamed answer starts after a fifth of the latency and spreads the rest over its chunks.
+        time.sleep(delay / 5 if streamed else delay)
+
+        if fail:
+            self._send_json(status, {'error': {'message': 'Injected stand-in failure', 'type': 'standin_error',
+                                               'code': status}})
+            return
+
+        text = config.canned_text(body)
+        prompt_tokens = len(messages_to_text(body.get('messages', []))) // 4
+        completion_tokens = len(text) // 4
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+        if streamed:
+            self._send_stream(body, text, delay - delay / 5, usage)
+            return
+        self._send_json(200, {
+            'id': f'chatcmpl-standin-{uuid.uuid4().hex[:12]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'standin'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': text},
+                'finish_reason': 'stop',
+            }],
+            'usage': usage,
+        })
+
+
+def make_server(host='127.0.0.1', port=8765, config=None):
+    """
+    Returns a ThreadingHTTPServer; call serve_forever() (or run it in a thread).
+    """
+    handler = type('ConfiguredStandInHandler', (StandInHandler,), {'config': config or StandInConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from statement_analyzer.llm_standin import StandInConfig, make_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a local OpenAI-compatible chat-completions server for offline testing. "
+        "Point the app at it with LLM_BACKEND=standin and LLM_STANDIN_URL=http://HOST:PORT/v1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency-ms', type=float, default=0, help='mean response latency')
+        parser.add_argument('--jitter-ms', type=float, default=0, help='uniform +/- jitter around the latency')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered 429/5xx')
+        parser.add_argument('--rpm', type=int, default=0, help='requests per minute before answering 429 (0: no limit)')
+        parser.add_argument('--cassettes', help='cassette directory to replay recorded responses from')
+        parser.add_argument('--extraction-response', help='file with the canned extraction reply')
+        parser.add_argument('--fraud-response', help='file with the canned fraud-detection reply')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        def read(path):
+            if not path:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+
+        config = StandInConfig(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            error_rate=options['error_rate'],
+            cassette_dir=options['cassettes'],
+            extraction_response=read(options['extraction_response']),
+            fraud_response=read(options['fraud_response']),
+            seed=options['seed'],
+            rpm_limit=options['rpm'],
+        )
+        server = make_server(options['host'], options['port'], config)
+        self.stdout.write(f"LLM stand-in listening on http://{options['host']}:{options['port']}/v1")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
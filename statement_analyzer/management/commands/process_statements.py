@@ -0,0 +1,78 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import errors as pymongo_errors
+
+from statement_analyzer import cpu_budget
+from statement_analyzer.offline import Checkpoint, JsonlSink, MongoSink, ProcessingRun, iter_statement_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Extracts and verifies every PDF statement under a directory in a pool of worker processes. "
+        "Results go to a JSONL file (--output) or MongoDB (--mongo). Completed documents are checkpointed, "
+        "so an interrupted run resumes where it stopped when started again with the same arguments."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--output', help='append results to this JSONL file')
+        target.add_argument('--mongo', action='store_true', help='write results to MongoDB in bulk')
+        parser.add_argument('--checkpoint',
+                            help='checkpoint file (default: <output>.checkpoint, or '
+                                 '.process_statements.checkpoint in the directory with --mongo)')
+        parser.add_argument('--pattern', default='*.pdf', help='file name pattern (default: *.pdf)')
+        parser.add_argument('--workers', type=int,
+                            default=settings.EXTRACTION_WORKERS or cpu_budget.task_slots(processes=1))
+        parser.add_argument('--threads', action='store_true',
+                            help='use threads instead of processes (for debugging)')
+        parser.add_argument('--batch-size', type=int, default=50, help='results per write to the output')
+        parser.add_argument('--progress-every', type=float, default=10, help='seconds between progress lines')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory.")
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1.")
+
+        checkpoint_path = options['checkpoint'] or (
+            f"{options['output']}.checkpoint" if options['output']
+            else os.path.join(directory, '.process_statements.checkpoint')
+        )
+        # Listing is cheap next to processing; it gives the ETA a denominator.
+        paths = list(iter_statement_files(directory, options['pattern']))
+        checkpoint = Checkpoint(checkpoint_path)
+        sink = JsonlSink(options['output']) if options['output'] else MongoSink()
+        self.stdout.write(
+            f"{len(paths)} files under {directory}, {len(checkpoint)} already done according to {checkpoint_path}; "
+            f"{options['workers']} {'threads' if options['threads'] else 'processes'}, writing to {sink.path}"
+        )
+
+        run = ProcessingRun(
+            checkpoint, sink,
+            workers=options['workers'],
+            total=len(paths),
+            batch_size=options['batch_size'],
+            progress_seconds=options['progress_every'],
+            in_processes=not options['threads'],
+            report=self.stdout.write,
+        )
+        try:
+            run.run(paths)
+        except KeyboardInterrupt:
+            self.stderr.write("Interrupted; run the same command again to resume.")
+            return
+        except pymongo_errors.PyMongoError as e:
+            raise CommandError(f"MongoDB write failed, stopping (finished files are checkpointed): {e}")
+        finally:
+            checkpoint.close()
+            sink.close()
+
+        for result in run.failures:
+            self.stderr.write(f"FAILED {result['path']}: {result['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {run.processed} processed, {run.failed} failed, {run.skipped} skipped, {run.rows} transactions."
+        ))
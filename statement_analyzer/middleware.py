@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.conf import settings
+
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimingMiddleware:
+    """
+    Observes request latency per view and logs requests slower than
+    SLOW_REQUEST_MS with the stages (spans) they spent their time in.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = instrumentation.start_trace()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            spans = instrumentation.end_trace(token)
+        view = _view_name(request)
+        instrumentation.REQUEST_SECONDS.observe(elapsed, view=view, status=f'{response.status_code // 100}xx')
+
+        if elapsed * 1000 >= settings.SLOW_REQUEST_MS:
+            instrumentation.SLOW_REQUESTS.inc(view=view)
+            logger.warning(
+                "Slow request %s %s (%s) took %.0f ms: %s",
+                request.method, request.path, view, elapsed * 1000,
+                [s.as_dict() for s in spans] or 'no stages recorded',
+            )
+        return response
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
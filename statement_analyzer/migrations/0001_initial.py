@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractedStatement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('document_hash', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('filename', models.CharField(blank=True, max_length=255)),
+                ('account_info', models.JSONField(default=dict)),
+                ('row_count', models.PositiveIntegerField(default=0)),
+                ('chunk_rows', models.PositiveIntegerField()),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('source_pdf', models.BinaryField(null=True)),
+                ('fraud_issues', models.JSONField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatementChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('payload', models.BinaryField()),
+                ('statement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='statement_analyzer.extractedstatement')),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='statementchunk',
+            constraint=models.UniqueConstraint(fields=('statement', 'index'), name='unique_statement_chunk'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statement_analyzer', '0002_statement_batches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('document_hash', models.CharField(blank=True, max_length=64)),
+                ('path', models.CharField(choices=[('text', 'pdfplumber + text LLM'), ('ocr', 'Docling OCR + text LLM'), ('vision', 'GPT-4o vision')], max_length=16)),
+                ('reason', models.CharField(max_length=16)),
+                ('attempt', models.PositiveSmallIntegerField(default=1)),
+                ('template', models.CharField(blank=True, db_index=True, max_length=32)),
+                ('layout', models.CharField(blank=True, max_length=16)),
+                ('page_count', models.PositiveIntegerField(default=0)),
+                ('features', models.JSONField(default=dict)),
+                ('estimate', models.JSONField(default=dict)),
+                ('seconds', models.FloatField(default=0.0)),
+                ('cost', models.FloatField(default=0.0)),
+                ('row_count', models.PositiveIntegerField(null=True)),
+                ('mismatch_count', models.PositiveIntegerField(null=True)),
+                ('passed', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
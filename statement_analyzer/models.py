@@ -1,3 +1,126 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class ExtractedStatement(models.Model):
+    """
+    One analysed statement. The session only keeps ``key``; the transactions
+    live in StatementChunk rows so an edit rewrites a chunk, not the statement.
+    """
+    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    document_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    filename = models.CharField(max_length=255, blank=True)
+    account_info = models.JSONField(default=dict)
+    row_count = models.PositiveIntegerField(default=0)
+    chunk_rows = models.PositiveIntegerField()
+    version = models.PositiveIntegerField(default=1)
+    source_pdf = models.BinaryField(null=True)
+    fraud_issues = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename or self.key} (v{self.version})"
+
+
+class StatementChunk(models.Model):
+    """
+    A zlib-compressed TransactionTable holding ``chunk_rows`` consecutive rows.
+    """
+    statement = models.ForeignKey(ExtractedStatement, related_name='chunks', on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    payload = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['statement', 'index'], name='unique_statement_chunk'),
+        ]
+        ordering = ['index']
+
+
+class StatementBatch(models.Model):
+    """
+    A bulk upload of several statements (see batch.py). Workers update the
+    items, so any web worker can report progress.
+    """
+    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    file_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Batch {self.key} ({self.file_count} files)"
+
+
+class BatchItem(models.Model):
+    PENDING = 'pending'
+    EXTRACTING = 'extracting'
+    ANALYZING = 'analyzing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (EXTRACTING, 'Extracting text'),
+        (ANALYZING, 'Analyzing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    batch = models.ForeignKey(StatementBatch, related_name='items', on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    filename = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    statement = models.ForeignKey(ExtractedStatement, null=True, on_delete=models.SET_NULL)
+    mismatch_count = models.PositiveIntegerField(null=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'index'], name='unique_batch_item'),
+        ]
+        ordering = ['index']
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+
+class PipelineRun(models.Model):
+    """
+    One attempt to analyse a statement through one extraction path, as chosen
+    by path_selector. These rows are the history its cost model learns from,
+    and the record of its decisions for offline analysis.
+    """
+    TEXT = 'text'
+    OCR = 'ocr'
+    VISION = 'vision'
+    PATH_CHOICES = [
+        (TEXT, 'pdfplumber + text LLM'),
+        (OCR, 'Docling OCR + text LLM'),
+        (VISION, 'GPT-4o vision'),
+    ]
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    document_hash = models.CharField(max_length=64, blank=True)
+    path = models.CharField(max_length=16, choices=PATH_CHOICES)
+    reason = models.CharField(max_length=16)
+    attempt = models.PositiveSmallIntegerField(default=1)
+    template = models.CharField(max_length=32, blank=True, db_index=True)
+    layout = models.CharField(max_length=16, blank=True)
+    page_count = models.PositiveIntegerField(default=0)
+    features = models.JSONField(default=dict)
+    estimate = models.JSONField(default=dict)
+    seconds = models.FloatField(default=0.0)
+    cost = models.FloatField(default=0.0)
+    row_count = models.PositiveIntegerField(null=True)
+    mismatch_count = models.PositiveIntegerField(null=True)
+    passed = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.path} ({'passed' if self.passed else 'failed'}, {self.seconds:.1f}s)"
@@ -0,0 +1,371 @@
+"""
+MongoDB persistence for extracted statements and their transactions.
+
+One MongoClient is shared by the whole process. pymongo keeps its own
+connection pool, so building a client per request only adds handshakes.
+
+Writes made while an upload waits go through request_timeout(): they give up
+after MONGO_REQUEST_TIMEOUT_MS, and once one has failed to reach the server
+the next MONGO_RETRY_AFTER_S seconds of them are skipped straight away, so a
+stopped mongod costs one upload a short wait instead of every upload the full
+server selection timeout.
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import pymongo
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING, TEXT, MongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, ServerSelectionTimeoutError
+
+_client = None
+_client_lock = threading.Lock()
+_unreachable_until = 0.0
+
+DATE_FORMATS = ("%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%d.%m.%Y")
+
+# Fields an API client may ask for; everything else stays on the server.
+TRANSACTION_FIELDS = ("document_hash", "account_number", "date", "details", "amount", "balance", "mismatch", "txn_id")
+DEFAULT_QUERY_LIMIT = 50
+MAX_QUERY_LIMIT = 500
+
+
+def get_mongo_client():
+    """
+    Returns the process-wide MongoClient, creating it on first use.
+    The client connects lazily, so this never blocks on the network.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(
+                    settings.MONGO_URI,
+                    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+                    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    connect=False,
+                )
+    return _client
+
+
+def set_mongo_client(client):
+    """
+    Replaces the shared client, e.g. with a ``mongomock.MongoClient()`` in tests.
+    Passing None closes nothing and makes the next call build a fresh client.
+    """
+    global _client, _unreachable_until
+    with _client_lock:
+        _client = client
+        _unreachable_until = 0.0
+
+
+@contextmanager
+def request_timeout():
+    """
+    Bounds the MongoDB calls in the block to MONGO_REQUEST_TIMEOUT_MS,
+    server selection included. Raises ServerSelectionTimeoutError without
+    trying while the server is known to be unreachable.
+    """
+    global _unreachable_until
+    if time.monotonic() < _unreachable_until:
+        raise ServerSelectionTimeoutError("MongoDB was unreachable moments ago; write skipped.")
+    try:
+        with pymongo.timeout(settings.MONGO_REQUEST_TIMEOUT_MS / 1000):
+            yield
+    except (ConnectionFailure, ExecutionTimeout):
+        _unreachable_until = time.monotonic() + settings.MONGO_RETRY_AFTER_S
+        raise
+
+
+def get_database():
+    return get_mongo_client()[settings.MONGO_DATABASE_NAME]
+
+
+def get_transactions_collection():
+    return get_database()[settings.MONGO_COLLECTION_NAME]
+
+
+def get_statements_collection():
+    return get_database()[settings.MONGO_STATEMENTS_COLLECTION_NAME]
+
+
+def ensure_indexes():
+    """
+    Creates the indexes used by lookups on stored transactions.
+    create_index is idempotent, so this is safe to call on every startup.
+
+    Query indexes follow equality, sort, range order: the keyset sort on
+    (txn_date, _id) comes before amount so an amount band never forces an
+    in-memory sort.
+    """
+    transactions = get_transactions_collection()
+    transactions.create_index([("document_hash", ASCENDING), ("seq", ASCENDING)])
+    transactions.create_index([
+        ("account_number", ASCENDING), ("txn_date", DESCENDING), ("_id", DESCENDING), ("amount", ASCENDING),
+    ])
+    transactions.create_index([("txn_date", DESCENDING), ("_id", DESCENDING), ("amount", ASCENDING)])
+    transactions.create_index([("amount", ASCENDING)])
+    transactions.create_index([("details", TEXT)], default_language="none")
+
+    statements = get_statements_collection()
+    statements.create_index([("account_number", ASCENDING), ("created_at", DESCENDING)])
+
+
+def document_hash(file_bytes):
+    """
+    Returns the SHA-256 hex digest used as the identity of an uploaded statement.
+    """
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def parse_statement_date(value):
+    """
+    Parses a statement date (DD-MM-YYYY as produced by the extractor) into a datetime.
+    Returns None when the value cannot be parsed.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _to_float(value):
+    if value in (None, "", "nan", "null"):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(",", "").replace("Cr", "").replace("Dr", "").strip())
+    except ValueError:
+        return None
+
+
+def build_transaction_documents(doc_hash, account_info, transactions, start=0):
+    """
+    Converts extracted transaction dicts into MongoDB documents, numbered from
+    row ``start``. The _id combines the document hash with the row position,
+    so a statement can never be stored twice.
+    """
+    account_number = (account_info or {}).get("account_number")
+    documents = []
+    for seq, entry in enumerate(transactions, start):
+        documents.append({
+            "_id": f"{doc_hash}:{seq:06d}",
+            "document_hash": doc_hash,
+            "seq": seq,
+            "txn_id": entry.get("id"),
+            "account_number": account_number,
+            "date": entry.get("date"),
+            "txn_date": parse_statement_date(entry.get("date")),
+            "details": entry.get("details"),
+            "amount": _to_float(entry.get("amount")),
+            "balance": _to_float(entry.get("balance")),
+            "mismatch": bool(entry.get("mismatch", False)),
+        })
+    return documents
+
+
+def _statement_update(account_info, transaction_count, filename, now):
+    return {
+        "$set": {
+            "account_info": account_info,
+            "account_number": account_info.get("account_number"),
+            "filename": filename,
+            "transaction_count": transaction_count,
+            "updated_at": now,
+        },
+        "$setOnInsert": {"created_at": now},
+    }
+
+
+def save_statement(doc_hash, account_info, transactions, filename=None):
+    """
+    Upserts a statement and replaces all of its transactions.
+
+    The rows go out as a single unordered insert_many, so a statement of a few
+    thousand rows costs one round trip instead of one per row. Rows from a
+    previous extraction of the same document are removed first.
+
+    Returns the number of transaction rows written.
+    """
+    account_info = account_info or {}
+    get_statements_collection().update_one(
+        {"_id": doc_hash},
+        _statement_update(account_info, len(transactions), filename, datetime.now(timezone.utc)),
+        upsert=True,
+    )
+
+    collection = get_transactions_collection()
+    documents = build_transaction_documents(doc_hash, account_info, transactions)
+    collection.delete_many({"document_hash": doc_hash})
+    if documents:
+        collection.insert_many(documents, ordered=False)
+    return len(documents)
+
+
+def clear_transactions(doc_hash):
+    get_transactions_collection().delete_many({"document_hash": doc_hash})
+
+
+def insert_transactions(doc_hash, account_info, transactions, start):
+    """
+    Adds rows ``start`` onwards of a statement that is written a part at a
+    time (page_stream.py): clear_transactions first, then insert_transactions
+    per part, then save_statement_info.
+    """
+    documents = build_transaction_documents(doc_hash, account_info, transactions, start)
+    if documents:
+        get_transactions_collection().insert_many(documents, ordered=False)
+    return len(documents)
+
+
+def save_statement_info(doc_hash, account_info, transaction_count, filename=None):
+    get_statements_collection().update_one(
+        {"_id": doc_hash},
+        _statement_update(account_info or {}, transaction_count, filename, datetime.now(timezone.utc)),
+        upsert=True,
+    )
+
+
+def save_statements(statements):
+    """
+    save_statement for many statements at once, for offline batch runs:
+    one bulk_write for the statement documents, one delete_many and one
+    insert_many for all of their rows.
+
+    ``statements`` is a list of (doc_hash, account_info, transactions, filename).
+    Returns the number of transaction rows written.
+    """
+    if not statements:
+        return 0
+    now = datetime.now(timezone.utc)
+    get_statements_collection().bulk_write([
+        UpdateOne({"_id": doc_hash}, _statement_update(account_info or {}, len(transactions), filename, now), upsert=True)
+        for doc_hash, account_info, transactions, filename in statements
+    ], ordered=False)
+
+    collection = get_transactions_collection()
+    documents = [
+        document
+        for doc_hash, account_info, transactions, _ in statements
+        for document in build_transaction_documents(doc_hash, account_info, transactions)
+    ]
+    collection.delete_many({"document_hash": {"$in": [doc_hash for doc_hash, _, _, _ in statements]}})
+    if documents:
+        collection.insert_many(documents, ordered=False)
+    return len(documents)
+
+
+def encode_cursor(document):
+    """
+    Builds an opaque pagination cursor from the last document of a page.
+    """
+    txn_date = document.get("txn_date")
+    payload = {"d": txn_date.isoformat() if txn_date else None, "i": document["_id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Reverses encode_cursor. Raises ValueError for anything it did not produce.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        txn_date = datetime.fromisoformat(payload["d"]) if payload["d"] else None
+        return txn_date, str(payload["i"])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def build_transaction_query(account_number=None, date_from=None, date_to=None,
+                            amount_min=None, amount_max=None, text=None, cursor=None):
+    """
+    Translates query filters into a MongoDB filter document.
+    Dates are datetimes, amounts floats; None means "no bound".
+    """
+    clauses = []
+    if account_number:
+        clauses.append({"account_number": account_number})
+
+    date_range = {}
+    if date_from is not None:
+        date_range["$gte"] = date_from
+    if date_to is not None:
+        date_range["$lte"] = date_to
+    if date_range:
+        clauses.append({"txn_date": date_range})
+
+    amount_range = {}
+    if amount_min is not None:
+        amount_range["$gte"] = amount_min
+    if amount_max is not None:
+        amount_range["$lte"] = amount_max
+    if amount_range:
+        clauses.append({"amount": amount_range})
+
+    if text:
+        clauses.append({"$text": {"$search": text}})
+
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        if last_date is None:
+            # Undated rows sort last, so only undated rows remain after them.
+            clauses.append({"txn_date": None, "_id": {"$lt": last_id}})
+        else:
+            clauses.append({"$or": [
+                {"txn_date": {"$lt": last_date}},
+                {"txn_date": last_date, "_id": {"$lt": last_id}},
+                {"txn_date": None},
+            ]})
+
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
+
+def find_transactions(filters, cursor=None, limit=DEFAULT_QUERY_LIMIT, fields=None):
+    """
+    Returns one page of stored transactions, newest first, plus the cursor of
+    the next page (None on the last page).
+
+    Pagination is keyset based on (txn_date, _id), so deep pages cost the same
+    as the first one. Only the requested fields are sent back by the server.
+    """
+    limit = max(1, min(int(limit), MAX_QUERY_LIMIT))
+    fields = [f for f in (fields or TRANSACTION_FIELDS) if f in TRANSACTION_FIELDS]
+    projection = {field: 1 for field in fields}
+    # txn_date is needed to build the next cursor even if not returned.
+    projection["txn_date"] = 1
+
+    query = build_transaction_query(cursor=cursor, **filters)
+    documents = list(
+        get_transactions_collection()
+        .find(query, projection)
+        .sort([("txn_date", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+    )
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1])
+
+    results = []
+    for document in documents:
+        row = {"id": document["_id"]}
+        row.update({field: document.get(field) for field in fields})
+        results.append(row)
+    return results, next_cursor
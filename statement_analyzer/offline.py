@@ -0,0 +1,293 @@
+"""
+Offline reprocessing of archived statements (``manage.py process_statements``).
+
+Each PDF is read, text-extracted (pdf_extractor), parsed by the LLM
+(BankStatementParser) and balance-checked (transaction_verifier.verify_table,
+as for uploads) in a worker process; there is no request, session or ORM
+involved. Workers apply the CPU budget (cpu_budget.configure_process). Results are written
+in batches to a JSONL file or to MongoDB, and only then are their document
+hashes appended to the checkpoint file. A run that is killed can simply be
+started again: files whose hash is in the checkpoint are skipped. A result
+written just before a kill may be written again on resume; MongoDB writes
+are idempotent, JSONL readers should keep the last line per document_hash.
+"""
+import fnmatch
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from . import cpu_budget, mongo_store, pdf_extractor, transaction_verifier
+from .data_extractor import BankStatementParser
+from .llm_router import get_router
+from .transaction_table import TransactionTable
+
+logger = logging.getLogger(__name__)
+
+HASH_LENGTH = 64
+
+_parser = None
+
+
+def iter_statement_files(directory, pattern='*.pdf'):
+    """
+    Yields the paths of files under ``directory`` matching ``pattern``
+    (case-insensitive), in a stable order so runs are reproducible.
+    """
+    pattern = pattern.lower()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if fnmatch.fnmatch(name.lower(), pattern):
+                yield os.path.join(root, name)
+
+
+def file_hash(path):
+    """
+    SHA-256 of a file, the same document hash as mongo_store.document_hash.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def init_worker():
+    """
+    Process pool initializer: applies the project's LOGGING settings and the
+    CPU budget. The app registry is not needed, so django.setup() (and its
+    startup work) is skipped.
+    """
+    from django.utils.log import configure_logging
+
+    configure_logging(settings.LOGGING_CONFIG, settings.LOGGING)
+    cpu_budget.configure_process()
+
+
+def process_file(path, doc_hash):
+    """
+    Runs one PDF through extraction, the LLM and the balance check. Never
+    raises; failures come back as {'status': 'failed', 'error': ...}.
+    """
+    global _parser
+    start = time.perf_counter()
+    result = {'document_hash': doc_hash, 'path': path, 'filename': os.path.basename(path)}
+    try:
+        with open(path, 'rb') as f:
+            file_bytes = f.read()
+        text = pdf_extractor.extract_text_from_bytes(file_bytes)
+        if not text:
+            raise ValueError("no text could be extracted from the PDF")
+        if settings.LLM_ROUTING == 'auto':
+            extracted_data = get_router().extract(text)
+        else:
+            if _parser is None:
+                _parser = BankStatementParser()
+            extracted_data = _parser.extract__from_text_transactions_gpt(text)
+        if not extracted_data:
+            raise ValueError("the LLM returned no transaction data")
+
+        transactions = extracted_data.get('transactions') or []
+        table = TransactionTable.from_dicts(transactions)
+        flagged = transaction_verifier.verify_table(table)
+        for entry, mismatch in zip(transactions, table.mismatch):
+            entry['mismatch'] = bool(mismatch)
+        result.update(
+            status='ok',
+            account_info=extracted_data.get('account_info') or {},
+            row_count=len(transactions),
+            mismatch_count=len(flagged),
+            transactions=transactions,
+        )
+    except Exception as e:
+        logger.warning("Processing %s failed: %s", path, e)
+        result.update(status='failed', error=f"{type(e).__name__}: {e}")
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+class Checkpoint:
+    """
+    Append-only file of completed document hashes, one "<hash>\\t<path>" per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    doc_hash = line.split('\t', 1)[0].strip()
+                    # A run killed mid-write can leave a partial last line.
+                    if len(doc_hash) == HASH_LENGTH:
+                        self.done.add(doc_hash)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, doc_hash):
+        return doc_hash in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, results):
+        for result in results:
+            self.file.write(f"{result['document_hash']}\t{result['path']}\n")
+            self.done.add(result['document_hash'])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink:
+    """
+    Appends one JSON line per result, successful or not.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, results):
+        for result in results:
+            self.file.write(json.dumps(result, default=str) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class MongoSink:
+    """
+    Writes successful results with mongo_store.save_statements. Failures are
+    only reported (see ProcessingRun.failures); they are retried on the next run.
+    """
+
+    def __init__(self):
+        self.path = 'MongoDB'
+
+    def write(self, results):
+        mongo_store.save_statements([
+            (result['document_hash'], result['account_info'], result['transactions'], result['filename'])
+            for result in results if result['status'] == 'ok'
+        ])
+
+    def close(self):
+        pass
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class ProcessingRun:
+    """
+    Feeds files to a pool of ``workers`` processes, keeping at most two tasks
+    per worker queued so memory stays flat however many files there are.
+    Results are flushed to the sink every ``batch_size`` results (and at
+    least every ``flush_seconds``), then checkpointed.
+    """
+
+    def __init__(self, checkpoint, sink, workers, total, batch_size=50, flush_seconds=10,
+                 progress_seconds=10, in_processes=True, report=print):
+        self.checkpoint = checkpoint
+        self.sink = sink
+        self.workers = workers
+        self.total = total
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.progress_seconds = progress_seconds
+        self.in_processes = in_processes
+        self.report = report
+
+        self.pending = []
+        self.failures = []
+        self.processed = self.failed = self.skipped = self.rows = 0
+        self.started = self.last_flush = self.last_report = time.monotonic()
+
+    def _pool(self):
+        if self.in_processes:
+            # spawn, not fork: workers should not inherit open files, sockets or threads
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+            )
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='process-statements')
+
+    def run(self, paths):
+        seen = set()
+        in_flight = set()
+        pool = self._pool()
+        try:
+            for path in paths:
+                doc_hash = file_hash(path)
+                if doc_hash in self.checkpoint or doc_hash in seen:
+                    self.skipped += 1
+                    continue
+                seen.add(doc_hash)
+                while len(in_flight) >= self.workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._collect(done)
+                in_flight.add(pool.submit(process_file, path, doc_hash))
+                self._maybe_report()
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                self._collect(done)
+        finally:
+            # Also on KeyboardInterrupt: keep whatever finished, drop the rest.
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.flush()
+            self.report(self.progress_line())
+
+    def _collect(self, futures):
+        for future in futures:
+            result = future.result()
+            if result['status'] == 'ok':
+                self.processed += 1
+                self.rows += result['row_count']
+            else:
+                self.failed += 1
+                self.failures.append(result)
+            self.pending.append(result)
+        now = time.monotonic()
+        if len(self.pending) >= self.batch_size or now - self.last_flush >= self.flush_seconds:
+            self.flush()
+        self._maybe_report()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.sink.write(self.pending)
+        self.checkpoint.add(result for result in self.pending if result['status'] == 'ok')
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.progress_seconds:
+            self.last_report = now
+            self.report(self.progress_line())
+
+    def progress_line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        finished = self.processed + self.failed
+        rate = finished / elapsed
+        remaining = max(self.total - finished - self.skipped, 0)
+        eta = _format_duration(remaining / rate) if rate else '?'
+        return (
+            f"{finished + self.skipped}/{self.total} files "
+            f"({self.processed} ok, {self.failed} failed, {self.skipped} skipped) "
+            f"in {_format_duration(elapsed)}: {rate:.2f} files/s, {self.rows / elapsed:.1f} rows/s, ETA {eta}"
+        )
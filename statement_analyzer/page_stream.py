@@ -0,0 +1,208 @@
+"""
+Bounded-memory processing of very large statements, a window of pages at a time.
+
+    statement = process_document(file_bytes, filename)
+
+Each PAGE_WINDOW pages go through text extraction, the LLM, the
+running-balance check and storage before the next window is read. Text
+comes from pdfplumber on just those pages, or from the OCR_ENGINE when the
+window has scanned pages (pdf_extractor.extract_window_text). Without an
+OCR engine, scanned pages are rendered and read with GPT-4o vision. Rows are
+written to the statement store (statement_store.StatementWriter) and
+MongoDB as each window finishes. Only the last row and the carried balance
+are kept, so peak memory depends on PAGE_WINDOW and not on the page count.
+
+The windows are extracted independently, so their rows are stitched
+together. If a window repeats the previous window's last row, or opens with
+a "brought forward" row carrying the previous balance, that row is dropped.
+Ids run on across windows. Account info comes from the first window that
+has it, and final_balance from the last.
+
+Windowed statements are not handled by path_selector. Each window takes a
+fixed path (vision for scanned pages, otherwise the text LLM, through the
+router when LLM_ROUTING is "auto") with no fallback to another path, and no
+PipelineRun is recorded, so the largest statements do not feed its cost
+model.
+"""
+import logging
+import os
+import tempfile
+from contextlib import nullcontext
+
+from django.conf import settings
+from pymongo import errors as pymongo_errors
+
+from . import cpu_budget, mongo_store, pdf_extractor, statement_store
+from .data_extractor import BankStatementParser, continuation_rows
+from .instrumentation import span
+from .lazy import lazy_import
+from .llm_router import get_router
+from .repair import render_page
+from .transaction_table import TransactionTable, to_cents
+from .transaction_verifier import RunningBalanceCheck
+
+fitz = lazy_import('fitz')
+
+logger = logging.getLogger(__name__)
+
+MISSING = (None, '', 'null')
+
+
+def page_count(file_bytes):
+    doc = fitz.open(stream=file_bytes, filetype='pdf')
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+def stitch_rows(rows, last_row, carried):
+    """
+    The rows of a window that follow ``last_row``, the last row stored so
+    far. ``carried`` is the balance in cents carried into the window.
+    """
+    if last_row is None or not rows:
+        return rows
+    rows = continuation_rows([last_row], rows)
+    if rows and carried is not None:
+        try:
+            brought_forward = not to_cents(rows[0].get('amount')) and to_cents(rows[0].get('balance')) == carried
+        except ValueError:
+            brought_forward = False
+        if brought_forward:
+            rows = rows[1:]
+    return rows
+
+
+def merge_account_info(info, new):
+    """
+    ``info`` with the fields it is missing taken from ``new``, and the final balance of ``new``.
+    """
+    if not isinstance(new, dict):
+        return info
+    merged = dict(info)
+    for name, value in new.items():
+        if merged.get(name) in MISSING or (name == 'final_balance' and value not in MISSING):
+            merged[name] = value
+    return merged
+
+
+def _check_rows(rows, check, start):
+    """
+    Numbers the rows from ``start`` + 1 and flags those failing the running
+    balance carried by ``check``, or whose amount or balance is unreadable.
+    Returns the number flagged.
+    """
+    table = TransactionTable.from_dicts(rows)
+    flagged = 0
+    for i, (row, amount, balance) in enumerate(zip(rows, table.amounts, table.balances)):
+        row['id'] = start + i + 1
+        row['mismatch'] = check.feed(amount, balance)[0] or table.unreadable(i)
+        flagged += row['mismatch']
+    return flagged
+
+
+class _MongoRows:
+    """
+    The MongoDB copy of a statement written window by window. As in
+    pipeline.persist_extracted_statement, failures are logged and ignored;
+    after the first one the rest of the statement is not sent.
+    """
+
+    def __init__(self, doc_hash):
+        self.doc_hash = doc_hash
+        self.ok = self._write(mongo_store.clear_transactions, doc_hash)
+
+    def _write(self, fn, *args):
+        try:
+            with mongo_store.request_timeout():
+                fn(*args)
+            return True
+        except pymongo_errors.PyMongoError as err:
+            logger.warning("MongoDB write failed: %s", err)
+        return False
+
+    def append(self, account_info, rows, start):
+        if self.ok:
+            self.ok = self._write(mongo_store.insert_transactions, self.doc_hash, account_info, rows, start)
+
+    def finish(self, account_info, count, filename):
+        if self.ok:
+            self._write(mongo_store.save_statement_info, self.doc_hash, account_info, count, filename)
+
+    def discard(self):
+        # Also after a failed write: the windows before it may have landed.
+        self._write(mongo_store.clear_transactions, self.doc_hash)
+
+
+def _extract_window(parser, doc, text, scanned, first, stop):
+    if scanned:
+        with span('rendering', pages=stop - first), cpu_budget.cpu_slot():
+            images = [render_page(doc, number, settings.PIPELINE_VISION_DPI) for number in range(first, stop)]
+        return parser.extract_transactions_gpt(images, text)
+    if not text.strip():
+        return None
+    if settings.LLM_ROUTING == 'auto':
+        return get_router().extract(text)
+    return parser.extract__from_text_transactions_gpt(text)
+
+
+def process_document(file_bytes, filename='', offload=None, llm_gate=None, window=None, parser=None):
+    """
+    Extracts and stores a statement window by window. Returns the
+    ExtractedStatement, or None if no window gave any transactions.
+    ``offload`` and ``llm_gate`` work as in pipeline.analyze_document.
+    If the LLM is unavailable, LLMUnavailableError is raised and the partial
+    statement is deleted, along with the rows already sent to MongoDB.
+    """
+    window = window or settings.PAGE_WINDOW
+    offload = offload or cpu_budget.run
+    llm_gate = llm_gate or nullcontext
+    parser = parser or BankStatementParser()
+    doc_hash = mongo_store.document_hash(file_bytes)
+
+    # The windows read the PDF from disk, so worker processes get a path rather than the bytes.
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+        temp_file.write(file_bytes)
+        path = temp_file.name
+    writer = statement_store.StatementWriter(file_bytes, filename=filename, document_hash=doc_hash)
+    mongo = _MongoRows(doc_hash)
+    account_info, last_row, check = {}, None, RunningBalanceCheck()
+    count = mismatches = pages = 0
+    try:
+        with span('page_stream') as s, pdf_extractor.PdfProbe.open(path) as probe:
+            pages = probe.page_count
+            for first in range(0, pages, window):
+                stop = min(first + window, pages)
+                verdicts = [probe.verdict(number) for number in range(first, stop)]
+                text, scanned = offload(pdf_extractor.extract_window_text, path, first, stop, verdicts)
+                with llm_gate():
+                    data = _extract_window(parser, probe.doc, text, scanned, first, stop)
+                rows = [row for row in (data or {}).get('transactions') or [] if isinstance(row, dict)]
+                rows = stitch_rows(rows, last_row, check.previous)
+                if not rows:
+                    logger.warning("No transactions in pages %d-%d of %s", first + 1, stop, filename or doc_hash)
+                    continue
+                account_info = merge_account_info(account_info, data.get('account_info'))
+                mismatches += _check_rows(rows, check, count)
+                writer.append(rows)
+                mongo.append(account_info, rows, count)
+                count += len(rows)
+                last_row = rows[-1]
+                logger.debug("Pages %d-%d of %s: %d rows", first + 1, stop, filename or doc_hash, len(rows))
+            s.add(pages=pages, rows=count)
+    except BaseException:
+        writer.discard()
+        mongo.discard()
+        raise
+    finally:
+        os.unlink(path)
+
+    if not count:
+        writer.discard()
+        return None
+    statement = writer.close(account_info)
+    mongo.finish(account_info, count, filename)
+    logger.info("Stored %s window by window: %d pages, %d rows, %d mismatches",
+                filename or doc_hash, pages, count, mismatches)
+    return statement
@@ -0,0 +1,314 @@
+"""
+Chooses the extraction path of each statement with a cost model learned from past runs.
+
+Three paths turn a PDF into transactions:
+
+    text    pdfplumber text layer + text LLM    cheap, needs a text layer
+    ocr     Docling or RapidOCR + text LLM      CPU heavy, needs the OCR_ENGINE
+    vision  GPT-4o on page images               no OCR, but the most tokens
+
+pdf_features() reads cheap features of the PDF: page count, file size, the
+layout and share of text pages from a sample of pages (pdf_extractor.PdfProbe),
+and a fingerprint of the first page's header that identifies the bank template. Every attempt is stored as a
+PipelineRun with its latency, LLM cost, mismatch count and whether it
+passed, i.e. gave rows that could all be read. Balance mismatches do not
+fail a path: in a genuinely edited statement they are the finding, and
+another path that happens to misread them away must not win. CostModel
+learns from recent runs. For each
+path it keeps the median latency and cost per page and a smoothed pass
+rate. It uses the most specific group with enough runs: the same
+template, then the same layout (text/hybrid/scanned), then all
+statements. With no history it starts from PRIORS.
+
+plan() ranks the eligible paths. Paths expected to pass at least
+PIPELINE_MIN_PASS_RATE of the time come first, cheapest first. "Cheap"
+counts LLM dollars plus PIPELINE_SECONDS_COST per second of latency.
+analyze() tries the paths in that order. It falls back to the next path
+only when one raises, returns no rows or returns unreadable amounts or
+balances, up to PIPELINE_MAX_ATTEMPTS, and keeps the first attempt that
+passed. The PipelineRun rows double as the decision log for
+offline analysis (admin, or ``manage.py dumpdata statement_analyzer.PipelineRun``).
+Statements processed a window of pages at a time (page_stream.py) bypass
+the selector and record no runs.
+"""
+import hashlib
+import logging
+import random
+import re
+import statistics
+import threading
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from . import cpu_budget, mongo_store, pdf_extractor
+from .instrumentation import PIPELINE_PATH_DECISIONS, span
+from .lazy import lazy_import
+from .llm_backends import LLMUnavailableError
+from .llm_router import get_router, metered_parser, track_cost
+from .models import PipelineRun
+from .transaction_table import TransactionTable
+from .transaction_verifier import verify_table
+
+fitz = lazy_import('fitz')
+
+logger = logging.getLogger(__name__)
+
+PATHS = (PipelineRun.TEXT, PipelineRun.OCR, PipelineRun.VISION)
+
+# Starting estimates per page, before there is any history. With them a PDF
+# with a text layer goes to the text path and a scanned one to OCR, which is
+# what the fixed heuristic did.
+PRIORS = {
+    PipelineRun.TEXT: {'seconds_per_page': 3.0, 'cost_per_page': 0.004, 'pass_rate': 0.8},
+    PipelineRun.OCR: {'seconds_per_page': 8.0, 'cost_per_page': 0.004, 'pass_rate': 0.75},
+    PipelineRun.VISION: {'seconds_per_page': 5.0, 'cost_per_page': 0.012, 'pass_rate': 0.7},
+}
+PRIOR_WEIGHT = 2  # the prior pass rate counts as this many runs
+
+
+def _template_key(first_page_text):
+    """
+    Fingerprint of the first lines of a statement with digits and
+    punctuation removed, so statements of the same bank and layout share it.
+    """
+    lines = []
+    for line in first_page_text.splitlines():
+        words = re.sub(r'[\d\W_]+', ' ', line).strip().lower()
+        if words:
+            lines.append(words)
+        if len(lines) == 3:
+            break
+    return hashlib.sha1('\n'.join(lines).encode()).hexdigest()[:12] if lines else ''
+
+
+def pdf_features(file_bytes):
+    with span('pdf_probe') as s:
+        with pdf_extractor.PdfProbe.open(file_bytes) as probe:
+            first_page_text = probe.doc[0].get_text() if probe.page_count else ''
+            s.add(pages=probe.page_count, bytes=len(file_bytes), sampled=probe.sampled)
+            classified = probe.text_pages + probe.image_pages
+            return {
+                'pages': probe.page_count,
+                'bytes': len(file_bytes),
+                'sampled': probe.sampled,
+                'text_share': round(probe.text_pages / classified, 3) if classified else 1.0,
+                'layout': probe.layout,
+                'template': _template_key(first_page_text),
+            }
+
+
+def eligible_paths(features):
+    paths = []
+    for path in settings.PIPELINE_PATHS:
+        if path == PipelineRun.TEXT and features['layout'] == 'scanned':
+            continue
+        if path == PipelineRun.OCR and not pdf_extractor.ocr_available():
+            continue
+        if path == PipelineRun.VISION and features['pages'] > settings.PIPELINE_VISION_MAX_PAGES:
+            continue
+        paths.append(path)
+    return paths
+
+
+class CostModel:
+    def __init__(self, runs, min_samples=5):
+        """
+        ``runs``: dicts with path, template, layout, page_count, seconds, cost, passed and error.
+        """
+        self.min_samples = min_samples
+        self.groups = {}
+        for run in runs:
+            keys = [(run['path'], 'layout', run['layout']), (run['path'], 'all', '')]
+            if run['template']:
+                keys.append((run['path'], 'template', run['template']))
+            for key in keys:
+                self.groups.setdefault(key, []).append(run)
+
+    def estimate(self, path, features):
+        """
+        {'basis', 'samples', 'seconds', 'cost', 'pass_rate'} expected for ``path`` on this PDF.
+        """
+        prior = PRIORS[path]
+        basis, runs = 'prior', []
+        for level, value in (('template', features['template']), ('layout', features['layout']), ('all', '')):
+            group = self.groups.get((path, level, value), [])
+            if (value or level == 'all') and len(group) >= self.min_samples:
+                basis, runs = level, group
+                break
+
+        finished = [run for run in runs if not run['error']]
+        seconds_per_page = statistics.median(
+            run['seconds'] / max(run['page_count'], 1) for run in finished
+        ) if finished else prior['seconds_per_page']
+        cost_per_page = statistics.median(
+            run['cost'] / max(run['page_count'], 1) for run in finished
+        ) if finished else prior['cost_per_page']
+        passes = sum(1 for run in runs if run['passed'])
+        pages = max(features['pages'], 1)
+        return {
+            'basis': basis,
+            'samples': len(runs),
+            'seconds': round(seconds_per_page * pages, 3),
+            'cost': round(cost_per_page * pages, 6),
+            'pass_rate': round((passes + PRIOR_WEIGHT * prior['pass_rate']) / (len(runs) + PRIOR_WEIGHT), 3),
+        }
+
+
+_model = None
+_model_loaded = 0.0
+_model_lock = threading.Lock()
+
+
+def get_cost_model(max_age=60):
+    """
+    The CostModel of the last PIPELINE_HISTORY runs, rebuilt at most every ``max_age`` seconds.
+    """
+    global _model, _model_loaded
+    with _model_lock:
+        if _model is None or time.monotonic() - _model_loaded >= max_age:
+            runs = PipelineRun.objects.values(
+                'path', 'template', 'layout', 'page_count', 'seconds', 'cost', 'passed', 'error',
+            )[:settings.PIPELINE_HISTORY]
+            try:
+                _model = CostModel(list(runs))
+            except DatabaseError as e:
+                logger.warning("Could not load the pipeline history: %s", e)
+                _model = _model or CostModel([])
+            _model_loaded = time.monotonic()
+        return _model
+
+
+def plan(features, model, rng=random):
+    """
+    [(path, estimate), ...] in the order to try them, and the reason for the first choice.
+    """
+    estimates = {path: model.estimate(path, features) for path in eligible_paths(features)}
+
+    def price(path):
+        return estimates[path]['cost'] + settings.PIPELINE_SECONDS_COST * estimates[path]['seconds']
+
+    likely = sorted((path for path in estimates if estimates[path]['pass_rate'] >= settings.PIPELINE_MIN_PASS_RATE),
+                    key=price)
+    unlikely = sorted((path for path in estimates if path not in likely), key=lambda path: -estimates[path]['pass_rate'])
+    order = likely + unlikely
+    if not order:
+        return [], None
+    reason = 'prior' if estimates[order[0]]['basis'] == 'prior' else 'model'
+    if len(order) > 1 and rng.random() < settings.PIPELINE_EXPLORE:
+        pick = rng.choice(order[1:])
+        order = [pick] + [path for path in order if path != pick]
+        reason = 'explore'
+    return [(path, estimates[path]) for path in order], reason
+
+
+def _extract_from_text(text):
+    if settings.LLM_ROUTING == 'auto':
+        return get_router().extract(text)
+    return metered_parser().extract__from_text_transactions_gpt(text)
+
+
+def _extract_with_vision(file_bytes):
+    from .repair import render_page
+
+    with cpu_budget.cpu_slot():
+        doc = fitz.open(stream=file_bytes, filetype='pdf')
+        try:
+            images = [render_page(doc, number, settings.PIPELINE_VISION_DPI) for number in range(doc.page_count)]
+            text = '\n'.join(page.get_text() for page in doc)
+        finally:
+            doc.close()
+    return metered_parser().extract_transactions_gpt(images, text)
+
+
+def _run_path(path, file_bytes, offload, llm_gate):
+    if path == PipelineRun.VISION:
+        with llm_gate():
+            return _extract_with_vision(file_bytes)
+    text = offload(pdf_extractor.extract_text_with, path, file_bytes)
+    if not text:
+        return None
+    with llm_gate():
+        return _extract_from_text(text)
+
+
+def _verify(data):
+    """
+    (rows, mismatches, unreadable rows) of an extracted statement.
+    """
+    transactions = (data or {}).get('transactions') or []
+    table = TransactionTable.from_dicts(transactions)
+    mismatches = len(verify_table(table))
+    return len(table), mismatches, sum(1 for i in range(len(table)) if table.unreadable(i))
+
+
+def analyze(file_bytes, offload=None, llm_gate=None, rng=random):
+    """
+    {'account_info': ..., 'transactions': [...]} for a PDF, or None.
+
+    ``offload(fn, *args)`` runs the CPU-bound text extraction (a CPU slot
+    by default, a process pool in batch.py); ``llm_gate`` is a context manager factory held around
+    the LLM calls. LLMUnavailableError is raised, as every path needs the LLM.
+    The first attempt that passed is returned with its mismatches, however
+    many; failing that, the one with the fewest unreadable rows.
+    """
+    offload = offload or cpu_budget.run
+    llm_gate = llm_gate or nullcontext
+    features = pdf_features(file_bytes)
+    order, reason = plan(features, get_cost_model(), rng)
+    doc_hash = mongo_store.document_hash(file_bytes)
+
+    best, best_unreadable = None, None
+    for attempt, (path, estimate) in enumerate(order[:settings.PIPELINE_MAX_ATTEMPTS], 1):
+        PIPELINE_PATH_DECISIONS.inc(path=path, reason=reason)
+        logger.info("Extraction path %s (%s, attempt %d): expected %.1fs, $%.4f, pass rate %.2f from %s",
+                    path, reason, attempt, estimate['seconds'], estimate['cost'], estimate['pass_rate'],
+                    estimate['basis'])
+        run = PipelineRun(
+            document_hash=doc_hash, path=path, reason=reason, attempt=attempt, template=features['template'],
+            layout=features['layout'], page_count=features['pages'], features=features, estimate=estimate,
+        )
+        start = time.monotonic()
+        data = None
+        try:
+            with track_cost() as meter:
+                data = _run_path(path, file_bytes, offload, llm_gate)
+        except LLMUnavailableError as e:
+            run.error = str(e) or type(e).__name__
+            _save(run, start, meter, data)
+            raise
+        except cpu_budget.ServerBusyError:
+            raise  # says nothing about the path; not recorded
+        except Exception as e:
+            logger.exception("Extraction path %s failed", path)
+            run.error = str(e) or type(e).__name__
+        unreadable = _save(run, start, meter, data)
+
+        if run.passed:
+            return data
+        if data and run.row_count and (best_unreadable is None or unreadable < best_unreadable):
+            best, best_unreadable = data, unreadable
+        logger.warning("Extraction path %s gave no usable rows (%s rows, %s unreadable)%s",
+                       path, run.row_count, unreadable,
+                       "; falling back" if attempt < min(len(order), settings.PIPELINE_MAX_ATTEMPTS) else "")
+        reason = 'fallback'
+    return best
+
+
+def _save(run, start, meter, data):
+    """
+    Records the run; returns the number of unreadable rows, or None without data.
+    """
+    run.seconds = time.monotonic() - start
+    run.cost = meter.cost
+    unreadable = None
+    if data:
+        run.row_count, run.mismatch_count, unreadable = _verify(data)
+        run.passed = bool(run.row_count) and not unreadable
+    try:
+        run.save()
+    except DatabaseError as e:
+        logger.warning("Could not record the pipeline run: %s", e)
+    return unreadable
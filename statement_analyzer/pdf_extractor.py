@@ -1,126 +1,152 @@
-# Placeholder: statement_analyzer/pdf_extractor.py
-# YOU NEED TO IMPLEMENT THIS BASED ON YOUR PDF EXTRACTION TECHNIQUE.
-
-# Example: If you are using a library like PyPDF2 or pdfplumber
-# import PyPDF2 # or other relevant library
-
-from pathlib import Path
-import sys # For better error output
-import sys
-import re
-from pathlib import Path
-from typing import List
-import tempfile
-import pdfplumber
+import importlib.util
+import logging
+import math
 import os
+import random
 import re
-import json
-import fitz
+import tempfile
+import threading
 from io import BytesIO
-# --- Assuming these imports from docling are correct ---
-from .data_extractor import BankStatementParser
-from .enhancement import enhancement_logic
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import (
-    PdfPipelineOptions,
-    PipelineOptions,
-    EasyOcrOptions,
-    TesseractCliOcrOptions,
-    RapidOcrOptions
-    # Keep other OCR options commented out
-    # TesseractOcrOptions, RapidOcrOptions, OcrMacOptions
-)
-
-from docling.document_converter import (
-    ConversionResult,
-    DocumentConverter,
-    InputFormat,
-    PdfFormatOption,
-    ImageFormatOption
-)
-
-
-from pdf2image import convert_from_bytes
-from PIL import Image
-import os
-import uuid
-import json
-
-DOCLING_AVAILABLE = True  # Make sure this is properly managed in your actual code
-
-
-
-
+from pathlib import Path
 
+from django.conf import settings
 
-# def run_layout_aware_ocr(pdf_file_obj, output_dir="output"):
-#     # Convert PDF bytes to PIL Images
-#     images = convert_from_bytes(pdf_file_obj.read())
-#
-#     # Initialize PaddleOCR
-#     ocr = PaddleOCR(use_angle_cls=True, lang='en')
+from . import cpu_budget, rapid_ocr
+from .instrumentation import span
+from .lazy import lazy_import
 
-#     # ✅ Use PaddleDetectionLayoutModel instead of Detectron2
-#     model = lp.PaddleDetectionLayoutModel(
-#         model_path='lp://ppyolov2_r50vd_dcn_365e_publaynet',
-#         label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"},
-#         enforce_cpu=True
-#     )
+# Heavy backends are imported on first use (see lazy.py); Docling is
+# imported inside extract_data_from_pdf.
+fitz = lazy_import("fitz")
+pdfplumber = lazy_import("pdfplumber")
 
-#     os.makedirs(output_dir, exist_ok=True)
-#     final_results = []
+DOCLING_AVAILABLE = importlib.util.find_spec("docling") is not None  # checked without importing it
+RAPIDOCR_AVAILABLE = importlib.util.find_spec("rapidocr") is not None
 
-#     for i, image in enumerate(images):
-#         layout = model.detect(image)
-#         image_results = []
+logger = logging.getLogger(__name__)
 
-#         for block in layout:
-#             if block.type in ["Text", "Title", "List"]:
-#                 segment = image.crop(block.coordinates)
-#                 segment_path = os.path.join(output_dir, f"page_{i+1}_{uuid.uuid4().hex}.png")
-#                 segment.save(segment_path)
 
-#                 result = ocr.ocr(segment_path)
-#                 os.remove(segment_path)
+# A scanned statement is classified from a sample of its pages: after
+# PROBE_SAMPLE_SIZE image-only pages in a row, a text share of at least
+# PROBE_MIN_SHARE would have shown up with PROBE_CONFIDENCE probability.
+PROBE_MIN_SHARE = 0.1
+PROBE_CONFIDENCE = 0.95
+PROBE_SAMPLE_SIZE = math.ceil(math.log(1 - PROBE_CONFIDENCE) / math.log(1 - PROBE_MIN_SHARE))
 
-#                 for line in result:
-#                     for word in line:
-#                         text = word[1][0]
-#                         bbox = word[0]
-#                         image_results.append({
-#                             "text": text,
-#                             "bbox": bbox,
-#                             "block_type": block.type
-#                         })
 
-#         # Save per-page JSON
-#         output_json = os.path.join(output_dir, f"page_{i+1}_layout_ocr.json")
-#         with open(output_json, "w") as f:
-#             json.dump(image_results, f, indent=2)
+class PdfProbe:
+    """
+    Text-versus-image classification of a PDF that looks at as few pages as
+    it can.
+
+        with PdfProbe.open(uploaded_file) as probe:
+            if probe.layout == "scanned":
+                ...
+
+    A page's verdict comes from its resources: fonts mean a text layer,
+    images without fonts mean a scan. Only pages that have both are
+    text-extracted to tell a real text layer from a scan with a stamp or
+    header. Pages are visited first, last, then in a shuffled order. The
+    walk stops as soon as both kinds have been seen ("hybrid"), or after
+    PROBE_SAMPLE_SIZE pages of one kind. The other pages are classified
+    only when verdict() or verdicts() asks for them.
+    """
 
-#         final_results.append(image_results)
-#         print(final_results)
+    TEXT = "text"
+    IMAGE = "image"
+    EMPTY = "empty"
+
+    def __init__(self, doc, text_threshold=50, sample_size=PROBE_SAMPLE_SIZE):
+        self.doc = doc
+        self.text_threshold = text_threshold
+        self._verdicts = {}
+        order = list(range(1, doc.page_count - 1))
+        random.Random(doc.page_count).shuffle(order)
+        self.order = [0] + ([doc.page_count - 1] if doc.page_count > 1 else []) + order
+
+        seen = {self.TEXT: 0, self.IMAGE: 0}
+        for number in self.order:
+            verdict = self.verdict(number)
+            if verdict in seen:
+                seen[verdict] += 1
+            if all(seen.values()) or max(seen.values()) >= sample_size:
+                break
+        self.text_pages, self.image_pages = seen[self.TEXT], seen[self.IMAGE]
+        if self.text_pages and self.image_pages:
+            self.layout = "hybrid"
+        elif self.image_pages:
+            self.layout = "scanned"
+        else:
+            self.layout = "text"
+
+    @classmethod
+    def open(cls, source, **kwargs):
+        """
+        Probes PDF bytes, a file path, a Django upload or any binary file object. Uploads
+        spooled to disk are opened in place and in-memory ones through their
+        buffer, so the PDF is not copied. File objects are rewound afterwards.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            doc = fitz.open(stream=source, filetype="pdf")
+        elif isinstance(source, (str, os.PathLike)):
+            doc = fitz.open(source, filetype="pdf")
+        elif hasattr(source, "temporary_file_path"):
+            doc = fitz.open(source.temporary_file_path(), filetype="pdf")
+        else:
+            raw = getattr(source, "file", source)
+            source.seek(0)
+            data = raw.getbuffer() if hasattr(raw, "getbuffer") else source.read()
+            source.seek(0)
+            doc = fitz.open(stream=data, filetype="pdf")
+        return cls(doc, **kwargs)
+
+    @property
+    def page_count(self):
+        return self.doc.page_count
+
+    @property
+    def sampled(self):
+        return len(self._verdicts)
+
+    def verdict(self, number):
+        """
+        "text", "image" or "empty" (no fonts and no images) for a page.
+        """
+        if number not in self._verdicts:
+            page = self.doc[number]
+            fonts = page.get_fonts()
+            images = page.get_images()
+            if fonts and images:
+                verdict = self.TEXT if len(page.get_text().strip()) >= self.text_threshold else self.IMAGE
+            elif fonts:
+                verdict = self.TEXT
+            else:
+                verdict = self.IMAGE if images else self.EMPTY
+            self._verdicts[number] = verdict
+        return self._verdicts[number]
+
+    def verdicts(self):
+        """
+        (page number, verdict) for every page, classifying each one when it is reached.
+        """
+        for number in range(self.page_count):
+            yield number, self.verdict(number)
+
+    def close(self):
+        self.doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    # return final_results
 
 def is_image_based_pdf(uploaded_file, text_threshold=50):
-    file_buffer = BytesIO(uploaded_file.read())
-    doc = fitz.open(stream=file_buffer, filetype="pdf")
-
-    total_text_chars = 0
-    total_images = 0
-
-    for page in doc:
-        text = page.get_text().strip()
-        total_text_chars += len(text)
-        total_images += len(page.get_images(full=True))
-
-    uploaded_file.seek(0)  # Reset for reuse
-
-    if total_text_chars < text_threshold and total_images > 0:
-        return True  # Likely image-based
-    else:
-        return False  # Likely text-based or hybrid
+    with span("pdf_probe") as s:
+        with PdfProbe.open(uploaded_file, text_threshold=text_threshold) as probe:
+            s.add(pages=probe.page_count, sampled=probe.sampled)
+            return probe.layout == "scanned"
 
 def extract_data_from_pdf_2(uploaded_file_object):
     """
@@ -130,7 +156,7 @@ def extract_data_from_pdf_2(uploaded_file_object):
     Returns:
         Extracted markdown text as string, or None if extraction fails.
     """
-    print("Starting PDF extraction...", uploaded_file_object)
+    logger.info("Starting PDF extraction of %s", uploaded_file_object)
 
     is_image_only = is_image_based_pdf(uploaded_file_object)
 
@@ -138,83 +164,210 @@ def extract_data_from_pdf_2(uploaded_file_object):
         raw_text = extract_data_from_pdf(uploaded_file_object)
     else:
         raw_text = extract_using_pdfplumber(uploaded_file_object)
-    # updated_file_object = enhancement_logic(uploaded_file_object)  # Enhance the PDF if needed (e.g., fix skew)
-    # raw_text =extract_using_pdfplumber(uploaded_file_object)  # Extract text using pdfplumber for initial analysis
-    # if not raw_text:
-    # raw_text = extract_data_from_pdf(uploaded_file_object)  # Call the main extraction function
-    print("raw text :############# \n", raw_text)
-    # extracted_data = BankStatementParser().extract_transactions_gpt(raw_text)  # Use the BankStatementParser to extract transactions
-    # print("Extracted Data:#############", extracted_data)
+    logger.debug("Extracted %d characters of text (image based: %s)", len(raw_text or ""), is_image_only)
     return raw_text
-    # # run_layout_aware_ocr(uploaded_file_object)  # Run OCR on the PDF file
-    # # Save the in-memory uploaded file to a temporary file
+
+def extract_text_from_bytes(file_bytes):
+    """
+    extract_data_from_pdf_2 for raw PDF bytes. Picklable and independent of
+    the Django app registry, so it can run in a spawned worker process
+    (see batch.py and the process_statements command).
+    """
+    return extract_data_from_pdf_2(BytesIO(file_bytes))
+
+
+def extract_text_with(path, file_bytes):
+    """
+    Text of a PDF through one extraction path, 'text' (pdfplumber) or 'ocr'
+    (the OCR_ENGINE, see ocr_pdf), for path_selector. Picklable like
+    extract_text_from_bytes.
+    """
+    if path == "ocr":
+        return extract_data_from_pdf(BytesIO(file_bytes))
+    return extract_using_pdfplumber(BytesIO(file_bytes))
+
 
 def extract_using_pdfplumber(uploaded_file_object):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(uploaded_file_object.read())
-        temp_path = temp_file.name
+    with span("text_extraction") as s:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+            temp_file.write(uploaded_file_object.read())
+            temp_path = temp_file.name
 
-    input_path = Path(temp_path)
-    with pdfplumber.open(input_path) as pdf:
-        text = ""
-        for page in pdf.pages:
-            text += page.extract_text(layout=True) + "\n"
-        print("text from plumber ", text)
-        return text
+        input_path = Path(temp_path)
+        try:
+            with pdfplumber.open(input_path) as pdf:
+                text = ""
+                for page in pdf.pages:
+                    text += page.extract_text(layout=True) + "\n"
+                s.add(pages=len(pdf.pages), bytes=input_path.stat().st_size, characters=len(text))
+                logger.debug("pdfplumber extracted %d characters from %d pages", len(text), len(pdf.pages))
+                return text
+        finally:
+            os.unlink(temp_path)
+
+
+def extract_window_text(path, first, stop, verdicts):
+    """
+    Text of pages [first, stop) of the PDF at ``path`` for page_stream, as
+    (text, scanned pages). ``verdicts`` holds the PdfProbe verdict of each page.
+    Only these pages are loaded. With an OCR engine installed, a window with
+    scanned pages is OCR'd as a whole. Otherwise the scanned pages are
+    returned for the caller to read with vision. Picklable like
+    extract_text_from_bytes; the path keeps the PDF itself out of the pickle.
+    """
+    scanned = [first + i for i, verdict in enumerate(verdicts) if verdict == PdfProbe.IMAGE]
+    if scanned and ocr_available():
+        text = ocr_pdf(Path(path), page_range=(first + 1, stop))
+        if text:
+            return text, []
+
+    with span("text_extraction") as s:
+        parts = []
+        with pdfplumber.open(path, pages=list(range(first + 1, stop + 1))) as pdf:
+            for page, verdict in zip(pdf.pages, verdicts):
+                if verdict == PdfProbe.TEXT:
+                    parts.append(page.extract_text(layout=True) or "")
+                page.close()  # drops the page's parsed objects
+        text = "\n".join(parts)
+        s.add(pages=stop - first, characters=len(text))
+    return text, scanned
+
+
+def ocr_available():
+    """
+    Whether the OCR_ENGINE of this deployment is installed.
+    """
+    return RAPIDOCR_AVAILABLE if settings.OCR_ENGINE == "rapidocr" else DOCLING_AVAILABLE
+
+
+def ocr_pdf(input_path, page_range=None):
+    """
+    Text of the PDF at ``input_path`` from the OCR_ENGINE: Docling's markdown
+    ("docling"), or layout text straight from RapidOCR ("rapidocr", see
+    rapid_ocr.py). None if extraction fails. ``page_range`` is as for
+    convert_with_docling.
+    """
+    if settings.OCR_ENGINE == "rapidocr":
+        return rapid_ocr.extract_text(input_path, page_range=page_range)
+    return convert_with_docling(input_path, page_range=page_range)
 
 
 def extract_data_from_pdf(uploaded_file_object):
     """
-    Extracts data from the uploaded PDF file using Docling and RapidOCR.
+    Extracts data from the uploaded PDF file with the OCR_ENGINE (Docling or RapidOCR).
     Args:
         uploaded_file_object: An in-memory file object from Django's request.FILES.
     Returns:
         Extracted markdown text as string, or None if extraction fails.
     """
-    print("Starting PDF extraction...", uploaded_file_object)
+    logger.info("Starting OCR extraction of %s", uploaded_file_object)
+    # Save the in-memory uploaded file to a temporary file
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        temp_file.write(uploaded_file_object.read())
+        temp_path = temp_file.name
     try:
-        # Save the in-memory uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(uploaded_file_object.read())
-            temp_path = temp_file.name
+        return ocr_pdf(Path(temp_path))
+    finally:
+        os.unlink(temp_path)
+
+
+_docling_converter = None
+_docling_build_lock = threading.Lock()
+# One conversion at a time per process: a DocumentConverter is not meant to
+# be shared between threads, and its models already use every core.
+_docling_lock = threading.Lock()
 
-        input_path = Path(temp_path)
-        suffix = input_path.suffix.lower()
-        format_options = {}
-        input_format = None
-        pipeline_options_instance = None
 
-        if suffix == '.pdf':
-            input_format = InputFormat.PDF
+def get_docling_converter():
+    """
+    The process's Docling DocumentConverter for PDFs with RapidOCR. Its layout,
+    table-structure and OCR models are loaded once and kept for the life of
+    the process rather than per document. ONNX Runtime and torch run them
+    on cpu_budget.threads_per_task() threads.
+    """
+    global _docling_converter
+    with _docling_build_lock:
+        if _docling_converter is None:
+            # --- Docling is only needed for image based PDFs; import it here ---
+            from docling.datamodel.base_models import InputFormat
+            from docling.datamodel.pipeline_options import AcceleratorOptions, PdfPipelineOptions, RapidOcrOptions
+            from docling.document_converter import DocumentConverter, PdfFormatOption
+
             pipeline_options_instance = PdfPipelineOptions()
-            format_options[InputFormat.PDF] = PdfFormatOption(pipeline_options=pipeline_options_instance)
-            print(f"Detected PDF input: {input_path}", file=sys.stderr)
-        else:
-            print(f"Unsupported file format: {suffix}", file=sys.stderr)
-            return None
+            pipeline_options_instance.do_ocr = True
+            pipeline_options_instance.do_table_structure = True
+            pipeline_options_instance.accelerator_options = AcceleratorOptions(
+                num_threads=cpu_budget.threads_per_task(), device="cpu",
+            )
+
+            if hasattr(pipeline_options_instance, 'table_structure_options') and pipeline_options_instance.table_structure_options is not None:
+                pipeline_options_instance.table_structure_options.do_cell_matching = True
 
-        pipeline_options_instance.do_ocr = True
-        pipeline_options_instance.do_table_structure = True
+            ocr_options = RapidOcrOptions(force_full_page_ocr=False)
+            pipeline_options_instance.ocr_options = ocr_options
 
-        if hasattr(pipeline_options_instance, 'table_structure_options') and pipeline_options_instance.table_structure_options is not None:
-            pipeline_options_instance.table_structure_options.do_cell_matching = True
+            format_options = {InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options_instance)}
+            _docling_converter = DocumentConverter(format_options=format_options)
+        return _docling_converter
 
-        ocr_options = RapidOcrOptions(force_full_page_ocr=False)
-        pipeline_options_instance.ocr_options = ocr_options
 
-        converter = DocumentConverter(format_options=format_options)
-        conversion_result = converter.convert(input_path)
-        doc = conversion_result.document
+def preload_ocr_models():
+    """
+    Loads the PDF libraries and, when the OCR_ENGINE is installed, its models
+    right away. Servers that fork workers after loading the app call this in the
+    parent (see gunicorn.conf.py), so the workers share one copy of the models
+    copy-on-write instead of loading one each. Returns what was loaded.
+    """
+    loaded = []
+    for name in ("fitz", "pdfplumber", "numpy", "cv2"):
+        if importlib.util.find_spec(name) is not None:
+            importlib.import_module(name)
+            loaded.append(name)
+    if settings.OCR_ENGINE == "rapidocr":
+        if RAPIDOCR_AVAILABLE:
+            with span("ocr_preload"):
+                rapid_ocr.preload()
+            loaded.append("rapidocr")
+    elif DOCLING_AVAILABLE:
+        from docling.datamodel.base_models import InputFormat
+
+        with span("ocr_preload"):
+            get_docling_converter().initialize_pipeline(InputFormat.PDF)
+        loaded.append("docling")
+    return loaded
+
+
+def convert_with_docling(input_path, page_range=None):
+    """
+    Markdown of the PDF at ``input_path`` from Docling and RapidOCR, or None
+    if extraction fails. ``page_range`` (first, last), 1-based and inclusive,
+    converts only those pages.
+    """
+    try:
+        suffix = input_path.suffix.lower()
+        if suffix != '.pdf':
+            logger.error("Unsupported file format: %s", suffix)
+            return None
+        logger.debug("Detected PDF input: %s", input_path)
+        converter = get_docling_converter()
+
+        with _docling_lock, span("ocr", bytes=input_path.stat().st_size) as s:
+            if page_range:
+                conversion_result = converter.convert(input_path, page_range=page_range)
+            else:
+                conversion_result = converter.convert(input_path)
+            doc = conversion_result.document
+            s.add(pages=len(getattr(doc, "pages", None) or ()))
 
         if doc:
             # print(f"Docling extracted data \n", doc.export_to_markdown())
             return doc.export_to_markdown()
         else:
-            print("Docling returned empty document.", file=sys.stderr)
+            logger.warning("Docling returned empty document.")
             return None
 
     except Exception as e:
-        print(f"Error in PDF extraction: {e}", file=sys.stderr)
+        logger.exception("Error in PDF extraction: %s", e)
         return None
 
 
@@ -276,7 +429,7 @@ def clean_and_structure_data(raw_text_data):
 
     lines = raw_text_data.strip().split('\n')
     if len(lines) <= 1: # Only header or no data
-        print("Cleaner: Not enough lines to process.")
+        logger.debug("Cleaner: Not enough lines to process.")
         return []
         
     # Dynamically find header, assuming first non-empty line is header
@@ -289,14 +442,14 @@ def clean_and_structure_data(raw_text_data):
             break
     
     if not header_line:
-        print("Cleaner: No header line found.")
+        logger.debug("Cleaner: No header line found.")
         return []
 
     # Normalize header names (example: "Date", "Transaction Details", "Withdrawals", "Deposits", "Running Balance")
     # This part is VERY bank-specific and needs robust parsing.
     # For simplicity, assuming CSV-like structure from the dummy data.
     header = [h.strip().lower() for h in header_line.split(',')]
-    print(f"Cleaner: Detected Headers: {header}")
+    logger.debug(f"Cleaner: Detected Headers: {header}")
 
     # --- YOUR DATA CLEANING AND STRUCTURING LOGIC HERE ---
     # This needs to be robust to handle variations in PDF text output.
@@ -305,7 +458,7 @@ def clean_and_structure_data(raw_text_data):
     expected_headers = ['date', 'description', 'debit', 'credit', 'balance'] # Adjust to your actual needs
     # Simple check if essential headers are present
     if not all(eh in header for eh in ['date', 'balance']): # At least date and balance should be there
-        print(f"Cleaner: Essential headers ('date', 'balance') not found in {header}")
+        logger.debug(f"Cleaner: Essential headers ('date', 'balance') not found in {header}")
         # return [] # Or try to infer columns
 
     for line_number, line_content in enumerate(lines[data_lines_start_index:], start=data_lines_start_index):
@@ -340,16 +493,16 @@ def clean_and_structure_data(raw_text_data):
                 
                 # A basic validation: if running_balance is crucial and missing, skip
                 if 'running_balance' not in transaction_dict and not transaction.get('running_balance'):
-                    print(f"Cleaner: Skipping row due to missing balance: {line_content}")
+                    logger.debug(f"Cleaner: Skipping row due to missing balance: {line_content}")
                     continue
 
                 transactions.append(transaction)
             except ValueError as e:
-                print(f"Cleaner: Skipping row due to data conversion error: '{line_content}' - {e}")
+                logger.debug(f"Cleaner: Skipping row due to data conversion error: '{line_content}' - {e}")
             except IndexError:
-                print(f"Cleaner: Skipping row due to column mismatch: '{line_content}'")
+                logger.debug(f"Cleaner: Skipping row due to column mismatch: '{line_content}'")
         else:
-            print(f"Cleaner: Skipping row due to unexpected number of columns: '{line_content}' (expected {len(header)}, got {len(values)})")
+            logger.debug(f"Cleaner: Skipping row due to unexpected number of columns: '{line_content}' (expected {len(header)}, got {len(values)})")
             
-    print(f"Cleaner: Structured {len(transactions)} transactions.")
+    logger.debug(f"Cleaner: Structured {len(transactions)} transactions.")
     return transactions
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""
+The statement analysis pipeline without request objects.
+
+    text = extract_text(file_bytes)             # PDF probe, pdfplumber or OCR
+    data = extract_statement(text)              # LLM: account info + transactions
+                                                # (stream_statement: row by row)
+    data = analyze_document(file_bytes)         # both, on the path path_selector picks
+    statement = store_statement(file_bytes, data, filename)
+    statement = analyze_and_store(file_bytes, filename)
+                                                # all of it; very large statements
+                                                # go through page_stream
+
+Used by the upload view, bulk uploads (batch.py) and the offline
+process_statements management command.
+"""
+import logging
+from contextlib import nullcontext
+
+from django.conf import settings
+from pymongo import errors as pymongo_errors
+
+from . import cpu_budget, mongo_store, page_stream, path_selector, pdf_extractor, statement_store, transaction_verifier
+from .data_extractor import BankStatementParser
+from .instrumentation import span
+from .llm_router import get_router
+
+logger = logging.getLogger(__name__)
+
+
+def extract_text(file_bytes):
+    """
+    Raw text of a PDF. Process pools should submit
+    pdf_extractor.extract_text_from_bytes directly: importing this module
+    needs the Django app registry.
+    """
+    return pdf_extractor.extract_text_from_bytes(file_bytes)
+
+
+def analyze_document(file_bytes, offload=None, llm_gate=None):
+    """
+    extract_text + extract_statement in one step. With PIPELINE_SELECTOR=adaptive,
+    path_selector picks the extraction path (text layer, OCR or vision) and
+    falls back to another one when it fails or gives no readable rows.
+    ``offload(fn, *args)`` runs the CPU-bound text extraction (by default in a
+    CPU slot, see cpu_budget.py) and ``llm_gate`` is held around the LLM
+    calls; see batch.py.
+    """
+    if settings.PIPELINE_SELECTOR == 'adaptive':
+        return path_selector.analyze(file_bytes, offload=offload, llm_gate=llm_gate)
+    text = (offload or cpu_budget.run)(pdf_extractor.extract_text_from_bytes, file_bytes)
+    with (llm_gate or nullcontext)():
+        return extract_statement(text)
+
+
+def analyze_and_store(file_bytes, filename='', offload=None, llm_gate=None):
+    """
+    analyze_document + store_statement. Statements of PAGE_STREAM_MIN_PAGES
+    pages or more are processed and stored a window of pages at a time by
+    page_stream, so their size does not decide the memory needed.
+    Returns the ExtractedStatement, or None if nothing was extracted.
+    """
+    if settings.PAGE_STREAM_MIN_PAGES and page_stream.page_count(file_bytes) >= settings.PAGE_STREAM_MIN_PAGES:
+        return page_stream.process_document(file_bytes, filename, offload=offload, llm_gate=llm_gate)
+    extracted_data = analyze_document(file_bytes, offload=offload, llm_gate=llm_gate)
+    if not extracted_data:
+        return None
+    return store_statement(file_bytes, extracted_data, filename=filename)
+
+
+def extract_statement(text, parser=None):
+    """
+    {'account_info': ..., 'transactions': [...]} from the raw text, or None.
+    Without a parser the provider is picked by llm_router when LLM_ROUTING is 'auto'.
+    """
+    if not text:
+        return None
+    if parser is None and settings.LLM_ROUTING == 'auto':
+        return get_router().extract(text)
+    return (parser or BankStatementParser()).extract__from_text_transactions_gpt(text)
+
+
+def stream_statement(text, parser=None):
+    """
+    extract_statement with the LLM answer streamed: yields ('account_info', dict)
+    and ('transaction', dict) as they are parsed, then ('done', statement or None).
+    """
+    if not text:
+        return iter([('done', None)])
+    if parser is None and settings.LLM_ROUTING == 'auto':
+        return get_router().stream(text)
+    return (parser or BankStatementParser()).stream_transactions_gpt(text)
+
+
+def persist_extracted_statement(file_bytes, extracted_data, filename=None, doc_hash=None):
+    """
+    Stores the extracted statement in MongoDB. Failures are logged and ignored,
+    the analysis flow does not depend on the database being reachable; the
+    write is bounded by mongo_store.request_timeout, as the upload waits for it.
+    """
+    try:
+        doc_hash = doc_hash or mongo_store.document_hash(file_bytes)
+        with mongo_store.request_timeout():
+            mongo_store.save_statement(
+                doc_hash,
+                extracted_data.get('account_info', {}),
+                extracted_data.get('transactions', []),
+                filename=filename,
+            )
+        return doc_hash
+    except pymongo_errors.PyMongoError as err:
+        logger.warning("MongoDB write failed: %s", err)
+    except Exception as e:
+        logger.exception("An unexpected error occurred while storing the statement: %s", e)
+    return None
+
+
+def store_statement(file_bytes, extracted_data, filename=''):
+    """
+    Persists an extracted statement to MongoDB and the chunked statement
+    store. Returns the ExtractedStatement.
+    """
+    transactions = extracted_data.get('transactions', [])
+    with span("storage", rows=len(transactions), bytes=len(file_bytes)):
+        doc_hash = persist_extracted_statement(file_bytes, extracted_data, filename=filename)
+        return statement_store.create_statement(
+            extracted_data.get('account_info', {}),
+            transactions,
+            file_bytes=file_bytes,
+            filename=filename,
+            document_hash=doc_hash or mongo_store.document_hash(file_bytes),
+        )
+
+
+def count_mismatches(statement):
+    """
+    Number of rows of a stored statement that fail the running-balance check.
+    """
+    table, _ = statement_store.load_table(statement)
+    return len(transaction_verifier.verify_table(table))
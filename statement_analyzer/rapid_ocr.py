@@ -0,0 +1,442 @@
+"""
+Lightweight OCR for scanned statements (OCR_ENGINE=rapidocr).
+
+Docling runs layout analysis and table-structure recognition on every page
+and exports markdown, only for the text to go to the LLM. A statement is
+mostly one transaction table, so this engine skips both:
+
+- every page is rendered at OCR_DPI and RapidOCR's text detector finds the
+  text lines on a copy scaled down to OCR_DETECT_SIDE pixels;
+- with OCR_ROI, only the lines of the transaction table, and on the first
+  page the account header block above it, are recognized (find_lines).
+  The table is the longest run of rows of several lines each, found from the
+  boxes alone. Its column edges identify the bank template, whose table
+  region is cached (learn_layout): the later pages of its statements are
+  detected within that region only, and the whole page again only when the
+  table no longer fits it;
+- the lines of many pages are cropped and recognized together. The
+  recognizer sorts lines by width and pads each batch of OCR_REC_BATCH to
+  its widest, so a larger pool gives batches of more even widths, and there
+  is no short batch at the end of every page;
+- rows are rebuilt from the box coordinates. Lines at the same level form a
+  row, once the page's skew is taken out, and each line starts at a column
+  proportional to its x position, like pdfplumber's layout text.
+
+The engine is built once per process (get_engine), with ONNX Runtime on
+cpu_budget.threads_per_task() threads.
+"""
+import logging
+import threading
+from statistics import median
+
+from django.conf import settings
+
+from . import cpu_budget
+from .instrumentation import OCR_TABLE_REGIONS, span
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+fitz = lazy_import('fitz')
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+MIN_SCORE = 0.5  # recognized lines below this confidence are dropped, as RapidOCR itself does
+ROW_TOLERANCE = 0.5  # lines whose levels differ by less than this share of their height are one row
+# Lines waiting for recognition; bounds the memory held by crops on long documents.
+MAX_PENDING_LINES = 512
+TABLE_MIN_ROWS = 3  # rows of two or more lines that make a transaction table
+TABLE_MAX_GAP = 2  # one-line rows in a row that a table may span
+COLUMN_TOLERANCE = 0.01  # share of the page width by which a template's column edges may differ
+ROI_MARGIN = 0.03  # share of the page added around a template's table region
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    The process's RapidOCR engine, built on first use. The angle classifier
+    is off, as statement lines are horizontal. Detecting on the page scaled
+    down to OCR_DETECT_SIDE finds the same lines several times faster than
+    on the full rendering, which the lines are still cropped from.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            from rapidocr import RapidOCR
+
+            threads = cpu_budget.threads_per_task()
+            _engine = RapidOCR(params={
+                'Global.use_cls': False,
+                'Det.limit_type': 'max',
+                'Det.limit_side_len': settings.OCR_DETECT_SIDE,
+                'Rec.rec_batch_num': settings.OCR_REC_BATCH,
+                'EngineConfig.onnxruntime.intra_op_num_threads': threads,
+                'EngineConfig.onnxruntime.inter_op_num_threads': threads,
+            })
+        return _engine
+
+
+def preload():
+    """
+    Builds the engine and loads its detection and recognition models now rather than on the first page.
+    """
+    engine = get_engine()
+    _model(engine, 'det')
+    _model(engine, 'rec')
+
+
+def render_page(page, dpi):
+    """
+    A page as a BGR array, the layout RapidOCR expects from cv2.imread.
+    """
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    image = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, 3)
+    return np.ascontiguousarray(image[:, :, ::-1])
+
+
+def crop_line(image, box):
+    """
+    The text line inside ``box`` (four corners, clockwise from top left),
+    straightened with a perspective transform.
+    """
+    box = np.asarray(box, dtype=np.float32)
+    width = int(max(np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[2] - box[3])))
+    height = int(max(np.linalg.norm(box[0] - box[3]), np.linalg.norm(box[1] - box[2])))
+    target = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    crop = cv2.warpPerspective(image, cv2.getPerspectiveTransform(box, target), (max(width, 1), max(height, 1)),
+                               borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC)
+    if height >= width * 1.5:
+        crop = np.rot90(crop)
+    return crop
+
+
+def _model(engine, name):
+    # rapidocr 3.x builds its models on first use; earlier releases in __init__.
+    load = getattr(engine, f'_load_{name}_model', None)
+    return load() if load else getattr(engine, f'text_{name}')
+
+
+def detect(engine, image, region=None):
+    """
+    Boxes of the text lines on a page, each four (x, y) corners. The page is
+    scaled down to OCR_DETECT_SIDE pixels for the detector. ``region`` (x0,
+    y0, x1, y1 in pixels) limits detection to that part of the page, scaled
+    as the whole page would be, so it costs only its share of the page.
+    """
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = region or (0, 0, width, height)
+    scale = min(1.0, settings.OCR_DETECT_SIDE / max(height, width))
+    part = image[y0:y1, x0:x1]
+    if scale < 1:
+        part = cv2.resize(part, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    boxes = _model(engine, 'det')(part).boxes
+    if boxes is None:
+        return []
+    return [[[x / scale + x0, y / scale + y0] for x, y in box] for box in boxes.tolist()]
+
+
+def recognize(engine, crops):
+    """
+    (text, score) for each cropped line; ONNX Runtime sees them OCR_REC_BATCH at a time.
+    """
+    from rapidocr.ch_ppocr_rec import TextRecInput
+
+    if not crops:
+        return []
+    result = _model(engine, 'rec')(TextRecInput(img=crops))
+    return list(zip(result.txts or (), result.scores or ()))
+
+
+def _item(box, payload):
+    """
+    (x0, x1, y, height, payload) of a line from its box; y is the middle of the line.
+    """
+    xs, ys = [x for x, _ in box], [y for _, y in box]
+    return min(xs), max(xs), (min(ys) + max(ys)) / 2, max(ys) - min(ys), payload
+
+
+def _skew(lines):
+    """
+    The page's skew as a slope: the median slope from each line to the
+    nearest line on its right at about the same height. The detector's boxes
+    are upright even on a tilted scan, so the tilt shows only in how the
+    lines of a row drift across the page.
+    """
+    slopes = []
+    for x0, x1, y, height, _ in lines:
+        neighbours = [(nx0 - x1, ny, (nx0 + nx1) / 2) for nx0, nx1, ny, _, _ in lines
+                      if nx0 > x1 and abs(ny - y) < height / 2]
+        if neighbours:
+            _, ny, nx = min(neighbours)
+            slopes.append((ny - y) / (nx - (x0 + x1) / 2))
+    return median(slopes) if slopes else 0.0
+
+
+def _group_rows(items, slope):
+    """
+    [level, height, items] of each row, top to bottom. Lines whose levels
+    (their heights with the skew taken out) are within ROW_TOLERANCE of a
+    line height form a row.
+    """
+    rows = []
+    for item in sorted(items, key=lambda item: item[2] - slope * item[0]):
+        level = item[2] - slope * item[0]  # the line's height with the skew taken out
+        if rows and abs(level - rows[-1][0]) <= ROW_TOLERANCE * min(item[3], rows[-1][1]):
+            row = rows[-1]
+            row[2].append(item)
+            row[0] += (level - row[0]) / len(row[2])
+            row[1] = max(row[1], item[3])
+        else:
+            rows.append([level, item[3], [item]])
+    return rows
+
+
+def layout_text(lines):
+    """
+    The text of one page from its recognized lines, (box, text) pairs, one
+    row per output line with the columns kept aligned.
+    """
+    items = [_item(box, text.strip()) for box, text in lines if text.strip()]
+    if not items:
+        return ''
+    char_width = median((x1 - x0) / len(text) for x0, x1, _, _, text in items) or 1.0
+    left = min(item[0] for item in items)
+
+    text_rows = []
+    for _, _, row in _group_rows(items, _skew(items)):
+        line = ''
+        for x0, _, _, _, text in sorted(row):
+            column = round((x0 - left) / char_width)
+            line = line.ljust(column if column > len(line) else len(line) + (1 if line else 0)) + text
+        text_rows.append(line)
+    return '\n'.join(text_rows)
+
+
+def _find_table(rows):
+    """
+    (first, last) indices of the transaction table among a page's rows, or
+    None: the longest run of at least TABLE_MIN_ROWS rows of two or more
+    lines, bridging up to TABLE_MAX_GAP one-line rows (details wrapped onto
+    the next line). One-line rows right after it join it too while they are
+    indented past its first column, as the last wrapped details are.
+    """
+    best, start, count, gap = (0, 0, 0), None, 0, 0
+    for index, (_, _, items) in enumerate(rows):
+        if len(items) >= 2:
+            if start is None:
+                start, count = index, 0
+            count, gap = count + 1, 0
+            best = max(best, (count, start, index))
+        elif start is not None:
+            gap += 1
+            if gap > TABLE_MAX_GAP:
+                start = None
+    count, first, last = best
+    if count < TABLE_MIN_ROWS:
+        return None
+    left = min(item[0] for _, _, items in rows[first:last + 1] for item in items)
+    pitch = _pitch(rows[first:last + 1])
+    while (last + 1 < len(rows) and len(rows[last + 1][2]) == 1 and rows[last + 1][0] - rows[last][0] <= 1.5 * pitch
+           and rows[last + 1][2][0][0] > left + rows[last + 1][1]):
+        last += 1
+    return first, last
+
+
+def _pitch(rows):
+    return median(below[0] - above[0] for above, below in zip(rows, rows[1:]))
+
+
+def _bounds(rows):
+    items = [item for _, _, row in rows for item in row]
+    return (min(item[0] for item in items), min(item[2] - item[3] / 2 for item in items),
+            max(item[1] for item in items), max(item[2] + item[3] / 2 for item in items))
+
+
+def _columns(rows, slope, width):
+    """
+    The column edges of a table, which identify its bank template: the left
+    and right ends of lines, skew taken out, that line up in at least half
+    of its rows. Shares of the page width from the leftmost edge; None if no
+    column lines up.
+    """
+    rows = [row for _, _, row in rows if len(row) >= 2]
+    tolerance = median(item[3] for row in rows for item in row)
+    edges = []
+    for end in (0, 1):
+        clusters = []
+        for x in sorted(item[end] + slope * item[2] for row in rows for item in row):
+            if clusters and x - clusters[-1][-1] <= tolerance:
+                clusters[-1].append(x)
+            else:
+                clusters.append([x])
+        edges.append([median(cluster) for cluster in clusters if 2 * len(cluster) >= len(rows)])
+    if not edges[0]:
+        return None
+    origin = edges[0][0]
+    return tuple(tuple(round((x - origin) / width, 4) for x in side) for side in edges)
+
+
+class TemplateLayout:
+    """
+    What was learned about one bank template: its column edges and the part
+    of the page (x0, y0, x1, y1, as shares of the page) its transaction table
+    has covered so far.
+    """
+
+    def __init__(self, columns, bounds):
+        self.columns = columns
+        self.bounds = bounds
+
+    def matches(self, columns):
+        return all(len(ours) == len(theirs) and all(abs(a - b) <= COLUMN_TOLERANCE for a, b in zip(ours, theirs))
+                   for ours, theirs in zip(self.columns, columns))
+
+    def widen(self, bounds):
+        with _layouts_lock:
+            self.bounds = (min(self.bounds[0], bounds[0]), min(self.bounds[1], bounds[1]),
+                           max(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3]))
+
+    def region(self, width, height):
+        """
+        The table region in pixels of a page this size, with ROI_MARGIN around it.
+        """
+        x0, y0, x1, y1 = self.bounds
+        return (max(0, int((x0 - ROI_MARGIN) * width)), max(0, int((y0 - ROI_MARGIN) * height)),
+                min(width, int((x1 + ROI_MARGIN) * width) + 1), min(height, int((y1 + ROI_MARGIN) * height) + 1))
+
+
+_layouts = []  # TemplateLayouts, most recently used first
+_layouts_lock = threading.Lock()
+
+
+def learn_layout(columns, bounds):
+    """
+    The cached TemplateLayout with these column edges, its region widened to
+    ``bounds``; a new one, cached in place of the least recently used past
+    OCR_LAYOUT_CACHE, if no template matches.
+    """
+    with _layouts_lock:
+        layout = next((layout for layout in _layouts if layout.matches(columns)), None)
+        if layout is None:
+            layout = TemplateLayout(columns, bounds)
+        else:
+            _layouts.remove(layout)
+        _layouts.insert(0, layout)
+        del _layouts[settings.OCR_LAYOUT_CACHE:]
+    layout.widen(bounds)
+    return layout
+
+
+def _rows(boxes):
+    items = [_item(box, box) for box in boxes]
+    slope = _skew(items)
+    return _group_rows(items, slope), slope
+
+
+def _fits(rows, region, width, height):
+    """
+    Whether a table found in ``region`` keeps clear of its edges (those
+    inside the page) by more than the space between two rows: a table that
+    runs on past the region ends with a line cut at its edge, or with a row
+    that the next one would have followed inside the region.
+    """
+    x0, y0, x1, y1 = _bounds(rows)
+    left, top, right, bottom = region
+    line = median(row[1] for row in rows)
+    margin = max(_pitch(rows) - line, line / 2)
+    return ((left == 0 or x0 - left >= margin) and (top == 0 or y0 - top >= margin)
+            and (right == width or right - x1 >= margin) and (bottom == height or bottom - y1 >= margin))
+
+
+def find_lines(engine, image, layout=None, header=False):
+    """
+    (boxes, skipped, layout): the lines of a page to recognize, how many
+    detected lines were left out, and the TemplateLayout of the statement.
+
+    With OCR_ROI, only the transaction table is kept, and on the statement's
+    first page (``header``) the account header block above it; letterheads
+    on later pages, adverts and legal footers are not recognized. Pass the
+    ``layout`` returned for an earlier page of the statement: lines are then
+    detected only in its table region. The whole page is detected when
+    there is no layout yet, or the table does not fit the region, and the
+    table found teaches the template's region.
+    """
+    if not settings.OCR_ROI:
+        return detect(engine, image), 0, None
+    height, width = image.shape[:2]
+    if layout is not None and not header:
+        region = layout.region(width, height)
+        boxes = detect(engine, image, region)
+        rows, _ = _rows(boxes)
+        table = _find_table(rows)
+        if table and _fits(rows[table[0]:table[1] + 1], region, width, height):
+            OCR_TABLE_REGIONS.inc(result='hit')
+            kept = _kept(rows, table, header)
+            return kept, len(boxes) - len(kept), layout
+        OCR_TABLE_REGIONS.inc(result='stale')
+    else:
+        OCR_TABLE_REGIONS.inc(result='miss')
+
+    boxes = detect(engine, image)
+    rows, slope = _rows(boxes)
+    table = _find_table(rows)
+    if table is None:
+        return boxes, 0, layout
+    first, last = table
+    x0, y0, x1, y1 = _bounds(rows[first:last + 1])
+    bounds = (x0 / width, y0 / height, x1 / width, y1 / height)
+    if layout is not None:
+        layout.widen(bounds)
+    else:
+        columns = _columns(rows[first:last + 1], slope, width)
+        if columns is not None:
+            layout = learn_layout(columns, bounds)
+    kept = _kept(rows, table, header)
+    return kept, len(boxes) - len(kept), layout
+
+
+def _kept(rows, table, header):
+    return [item[4] for _, _, row in rows[0 if header else table[0]:table[1] + 1] for item in row]
+
+
+def extract_text(input_path, page_range=None):
+    """
+    Layout text of the PDF at ``input_path``, or None if OCR fails.
+    ``page_range`` (first, last), 1-based and inclusive, reads only those
+    pages, as for pdf_extractor.convert_with_docling.
+    """
+    try:
+        engine = get_engine()
+        with fitz.open(input_path) as doc:
+            first, last = page_range or (1, doc.page_count)
+            numbers = range(first - 1, min(last, doc.page_count))
+            page_lines = {number: [] for number in numbers}
+            pending = []  # (page number, box, crop) waiting for recognition
+            layout = None
+
+            def flush():
+                with span('ocr_recognition', lines=len(pending)):
+                    results = recognize(engine, [crop for _, _, crop in pending])
+                for (number, box, _), (text, score) in zip(pending, results):
+                    if score >= MIN_SCORE:
+                        page_lines[number].append((box, text))
+                pending.clear()
+
+            with span('ocr', pages=len(numbers)):
+                for number in numbers:
+                    with span('ocr_detection') as s:
+                        image = render_page(doc[number], settings.OCR_DPI)
+                        boxes, skipped, layout = find_lines(engine, image, layout, header=number == 0)
+                        pending.extend((number, box, crop_line(image, box)) for box in boxes)
+                        s.add(lines=len(boxes), skipped=skipped)
+                    del image
+                    if len(pending) >= MAX_PENDING_LINES:
+                        flush()
+                if pending:
+                    flush()
+                return '\n'.join(layout_text(page_lines[number]) for number in numbers)
+    except Exception as e:
+        logger.exception("Error in RapidOCR extraction: %s", e)
+        return None
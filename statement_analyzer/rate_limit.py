@@ -0,0 +1,391 @@
+"""
+Rate limiting, retries and hedged requests for LLM calls.
+
+ResilientBackend wraps another LLMBackend (see llm_backends.build_llm_backend):
+
+- Before each call it takes one request and the estimated tokens from the
+  provider's requests-per-minute and tokens-per-minute buckets. The buckets
+  live in a small SQLite file (LLM_RATE_LIMIT_DB), so every worker process
+  on the host draws from the same budget instead of each bursting into 429s.
+- 429, 5xx, timeouts and connection errors are retried with exponential
+  backoff and full jitter, honouring Retry-After up to the backoff cap. The
+  tokens of a failed attempt go back to the bucket; the request still
+  counts, as it does at the provider. When the attempts run out,
+  LLMUnavailableError is raised instead of an empty result.
+- With LLM_HEDGE on, a call still running after the model's recent p95
+  latency gets one duplicate request if the buckets allow it, and the first
+  answer wins. Only the first request's own latency is recorded, so hedging
+  does not pull the p95 down and trigger ever more hedges.
+"""
+import logging
+import math
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from django.conf import settings
+
+from .instrumentation import LLM_HEDGES, LLM_RATE_LIMIT_WAIT, LLM_RETRIES
+from .llm_backends import LLMBackend, LLMUnavailableError, is_gemini_model, messages_to_text
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504})
+# Exceptions without an HTTP status that are still worth retrying (openai, google-api-core).
+RETRYABLE_ERRORS = frozenset({
+    'APIConnectionError', 'APITimeoutError', 'ServiceUnavailable', 'DeadlineExceeded', 'ResourceExhausted',
+    'InternalServerError', 'TooManyRequests',
+})
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1000
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    Tokens a call may use, the way providers count them against TPM:
+    the prompt plus the completion allowance.
+    """
+    images = sum(
+        1
+        for message in messages if not isinstance(message['content'], str)
+        for part in message['content'] if part.get('type') == 'image_url'
+    )
+    prompt = len(messages_to_text(messages)) // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+    return prompt + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+def status_code(error):
+    for attr in ('status_code', 'code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(error):
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in RETRYABLE_ERRORS or isinstance(error, (ConnectionError, TimeoutError))
+
+
+def retry_after(error):
+    """
+    Seconds from the Retry-After header of a failed HTTP call, if any.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    try:
+        return float(headers.get('retry-after')) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base, cap, rng=random):
+    """
+    Exponential backoff with full jitter: uniform in [0, min(cap, base * 2**attempt)].
+    """
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucketStore:
+    """
+    Token buckets in a SQLite table. Each bucket refills continuously at its
+    rate per minute and holds at most ``burst_seconds`` worth of it, so a cold
+    start cannot spend a whole minute of budget at once. BEGIN IMMEDIATE
+    serialises concurrent takers across processes.
+    """
+
+    def __init__(self, path, burst_seconds=10):
+        self.path = path
+        self.burst_seconds = burst_seconds
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            self._local.connection = connection
+        return connection
+
+    def capacity(self, per_minute):
+        return max(1.0, per_minute * self.burst_seconds / 60)
+
+    def _update(self, limits, take):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = {}
+            shortfall = 0.0
+            for name, per_minute, amount in limits:
+                capacity = self.capacity(per_minute)
+                row = connection.execute('SELECT level, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * per_minute / 60)
+                if not take:
+                    level = min(capacity, level + amount)
+                elif level < min(amount, capacity):
+                    # A call larger than the bucket only waits for a full one, then leaves it in debt.
+                    shortfall = max(shortfall, (min(amount, capacity) - level) * 60 / per_minute)
+                levels[name] = level
+            if take and not shortfall:
+                for name, _, amount in limits:
+                    levels[name] -= amount
+            connection.executemany(
+                'INSERT INTO buckets (name, level, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET level = excluded.level, updated = excluded.updated',
+                [(name, level, now) for name, level in levels.items()],
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return shortfall
+
+    def take(self, limits):
+        """
+        Takes every (name, per_minute, amount) at once, or nothing.
+        Returns 0 on success, otherwise the seconds until all of them fit.
+        """
+        return self._update(limits, take=True)
+
+    def give(self, limits):
+        """
+        Returns amounts to their buckets (negative amounts take more).
+        """
+        self._update(limits, take=False)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute for each provider ('openai', 'gemini').
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(self, store, rpm, tpm):
+        self.store = store
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def _limits(self, provider, tokens):
+        limits = []
+        if self.rpm.get(provider):
+            limits.append((f'{provider}:requests', self.rpm[provider], 1))
+        if self.tpm.get(provider):
+            limits.append((f'{provider}:tokens', self.tpm[provider], tokens))
+        return limits
+
+    def try_acquire(self, provider, tokens):
+        limits = self._limits(provider, tokens)
+        return not limits or self.store.take(limits) == 0
+
+    def acquire(self, provider, tokens, max_wait):
+        """
+        Blocks until the call fits the provider's limits. Raises
+        LLMUnavailableError if that would take longer than ``max_wait`` seconds.
+        """
+        limits = self._limits(provider, tokens)
+        if not limits:
+            return 0.0
+        start = time.monotonic()
+        while True:
+            shortfall = self.store.take(limits)
+            waited = time.monotonic() - start
+            if not shortfall:
+                LLM_RATE_LIMIT_WAIT.observe(waited, provider=provider)
+                return waited
+            if waited + shortfall > max_wait:
+                raise LLMUnavailableError(
+                    f"{provider} rate limit: no capacity for {tokens} tokens within {max_wait:.0f}s."
+                )
+            # Jitter so processes woken together do not retry in lockstep.
+            time.sleep(shortfall + random.uniform(0, 0.05))
+
+    def settle(self, provider, estimated, actual):
+        """
+        Corrects the token bucket once the real usage of a call is known.
+        """
+        if self.tpm.get(provider) and actual and actual != estimated:
+            self.store.give([(f'{provider}:tokens', self.tpm[provider], estimated - actual)])
+
+    def refund(self, provider, estimated):
+        """
+        Gives back the tokens taken for a call that failed.
+        """
+        if self.tpm.get(provider):
+            self.store.give([(f'{provider}:tokens', self.tpm[provider], estimated)])
+
+
+class LatencyTracker:
+    """
+    Recent successful call latencies per model.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def observe(self, model, seconds):
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def p95(self, model):
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[math.ceil(len(samples) * 0.95) - 1]
+
+
+class ResilientBackend(LLMBackend):
+    """
+    Rate limiting, retries and hedging around ``inner``; see the module docstring.
+    """
+
+    def __init__(self, inner, limiter, max_attempts=5, backoff_base=1.0, backoff_max=30.0, max_wait=120.0,
+                 hedge=False, latency=None):
+        self.inner = inner
+        self.limiter = limiter
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.hedge = hedge
+        self.latency = latency or LatencyTracker()
+        self._hedge_pool = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, inner):
+        return cls(
+            inner,
+            RateLimiter(
+                TokenBucketStore(settings.LLM_RATE_LIMIT_DB, settings.LLM_RATE_LIMIT_BURST_S),
+                settings.LLM_RPM, settings.LLM_TPM,
+            ),
+            max_attempts=settings.LLM_MAX_ATTEMPTS,
+            backoff_base=settings.LLM_BACKOFF_BASE_S,
+            backoff_max=settings.LLM_BACKOFF_MAX_S,
+            max_wait=settings.LLM_RATE_LIMIT_MAX_WAIT_S,
+            hedge=settings.LLM_HEDGE,
+            latency=LatencyTracker(min_samples=settings.LLM_HEDGE_MIN_SAMPLES),
+        )
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        provider = 'gemini' if is_gemini_model(model) else 'openai'
+        estimate = estimate_tokens(messages, max_tokens)
+        for attempt in range(self.max_attempts):
+            self.limiter.acquire(provider, estimate, self.max_wait)
+            try:
+                response = self._call(provider, model, estimate, messages, max_tokens, temperature, response_format)
+            except Exception as e:
+                self.limiter.refund(provider, estimate)
+                self._wait_to_retry(e, attempt, provider, model)
+                continue
+            self.limiter.settle(provider, estimate, response.prompt_tokens + response.completion_tokens)
+            return response
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        """
+        Rate limited and retried like complete(), but only until the first
+        piece arrives: a stream that breaks later is not restarted, since its
+        text has already been handed out. Streams are never hedged.
+        """
+        provider = 'gemini' if is_gemini_model(model) else 'openai'
+        estimate = estimate_tokens(messages, max_tokens)
+        for attempt in range(self.max_attempts):
+            self.limiter.acquire(provider, estimate, self.max_wait)
+            pieces = self.inner.stream(model, messages, max_tokens, temperature, response_format)
+            try:
+                first = next(pieces)
+            except StopIteration:
+                return
+            except Exception as e:
+                self.limiter.refund(provider, estimate)
+                self._wait_to_retry(e, attempt, provider, model)
+                continue
+            used = first.prompt_tokens + first.completion_tokens
+            yield first
+            for piece in pieces:
+                # Usage arrives with the last pieces.
+                used = max(used, piece.prompt_tokens + piece.completion_tokens)
+                yield piece
+            self.limiter.settle(provider, estimate, used)
+            return
+
+    def _wait_to_retry(self, error, attempt, provider, model):
+        """
+        Re-raises ``error`` unless it is worth retrying, then sleeps the backoff delay.
+        """
+        if not is_retryable(error):
+            raise error
+        if attempt + 1 == self.max_attempts:
+            raise LLMUnavailableError(
+                f"{provider} call to {model} failed after {self.max_attempts} attempts: {error}"
+            ) from error
+        after = retry_after(error)
+        if after is not None:
+            delay = min(max(after, 0.0), self.backoff_max)
+        else:
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+        LLM_RETRIES.inc(provider=provider, status=str(status_code(error) or type(error).__name__))
+        logger.warning("%s call to %s failed (%s); retry %d/%d in %.1fs",
+                       provider, model, error, attempt + 1, self.max_attempts - 1, delay)
+        time.sleep(delay)
+
+    def _call(self, provider, model, estimate, *args):
+        hedge_after = self.latency.p95(model) if self.hedge else None
+        if hedge_after is not None:
+            return self._hedged(provider, model, estimate, hedge_after, *args)
+        start = time.monotonic()
+        response = self.inner.complete(model, *args)
+        self.latency.observe(model, time.monotonic() - start)
+        return response
+
+    def _get_hedge_pool(self):
+        with self._lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='llm-hedge')
+            return self._hedge_pool
+
+    def _hedged(self, provider, model, estimate, hedge_after, *args):
+        pool = self._get_hedge_pool()
+        start = time.monotonic()
+        primary = pool.submit(self.inner.complete, model, *args)
+
+        def observe(future):
+            # Even when the backup wins: the p95 must stay that of unhedged calls.
+            if not future.cancelled() and future.exception() is None:
+                self.latency.observe(model, time.monotonic() - start)
+
+        primary.add_done_callback(observe)
+        try:
+            return primary.result(timeout=hedge_after)
+        except FuturesTimeoutError:
+            pass
+        # A hedge never waits for capacity; under pressure it would only add load.
+        if not self.limiter.try_acquire(provider, estimate):
+            return primary.result()
+
+        LLM_HEDGES.inc(provider=provider, outcome='sent')
+        backup = pool.submit(self.inner.complete, model, *args)
+        done, _ = wait((primary, backup), return_when=FIRST_COMPLETED)
+        first = done.pop()
+        other = backup if first is primary else primary
+        try:
+            response = first.result()
+        except Exception:
+            first, response = other, other.result()
+        if first is backup:
+            LLM_HEDGES.inc(provider=provider, outcome='won')
+        return response
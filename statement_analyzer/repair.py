@@ -0,0 +1,212 @@
+"""
+Targeted re-extraction of the pages behind balance mismatches.
+
+    result = repair_statement(statement)
+
+The rows flagged by the running-balance check are mapped back to the PDF
+page they came from: each row's balance (or amount) is looked up in the
+pages' text layer, moving forward through the document. Only the pages
+holding flagged rows are extracted again, with GPT-4o vision on a REPAIR_DPI
+rendering of the page plus that page's text. The new rows replace the old
+rows of that page, and the check is re-run over just that range and the row
+after it. A page's new rows are kept only if they leave fewer mismatches
+there, so a repair never makes a statement worse. Fixing one page
+therefore costs one page of LLM time instead of the whole document.
+"""
+import logging
+import re
+from collections import Counter
+
+from django.conf import settings
+
+from . import cpu_budget, statement_store, transaction_verifier
+from .data_extractor import BankStatementParser, continuation_rows
+from .instrumentation import REPAIR_PAGES, span
+from .lazy import lazy_import
+from .llm_backends import LLMUnavailableError
+from .transaction_table import NO_BALANCE, TransactionTable
+
+fitz = lazy_import('fitz')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+
+class RepairError(Exception):
+    pass
+
+
+def _money_pattern(cents):
+    """
+    Matches an amount as printed: 1234.50, 1,234.50 or 1 234.50, but not as
+    part of a longer number.
+    """
+    value = f'{abs(cents) / 100:,.2f}'
+    return re.compile(r'(?<![\d.,])' + re.escape(value).replace(',', '[, ]?') + r'(?!\d)')
+
+
+def _find_page(texts, pattern, first):
+    for number in range(first, len(texts)):
+        if pattern.search(texts[number]):
+            return number
+    return None
+
+
+def map_rows_to_pages(table, texts):
+    """
+    The page index of each row of ``table``, given the text of each page.
+    Rows whose numbers are not found on any page take the page of the row
+    before them. Without any text layer (scanned PDFs) rows are spread
+    evenly over the pages.
+    """
+    amounts = table.amounts_view()
+    balances = table.balances_view()
+    pages = [None] * len(table)
+    page = 0
+    for i in range(len(table)):
+        for cents in (balances[i], amounts[i]):
+            if cents in (NO_BALANCE, 0):
+                continue
+            found = _find_page(texts, _money_pattern(cents), page)
+            if found is not None:
+                pages[i] = page = found
+                break
+
+    known = [number for number in pages if number is not None]
+    if not known:
+        return [i * len(texts) // max(len(table), 1) for i in range(len(table))]
+    last = known[0]
+    for i, number in enumerate(pages):
+        if number is None:
+            pages[i] = last
+        else:
+            last = number
+    return pages
+
+
+def page_ranges(pages):
+    """
+    {page index: (first row, end row)} for a row-to-page mapping.
+    """
+    ranges = {}
+    for i, number in enumerate(pages):
+        start, _ = ranges.get(number, (i, i))
+        ranges[number] = (start, i + 1)
+    return ranges
+
+
+def suspect_pages(pages, flagged, limit):
+    """
+    Up to ``limit`` pages most likely to hold the errors behind the flagged
+    rows. A mismatch on a page's first row can come from the last balance of
+    the page before, so that page counts as well.
+    """
+    counts = Counter()
+    for i in flagged:
+        counts[pages[i]] += 1
+        if i and pages[i - 1] != pages[i]:
+            counts[pages[i - 1]] += 1
+    return sorted(number for number, _ in counts.most_common(limit))
+
+
+def render_page(doc, number, dpi):
+    pixmap = doc[number].get_pixmap(dpi=dpi)
+    return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def _mismatches(rows, previous):
+    table = TransactionTable.from_dicts(rows)
+    check = transaction_verifier.RunningBalanceCheck(previous)
+    return sum(check.feed(amount, balance)[0] for amount, balance in zip(table.amounts, table.balances))
+
+
+def _reextract_page(parser, doc, number, text, rows_before, dpi):
+    with span('repair_page'):
+        with cpu_budget.cpu_slot():
+            image = render_page(doc, number, dpi)
+        data = parser.extract_transactions_gpt([image], text)
+    new_rows = [row for row in (data or {}).get('transactions') or [] if isinstance(row, dict)]
+    if new_rows and rows_before:
+        # A page often repeats the previous page's last row as "balance brought forward".
+        new_rows = continuation_rows(rows_before, new_rows)
+    return new_rows
+
+
+def repair_statement(statement, parser=None, max_pages=None, dpi=None):
+    """
+    Re-extracts the pages holding mismatched rows of a stored statement and
+    saves the fixes that reduce the mismatches. Returns
+    {'mismatches_before', 'mismatches_after', 'version', 'row_count', 'pages': [...]}.
+    Raises RepairError when the statement has no PDF, and
+    StaleStatementError if it was edited meanwhile.
+    """
+    max_pages = settings.REPAIR_MAX_PAGES if max_pages is None else max_pages
+    dpi = dpi or settings.REPAIR_DPI
+    table, _ = statement_store.load_table(statement)
+    before = len(transaction_verifier.verify_table(table))
+    result = {'mismatches_before': before, 'mismatches_after': before, 'version': statement.version,
+              'row_count': statement.row_count, 'pages': []}
+    if not before:
+        return result
+    pdf = statement_store.get_source_pdf(statement)
+    if not pdf:
+        raise RepairError("The original PDF of this statement was not kept, so it cannot be re-read.")
+
+    parser = parser or BankStatementParser()
+    with span('repair', rows=len(table)) as s:
+        doc = fitz.open(stream=bytes(pdf), filetype='pdf')
+        try:
+            texts = [page.get_text() for page in doc]
+            pages = map_rows_to_pages(table, texts)
+            ranges = page_ranges(pages)
+            flagged = [i for i, mismatch in enumerate(table.mismatch) if mismatch]
+            rows = table.to_dicts()
+            first_changed = None
+
+            # Last page first, so the row ranges of the pages still to do do not move.
+            for number in reversed(suspect_pages(pages, flagged, max_pages)):
+                start, stop = ranges[number]
+                previous = transaction_verifier.carried_balance(table, start)
+                old = _mismatches(rows[start:stop + 1], previous)
+                report = {'page': number + 1, 'rows': [start, stop], 'mismatches_before': old}
+                result['pages'].append(report)
+                try:
+                    new_rows = _reextract_page(parser, doc, number, texts[number], rows[:start], dpi)
+                    new = _mismatches(new_rows + rows[stop:stop + 1], previous) if new_rows else None
+                except LLMUnavailableError as e:
+                    logger.warning("Stopped repairing statement %s: %s", statement.key, e)
+                    report.update(outcome='failed', mismatches_after=old)
+                    REPAIR_PAGES.inc(outcome='failed')
+                    break
+                except ValueError as e:
+                    logger.warning("Re-extracted page %d of statement %s is unusable: %s", number + 1, statement.key, e)
+                    new = None
+                report['mismatches_after'] = old if new is None else min(old, new)
+                if new is None:
+                    report['outcome'] = 'failed'
+                elif new < old:
+                    rows[start:stop] = new_rows
+                    first_changed = start
+                    report['outcome'] = 'fixed'
+                else:
+                    report['outcome'] = 'unchanged'
+                REPAIR_PAGES.inc(outcome=report['outcome'])
+        finally:
+            doc.close()
+        result['pages'].reverse()
+
+        if first_changed is not None:
+            if len(rows) != statement.row_count:
+                for n, row in enumerate(rows, 1):
+                    row['id'] = n
+            statement_store.apply_transactions(statement, rows, expected_version=statement.version)
+            repaired = TransactionTable.from_dicts(rows)
+            # Rows before the first changed page kept their flags.
+            after = sum(1 for i in flagged if i < first_changed)
+            after += len(transaction_verifier.verify_table(repaired, first_changed))
+            statement.row_count = len(rows)
+            result.update(mismatches_after=after, version=statement.version, row_count=len(rows))
+        s.add(pages=len(result['pages']))
+    logger.info("Repaired statement %s: %d -> %d mismatches over %d pages",
+                statement.key, before, result['mismatches_after'], len(result['pages']))
+    return result
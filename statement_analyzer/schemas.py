@@ -0,0 +1,135 @@
+"""
+Pydantic models of the JSON the LLM is asked to return.
+
+They serve twice: as the JSON schema handed to the provider's structured
+output mode (see response_format), and to validate and normalise what comes
+back. Validation is forgiving on purpose. Money written as "1,025.50 Cr" is
+converted to a float, unknown keys are kept, and a row that still does not
+fit is kept exactly as returned instead of failing the whole statement.
+Storage copes with what is left: the transaction table keeps an unreadable
+amount or balance as a blank cell flagged for the balance check, and MongoDB
+stores it as null.
+"""
+import logging
+from typing import List, Optional, Union
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+from .transaction_table import from_cents, to_cents
+
+logger = logging.getLogger(__name__)
+
+
+def _money(value):
+    """
+    Money text as a float. Text that is not a number ("N/A") is returned
+    unchanged so the row fails validation and is stored flagged, not as 0.
+    """
+    if isinstance(value, str):
+        try:
+            cents = to_cents(value)
+        except ValueError:
+            return value
+        return None if cents is None else from_cents(cents)
+    return value
+
+
+class AccountInfo(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    bank_name: Optional[str] = None
+    branch_code: Optional[str] = None
+    branch_address: Optional[str] = None
+    holder_name: Optional[str] = None
+    account_number: Optional[str] = None
+    period: Optional[str] = None
+    final_balance: Optional[float] = None
+
+    _final_balance = field_validator('final_balance', mode='before')(_money)
+
+
+class Transaction(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    id: Optional[Union[int, str]] = None
+    details: Optional[str] = None
+    date: Optional[str] = Field(None, description='DD-MM-YYYY')
+    amount: Optional[float] = Field(None, description='Positive for credits, negative for debits')
+    balance: Optional[float] = Field(None, description='Running balance, negative when overdrawn')
+
+    _money_fields = field_validator('amount', 'balance', mode='before')(_money)
+
+
+class StatementExtraction(BaseModel):
+    account_info: AccountInfo = Field(default_factory=AccountInfo)
+    transactions: List[Transaction] = Field(default_factory=list)
+
+
+class FraudIssue(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    issue_type: str = 'other'
+    description: str = ''
+    related_transaction_image_snippet: Optional[str] = None
+
+
+def response_format(model, name):
+    """
+    OpenAI ``response_format`` asking for JSON that follows ``model``.
+    Not strict: strict mode forbids the optional fields and extra keys above.
+    """
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': name, 'schema': model.model_json_schema(), 'strict': False},
+    }
+
+
+STATEMENT_FORMAT = response_format(StatementExtraction, 'bank_statement')
+
+
+def _validate(model, data, what):
+    try:
+        return model.model_validate(data).model_dump(exclude_unset=True)
+    except ValidationError as e:
+        logger.warning("LLM returned an invalid %s, keeping it as is: %s", what, e.errors()[0]['msg'])
+        return data
+
+
+def validate_account_info(data):
+    return _validate(AccountInfo, data, 'account_info') if isinstance(data, dict) else {}
+
+
+def validate_transaction(row):
+    return _validate(Transaction, row, 'transaction')
+
+
+def validate_statement(data):
+    """
+    {'account_info': ..., 'transactions': [...]} with money normalised, or
+    None if ``data`` is not a dict. Non-dict rows are dropped.
+    """
+    if not isinstance(data, dict):
+        return None
+    transactions = data.get('transactions')
+    dropped = 0
+    rows = []
+    for row in transactions if isinstance(transactions, list) else []:
+        if isinstance(row, dict):
+            rows.append(validate_transaction(row))
+        else:
+            dropped += 1
+    if dropped:
+        logger.warning("Dropped %d transaction rows that were not objects", dropped)
+    return dict(data, account_info=validate_account_info(data.get('account_info')), transactions=rows)
+
+
+def validate_fraud_issues(data):
+    """
+    A list of fraud issue dicts from a JSON array, or from an object holding
+    one under "issues"/"fraud_details". Anything else gives [].
+    """
+    if isinstance(data, dict):
+        data = data.get('issues', data.get('fraud_details'))
+    if not isinstance(data, list):
+        return []
+    return [_validate(FraudIssue, issue, 'fraud issue') for issue in data if isinstance(issue, dict)]
@@ -0,0 +1,259 @@
+"""
+Database-backed storage for extracted statements.
+
+Transactions are kept as zlib-compressed TransactionTable chunks of
+STATEMENT_CHUNK_ROWS rows. The session only holds a small reference
+(statement key and version), and an edit rewrites just the chunks that
+contain changed rows.
+"""
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ExtractedStatement, StatementChunk
+from .transaction_table import TransactionTable
+
+SESSION_KEY = 'statement_ref'
+COMPARED_FIELDS = ('date', 'details', 'amount', 'balance')
+
+
+class StaleStatementError(Exception):
+    """Raised when a write is based on an older version of the statement."""
+
+
+def encode_chunk(table):
+    return zlib.compress(table.to_bytes(), settings.STATEMENT_COMPRESSION_LEVEL)
+
+
+def decode_chunk(payload):
+    return TransactionTable.from_bytes(zlib.decompress(bytes(payload)))
+
+
+def _build_chunks(statement, transactions):
+    size = statement.chunk_rows
+    return [
+        StatementChunk(
+            statement=statement,
+            index=start // size,
+            payload=encode_chunk(TransactionTable.from_dicts(transactions[start:start + size])),
+        )
+        for start in range(0, len(transactions), size)
+    ]
+
+
+def create_statement(account_info, transactions, file_bytes=None, filename='', document_hash=''):
+    """
+    Stores a freshly extracted statement and returns the ExtractedStatement.
+    """
+    with transaction.atomic():
+        statement = ExtractedStatement.objects.create(
+            account_info=account_info or {},
+            row_count=len(transactions),
+            chunk_rows=settings.STATEMENT_CHUNK_ROWS,
+            source_pdf=file_bytes,
+            filename=filename or '',
+            document_hash=document_hash or '',
+        )
+        StatementChunk.objects.bulk_create(_build_chunks(statement, transactions))
+    return statement
+
+
+class StatementWriter:
+    """
+    Stores a statement while it is still being extracted (see page_stream.py).
+    Each chunk is written as soon as it fills up, so at most one chunk of rows
+    is held here. The statement only gets its account info at close().
+    """
+
+    def __init__(self, file_bytes=None, filename='', document_hash=''):
+        self.statement = ExtractedStatement.objects.create(
+            account_info={},
+            row_count=0,
+            chunk_rows=settings.STATEMENT_CHUNK_ROWS,
+            source_pdf=file_bytes,
+            filename=filename or '',
+            document_hash=document_hash or '',
+        )
+        self.pending = []
+        self.index = 0
+
+    def append(self, transactions):
+        self.pending.extend(transactions)
+        size = self.statement.chunk_rows
+        while len(self.pending) >= size:
+            self._write(self.pending[:size])
+            del self.pending[:size]
+
+    def _write(self, transactions):
+        statement = self.statement
+        StatementChunk.objects.create(
+            statement=statement, index=self.index, payload=encode_chunk(TransactionTable.from_dicts(transactions)),
+        )
+        self.index += 1
+        statement.row_count += len(transactions)
+        ExtractedStatement.objects.filter(pk=statement.pk).update(row_count=statement.row_count)
+
+    def close(self, account_info):
+        """
+        Writes the last, partial chunk and the account info. Returns the ExtractedStatement.
+        """
+        if self.pending:
+            self._write(self.pending)
+            self.pending = []
+        self.statement.account_info = account_info or {}
+        ExtractedStatement.objects.filter(pk=self.statement.pk).update(account_info=self.statement.account_info)
+        return self.statement
+
+    def discard(self):
+        self.statement.delete()
+
+
+def get_statement(key):
+    """
+    Returns the statement without its PDF bytes, or None if it does not exist.
+    """
+    try:
+        return ExtractedStatement.objects.defer('source_pdf').get(key=key)
+    except (ExtractedStatement.DoesNotExist, ValueError):
+        return None
+
+
+def load_table(statement, start=0, stop=None):
+    """
+    Loads rows [start, stop) of a statement into one TransactionTable.
+    Only the chunks overlapping the range are read. Returns the table and the
+    row number of its first row (the start of the first chunk read).
+    """
+    size = statement.chunk_rows
+    stop = statement.row_count if stop is None else min(stop, statement.row_count)
+    table = TransactionTable()
+    if start >= stop:
+        return table, start
+    first, last = start // size, (stop - 1) // size
+    payloads = (
+        StatementChunk.objects
+        .filter(statement=statement, index__gte=first, index__lte=last)
+        .order_by('index')
+        .values_list('payload', flat=True)
+    )
+    for payload in payloads:
+        table.extend(decode_chunk(payload))
+    return table, first * size
+
+
+def iter_chunks(statement):
+    """
+    Yields (first row number, TransactionTable) for each chunk in order,
+    reading one chunk at a time from the database.
+    """
+    payloads = (
+        StatementChunk.objects
+        .filter(statement=statement)
+        .order_by('index')
+        .values_list('index', 'payload')
+        .iterator(chunk_size=1)
+    )
+    for index, payload in payloads:
+        yield index * statement.chunk_rows, decode_chunk(payload)
+
+
+def _bump_version(statement, expected_version):
+    filters = {'pk': statement.pk}
+    if expected_version is not None:
+        filters['version'] = expected_version
+    updated = ExtractedStatement.objects.filter(**filters).update(
+        version=F('version') + 1, updated_at=timezone.now(),
+    )
+    if not updated:
+        raise StaleStatementError(
+            f"Statement {statement.key} changed since version {expected_version}; reload and retry."
+        )
+    statement.version = ExtractedStatement.objects.values_list('version', flat=True).get(pk=statement.pk)
+
+
+def update_rows(statement, edits, expected_version=None):
+    """
+    Applies ``edits`` ({row index: transaction dict}) to a stored statement.
+    Only the chunks holding edited rows are rewritten. Row ids are preserved.
+    Returns the new version.
+    """
+    if not edits:
+        if expected_version is not None and expected_version != statement.version:
+            raise StaleStatementError(
+                f"Statement {statement.key} changed since version {expected_version}; reload and retry."
+            )
+        return statement.version
+    size = statement.chunk_rows
+    by_chunk = {}
+    for index, entry in edits.items():
+        if not 0 <= index < statement.row_count:
+            raise IndexError(f"Row {index} is out of range for statement {statement.key}.")
+        by_chunk.setdefault(index // size, {})[index % size] = entry
+
+    with transaction.atomic():
+        _bump_version(statement, expected_version)
+        chunks = list(StatementChunk.objects.select_for_update().filter(statement=statement, index__in=by_chunk))
+        for chunk in chunks:
+            table = decode_chunk(chunk.payload)
+            for offset, entry in by_chunk[chunk.index].items():
+                entry = dict(entry, id=table.row(offset)['id'])
+                table.set_row(offset, entry)
+            chunk.payload = encode_chunk(table)
+        StatementChunk.objects.bulk_update(chunks, ['payload'])
+    return statement.version
+
+
+def replace_transactions(statement, transactions, expected_version=None):
+    """
+    Rewrites every chunk of a statement; used when the row count changes.
+    """
+    with transaction.atomic():
+        _bump_version(statement, expected_version)
+        statement.chunks.all().delete()
+        statement.row_count = len(transactions)
+        ExtractedStatement.objects.filter(pk=statement.pk).update(row_count=statement.row_count)
+        StatementChunk.objects.bulk_create(_build_chunks(statement, transactions))
+    return statement.version
+
+
+def apply_transactions(statement, transactions, expected_version=None):
+    """
+    Saves a full edited transaction list by diffing it against the stored rows,
+    so an edit of a handful of rows only rewrites the chunks holding them.
+    Returns the new version.
+    """
+    if len(transactions) != statement.row_count:
+        return replace_transactions(statement, transactions, expected_version)
+
+    stored, _ = load_table(statement)
+    edited = TransactionTable.from_dicts(transactions)
+    edits = {}
+    for index in range(len(stored)):
+        before, after = stored.row(index), edited.row(index)
+        if any(before[field] != after[field] for field in COMPARED_FIELDS):
+            edits[index] = transactions[index]
+    return update_rows(statement, edits, expected_version)
+
+
+def get_source_pdf(statement):
+    return ExtractedStatement.objects.values_list('source_pdf', flat=True).get(pk=statement.pk)
+
+
+def set_fraud_issues(statement, fraud_issues):
+    statement.fraud_issues = fraud_issues
+    ExtractedStatement.objects.filter(pk=statement.pk).update(fraud_issues=fraud_issues)
+
+
+# --- Session reference helpers ---
+def remember_statement(session, statement):
+    session[SESSION_KEY] = {'key': str(statement.key), 'version': statement.version}
+
+
+def get_session_statement(session):
+    ref = session.get(SESSION_KEY)
+    if not ref:
+        return None
+    return get_statement(ref.get('key'))
@@ -0,0 +1,111 @@
+"""
+Server-sent events from work that runs in a background thread.
+
+    def work(emit):
+        emit('status', {'message': 'Reading the PDF'})
+        ...
+
+    stream = EventStream(work)
+    return StreamingHttpResponse(stream.response_content(request), content_type='text/event-stream')
+
+The work function runs in its own thread and calls emit() as results come
+in. Each event is sent right away, and a comment line goes out every
+``keepalive`` seconds so that proxies keep the connection open. Under ASGI
+(uvicorn, daphne) the events come from an async generator, so no worker
+thread waits on the stream. Django would read a sync iterator to the end
+before sending anything. Under WSGI a plain generator is used. The
+runserver and gunicorn sync workers flush every event, but each open
+stream then occupies a worker. When the client goes away, the
+next emit() raises StreamClosed, which stops the work.
+"""
+import asyncio
+import json
+import logging
+import queue
+import threading
+
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class StreamClosed(Exception):
+    pass
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+class EventStream:
+    def __init__(self, work, keepalive=15):
+        self.work = work
+        self.keepalive = keepalive
+        self.closed = False
+
+    def _start(self, put):
+        def emit(event, data):
+            if self.closed:
+                raise StreamClosed()
+            put(format_event(event, data))
+
+        def run():
+            try:
+                self.work(emit)
+            except StreamClosed:
+                logger.info("Event stream closed by the client")
+            except Exception as e:
+                logger.exception("Event stream work failed")
+                put(format_event('error', {'message': f"An unexpected error occurred: {e}"}))
+            finally:
+                connection.close()
+                put(_END)
+
+        threading.Thread(target=run, name='event-stream', daemon=True).start()
+
+    def response_content(self, request):
+        return self.async_events() if isinstance(request, ASGIRequest) else self.events()
+
+    def events(self):
+        events = queue.Queue()
+        self._start(events.put)
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is _END:
+                    return
+                yield item
+        finally:
+            self.closed = True
+
+    async def async_events(self):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, item)
+            except RuntimeError:
+                # The loop is gone: the response was abandoned.
+                self.closed = True
+
+        self._start(put)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is _END:
+                    return
+                yield item
+        finally:
+            self.closed = True
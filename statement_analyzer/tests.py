@@ -1,3 +1,1167 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from pymongo.errors import ServerSelectionTimeoutError
+
+from . import (batch, cpu_budget, exporter, instrumentation, llm_router, llm_standin, mongo_store, offline,
+               page_stream, path_selector, pdf_extractor, pipeline, rapid_ocr, rate_limit, repair, statement_store)
+from .data_extractor import BankStatementParser, continuation_rows
+from .llm_backends import (CassetteBackend, CassetteMissError, LLMBackend, LLMResponse, LLMUnavailableError,
+                           StandInBackend, join_pieces, prompt_key)
+from .llm_json import StatementStreamParser, close_truncated, loads_lenient, parse_statement
+from .models import BatchItem, ExtractedStatement, PipelineRun
+from .schemas import validate_statement
+from .transaction_table import NO_BALANCE, TransactionTable, to_cents
+from .transaction_verifier import verify_table
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def _rows(*amounts, start_balance=100.0, start_day=1):
+    """
+    Transaction dicts with consistent running balances.
+    """
+    rows, balance = [], start_balance
+    for i, amount in enumerate(amounts):
+        balance = round(balance + amount, 2)
+        rows.append({'id': i + 1, 'date': f'{start_day + i:02d}-02-2024', 'details': f'Row {i + 1}',
+                     'amount': amount, 'balance': balance})
+    return rows
+
+
+class MongoMixin:
+    """
+    Runs mongo_store against mongomock instead of a server.
+    """
+
+    def setUp(self):
+        if mongomock is None:
+            self.skipTest('mongomock is not installed')
+        mongo_store.set_mongo_client(mongomock.MongoClient())
+        self.addCleanup(mongo_store.set_mongo_client, None)
+        # pymongo >= 4.9 passes UpdateOne's sort, which mongomock does not know.
+        add_update = mongomock.collection.BulkOperationBuilder.add_update
+        patcher = mock.patch.object(mongomock.collection.BulkOperationBuilder, 'add_update',
+                                    lambda bulk, *args, sort=None, **kwargs: add_update(bulk, *args, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TransactionTableTests(SimpleTestCase):
+    def test_cr_dr_suffixes_keep_the_sign(self):
+        self.assertEqual(to_cents('1,025.50 Cr'), 102550)
+        self.assertEqual(to_cents('450.75 Dr'), 45075)
+        self.assertEqual(to_cents('-450.75 Dr'), -45075)
+
+    def test_garbage_raises(self):
+        with self.assertRaises(ValueError):
+            to_cents('N/A')
+
+    def test_unreadable_cells_are_flagged_not_fatal(self):
+        table = TransactionTable.from_dicts([
+            {'id': 1, 'date': '01-02-2024', 'details': 'Opening', 'amount': 0, 'balance': 100.0},
+            {'id': 2, 'date': '02-02-2024', 'details': 'Garbled', 'amount': 'N/A', 'balance': 'n/a'},
+            {'id': 3, 'date': '03-02-2024', 'details': 'Fee', 'amount': -10.0, 'balance': 90.0},
+        ])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.amounts[1], 0)
+        self.assertEqual(table.balances[1], NO_BALANCE)
+
+        flagged = verify_table(table)
+        self.assertEqual(len(flagged), 1)
+        self.assertIn('Unreadable', flagged[0])
+        self.assertEqual([row['mismatch'] for row in table.to_dicts()], [False, True, False])
+
+        # The flag survives serialization and a second check.
+        table = TransactionTable.from_bytes(table.to_bytes())
+        verify_table(table)
+        self.assertTrue(table.unreadable(1))
+
+    def test_out_of_range_amount_is_unreadable(self):
+        table = TransactionTable.from_dicts([
+            {'amount': '100000000000000000', 'balance': 5.0},
+            {'amount': 1.0, 'balance': -(2 ** 63) / 100},
+        ])
+        self.assertTrue(table.unreadable(0))
+        self.assertTrue(table.unreadable(1))
+        self.assertEqual(len(verify_table(table)), 2)
+
+    def test_editing_a_row_clears_the_flag(self):
+        table = TransactionTable.from_dicts([{'amount': 'N/A', 'balance': 5.0}])
+        table.set_row(0, {'amount': 5.0, 'balance': 5.0})
+        self.assertFalse(table.unreadable(0))
+        self.assertEqual(verify_table(table), [])
+
+
+class MongoStoreTests(MongoMixin, SimpleTestCase):
+    def test_save_statement_replaces_rows(self):
+        info = {'account_number': '123', 'holder_name': 'A'}
+        self.assertEqual(mongo_store.save_statement('doc', info, _rows(1.0, 2.0, 3.0), filename='a.pdf'), 3)
+        self.assertEqual(mongo_store.save_statement('doc', info, _rows(5.0), filename='a.pdf'), 1)
+
+        statement = mongo_store.get_statements_collection().find_one({'_id': 'doc'})
+        self.assertEqual(statement['transaction_count'], 1)
+        self.assertEqual(statement['account_number'], '123')
+        self.assertIn('created_at', statement)
+        rows = list(mongo_store.get_transactions_collection().find({'document_hash': 'doc'}))
+        self.assertEqual([row['amount'] for row in rows], [5.0])
+        self.assertEqual(rows[0]['txn_date'], datetime(2024, 2, 1))
+
+    def test_save_statements_writes_all(self):
+        written = mongo_store.save_statements([
+            ('a', {'account_number': '1'}, _rows(1.0, 2.0), 'a.pdf'),
+            ('b', {'account_number': '2'}, _rows(3.0), 'b.pdf'),
+        ])
+        self.assertEqual(written, 3)
+        self.assertEqual(mongo_store.get_statements_collection().count_documents({}), 2)
+        self.assertEqual(mongo_store.get_transactions_collection().count_documents({'account_number': '1'}), 2)
+
+    def test_find_transactions_filters(self):
+        mongo_store.save_statement('a', {'account_number': '1'}, _rows(10.0, -20.0, 30.0))
+        mongo_store.save_statement('b', {'account_number': '2'}, _rows(40.0))
+
+        results, cursor = mongo_store.find_transactions({'account_number': '1', 'amount_min': 0.0})
+        self.assertIsNone(cursor)
+        self.assertEqual([row['amount'] for row in results], [30.0, 10.0])  # newest first
+
+        results, _ = mongo_store.find_transactions(
+            {'date_from': datetime(2024, 2, 2), 'date_to': datetime(2024, 2, 2)}, fields=['amount'])
+        self.assertEqual(results, [{'id': 'a:000001', 'amount': -20.0}])
+
+    def test_cursor_pages_through_everything_once(self):
+        mongo_store.save_statement('a', {}, _rows(*[1.0] * 7))
+        mongo_store.get_transactions_collection().insert_one({'_id': 'a:undated', 'txn_date': None, 'amount': 9.0})
+
+        seen, cursor = [], None
+        while True:
+            results, cursor = mongo_store.find_transactions({}, cursor=cursor, limit=3)
+            seen.extend(row['id'] for row in results)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(len(set(seen)), 8)
+        self.assertEqual(seen[-1], 'a:undated')  # undated rows sort last
+
+    def test_cursor_round_trip(self):
+        document = {'_id': 'a:000003', 'txn_date': datetime(2024, 2, 3)}
+        self.assertEqual(mongo_store.decode_cursor(mongo_store.encode_cursor(document)),
+                         (datetime(2024, 2, 3), 'a:000003'))
+        self.assertEqual(mongo_store.decode_cursor(mongo_store.encode_cursor({'_id': 'x', 'txn_date': None})),
+                         (None, 'x'))
+        with self.assertRaises(ValueError):
+            mongo_store.decode_cursor('not a cursor')
+
+    @override_settings(MONGO_RETRY_AFTER_S=60)
+    def test_unreachable_server_skips_later_writes(self):
+        with self.assertRaises(ServerSelectionTimeoutError):
+            with mongo_store.request_timeout():
+                raise ServerSelectionTimeoutError('down')
+        with mock.patch.object(mongo_store, 'save_statement') as save:
+            with self.assertRaises(ServerSelectionTimeoutError):
+                with mongo_store.request_timeout():
+                    save()
+            save.assert_not_called()
+
+
+class StoreStatementTests(MongoMixin, TestCase):
+    def test_non_numeric_amount_is_stored_flagged(self):
+        rows = _rows(10.0, -5.0, 2.0)
+        rows[1]['amount'] = 'N/A'
+        extracted = validate_statement({'account_info': {'account_number': '9'}, 'transactions': rows})
+        self.assertEqual(extracted['transactions'][1]['amount'], 'N/A')
+
+        statement = pipeline.store_statement(b'%PDF-1.4 test', extracted, filename='a.pdf')
+        table, _ = statement_store.load_table(statement)
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table.unreadable(1))
+        self.assertEqual(pipeline.count_mismatches(statement), 1)
+
+        stored = mongo_store.get_transactions_collection().find_one({'_id': f'{statement.document_hash}:000001'})
+        self.assertIsNone(stored['amount'])
+        self.assertEqual(stored['balance'], 105.0)
+
+
+class QueryTransactionsTests(MongoMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        mongo_store.save_statement('a', {'account_number': '1'}, _rows(10.0, -20.0))
+        self.url = reverse('statement_analyzer:query_transactions')
+
+    def test_requires_staff(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(get_user_model().objects.create_user('user'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_staff_can_query(self):
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        response = self.client.get(self.url, {'amount_max': '0'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['amount'] for row in response.json()['results']], [-20.0])
+
+    def test_rejects_non_finite_amounts(self):
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        for value in ('nan', 'inf', '-Infinity'):
+            self.assertEqual(self.client.get(self.url, {'amount_min': value}).status_code, 400)
+
+
+@override_settings(STATEMENT_CHUNK_ROWS=2)
+class ExporterTests(TestCase):
+    def setUp(self):
+        rows = _rows(10.0, -20.0, 30.0)
+        rows[1]['balance'] = 95.0  # should be 90.00
+        rows[2]['balance'] = 'N/A'
+        self.statement = statement_store.create_statement({'holder_name': 'A. Holder', 'final_balance': 120.0}, rows,
+                                                          filename='May 2024 (final).pdf')
+
+    def test_rows_are_split_and_checked_across_chunks(self):
+        self.assertEqual(list(exporter.iter_export_rows(self.statement)), [
+            [1, '01-02-2024', 'Row 1', 10.0, None, 110.0, ''],
+            [2, '02-02-2024', 'Row 2', None, -20.0, 95.0, 'YES'],
+            [3, '03-02-2024', 'Row 3', 30.0, None, None, 'YES'],
+        ])
+
+    def test_csv_and_batch_csv(self):
+        rows = list(csv.reader(io.StringIO(''.join(exporter.iter_csv(self.statement)))))
+        self.assertEqual(rows[0], exporter.COLUMNS)
+        self.assertEqual(rows[3], ['3', '03-02-2024', 'Row 3', '30.0', '', '', 'YES'])
+        other = statement_store.create_statement({}, _rows(5.0))
+        batch_rows = list(csv.reader(io.StringIO(''.join(
+            exporter.iter_batch_csv([('a.pdf', self.statement), ('b.pdf', other)])))))
+        self.assertEqual(batch_rows[0], ['File'] + exporter.COLUMNS)
+        self.assertEqual([row[:2] for row in batch_rows[1:]], [['a.pdf', '1'], ['a.pdf', '2'], ['a.pdf', '3'],
+                                                               ['b.pdf', '1']])
+
+    def test_xlsx_has_account_and_transaction_sheets(self):
+        from openpyxl import load_workbook
+
+        with mock.patch.object(exporter, 'XLSX_BLOCK_SIZE', 1024):
+            blocks = list(exporter.iter_xlsx(self.statement))
+        self.assertGreater(len(blocks), 1)
+        workbook = load_workbook(io.BytesIO(b''.join(blocks)))
+        account = {label: value for label, value in workbook['Account'].values}
+        self.assertEqual((account['Holder Name'], account['Final Balance'], account['Transactions']),
+                         ('A. Holder', 120, 3))
+        transactions = list(workbook['Transactions'].values)
+        self.assertEqual(list(transactions[0]), exporter.COLUMNS)
+        self.assertEqual(list(transactions[2]), [2, '02-02-2024', 'Row 2', None, -20, 95, 'YES'])
+
+    def test_export_filename_is_sanitised(self):
+        self.assertEqual(exporter.export_filename(self.statement, 'csv'), 'May_2024_final__transactions.csv')
+        self.statement.filename = ''
+        self.assertEqual(exporter.export_filename(self.statement, 'xlsx'), 'statement_transactions.xlsx')
+
+
+class RevalidateTests(TestCase):
+    def setUp(self):
+        self.statement = statement_store.create_statement({}, _rows(10.0, -5.0))
+        self.url = reverse('statement_analyzer:revalidate_transactions')
+
+    def _client(self, **kwargs):
+        client = Client(**kwargs)
+        session = client.session
+        statement_store.remember_statement(session, self.statement)
+        session.save()
+        return client
+
+    def _edit(self, client, **extra):
+        body = json.dumps({'edits': [{'index': 1, 'amount': -6.0, 'balance': 104.0}], 'version': 1})
+        return client.post(self.url, body, content_type='application/json', **extra)
+
+    def test_requires_csrf_token(self):
+        client = self._client(enforce_csrf_checks=True)
+        self.assertEqual(self._edit(client).status_code, 403)
+        client.get(reverse('statement_analyzer:view_transactions_data'))
+        response = self._edit(client, HTTP_X_CSRFTOKEN=client.cookies['csrftoken'].value)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'version': 2, 'mismatch_count': 0})
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.batch = batch.create_batch([('a.pdf', b''), ('b.pdf', b''), ('c.pdf', b'')])
+
+    @override_settings(BATCH_ITEM_TIMEOUT_S=60)
+    def test_stale_items_are_expired(self):
+        long_ago = timezone.now() - timedelta(minutes=5)
+        self.batch.items.filter(index=0).update(status=BatchItem.EXTRACTING, started_at=long_ago)
+        self.batch.items.filter(index=1).update(status=BatchItem.ANALYZING, started_at=timezone.now())
+        self.assertEqual(batch.expire_stale_items(self.batch), 1)
+        type(self.batch).objects.filter(pk=self.batch.pk).update(created_at=long_ago)
+        self.assertEqual(batch.expire_stale_items(self.batch), 1)  # c.pdf never started
+
+        response = self.client.get(reverse('statement_analyzer:batch_status', args=[self.batch.key]))
+        self.assertEqual([item['status'] for item in response.json()['items']],
+                         [BatchItem.FAILED, BatchItem.ANALYZING, BatchItem.FAILED])
+        self.assertFalse(response.json()['finished'])
+
+    def test_open_item_without_statement_is_404(self):
+        statement = statement_store.create_statement({}, _rows(1.0))
+        self.batch.items.filter(index=0).update(status=BatchItem.DONE, statement=statement)
+        url = reverse('statement_analyzer:open_batch_item', args=[self.batch.key, 0])
+        self.assertEqual(self.client.get(url).status_code, 302)
+        statement.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class _PageParser:
+    """
+    Stands in for BankStatementParser: answers a page re-extraction with the
+    rows registered for that page's text.
+    """
+
+    def __init__(self, rows_by_text):
+        self.rows_by_text = rows_by_text
+
+    def extract_transactions_gpt(self, images, raw_text):
+        for text, rows in self.rows_by_text.items():
+            if text in raw_text:
+                return {'transactions': [dict(row) for row in rows]}
+        return {}
+
+
+class RepairTests(TestCase):
+    PAGES = ['110.00 130.00', '160.00 200.00']
+
+    def setUp(self):
+        rows = _rows(10.0, 20.0, 30.0, 40.0)
+        rows[2]['amount'] = 99.0  # misread; its balance no longer follows
+        doc = repair.fitz.open()
+        for text in self.PAGES:
+            doc.new_page().insert_text((72, 72), text)
+        self.statement = statement_store.create_statement({}, rows, file_bytes=doc.tobytes())
+        self.rows = rows
+        patcher = mock.patch.object(repair, 'render_page', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rows_map_to_their_pages(self):
+        table, _ = statement_store.load_table(self.statement)
+        pages = repair.map_rows_to_pages(table, self.PAGES)
+        self.assertEqual(pages, [0, 0, 1, 1])
+        self.assertEqual(repair.page_ranges(pages), {0: (0, 2), 1: (2, 4)})
+        # A mismatch on a page's first row also suspects the page before.
+        self.assertEqual(repair.suspect_pages(pages, [2], 3), [0, 1])
+        self.assertEqual(repair.suspect_pages(pages, [2], 1), [1])
+
+    def test_fixed_page_is_spliced_in_and_renumbered(self):
+        fixed = [{'date': '03-02-2024', 'details': 'Row 3', 'amount': 25.0, 'balance': 155.0},
+                 {'date': '03-02-2024', 'details': 'Row 3b', 'amount': 5.0, 'balance': 160.0},
+                 {'date': '04-02-2024', 'details': 'Row 4', 'amount': 40.0, 'balance': 200.0}]
+        parser = _PageParser({self.PAGES[0]: self.rows[:2], self.PAGES[1]: fixed})
+        result = repair.repair_statement(self.statement, parser=parser, max_pages=3)
+
+        self.assertEqual((result['mismatches_before'], result['mismatches_after']), (1, 0))
+        self.assertEqual([(page['page'], page['outcome']) for page in result['pages']],
+                         [(1, 'unchanged'), (2, 'fixed')])
+        self.assertEqual(result['row_count'], 5)
+
+        table, _ = statement_store.load_table(self.statement)
+        rows = table.to_dicts()
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual([row['balance'] for row in rows], [110.0, 130.0, 155.0, 160.0, 200.0])
+        self.assertEqual(verify_table(table), [])
+
+    def test_document_is_closed_when_a_page_fails(self):
+        opened = []
+        real_open = repair.fitz.open
+
+        def tracking_open(*args, **kwargs):
+            opened.append(real_open(*args, **kwargs))
+            return opened[-1]
+
+        parser = mock.Mock(extract_transactions_gpt=mock.Mock(side_effect=RuntimeError('boom')))
+        with mock.patch.object(repair.fitz, 'open', tracking_open), self.assertRaises(RuntimeError):
+            repair.repair_statement(self.statement, parser=parser, max_pages=3)
+        self.assertTrue(opened[0].is_closed)
+
+
+class _WindowParser:
+    """
+    Answers the first page window of a statement, then gives up.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def extract__from_text_transactions_gpt(self, text):
+        if self.rows is None:
+            raise LLMUnavailableError('rate limited')
+        rows, self.rows = self.rows, None
+        return {'account_info': {'account_number': '9'}, 'transactions': rows}
+
+
+@override_settings(LLM_ROUTING='fixed')
+class PageStreamTests(MongoMixin, TestCase):
+    def test_failure_discards_sql_and_mongo_rows(self):
+        doc = repair.fitz.open()
+        for text in ('110.00 130.00', '160.00 200.00'):
+            doc.new_page().insert_text((72, 72), text)
+        file_bytes = doc.tobytes()
+
+        with self.assertRaises(LLMUnavailableError):
+            page_stream.process_document(file_bytes, offload=lambda fn, *args: fn(*args), window=1,
+                                         parser=_WindowParser(_rows(10.0, 20.0)))
+        self.assertFalse(ExtractedStatement.objects.exists())
+        self.assertEqual(mongo_store.get_transactions_collection().count_documents(
+            {'document_hash': mongo_store.document_hash(file_bytes)}), 0)
+
+
+@override_settings(PIPELINE_PATHS=['text', 'vision'], PIPELINE_EXPLORE=0, PIPELINE_MAX_ATTEMPTS=2)
+class PathSelectorTests(TestCase):
+    FEATURES = {'pages': 1, 'bytes': 100, 'sampled': False, 'text_share': 1.0, 'layout': 'text', 'template': 't'}
+
+    def _analyze(self, answers):
+        paths = []
+
+        def run_path(path, file_bytes, offload, llm_gate):
+            paths.append(path)
+            return answers[path]
+
+        with mock.patch.object(path_selector, 'pdf_features', return_value=self.FEATURES), \
+                mock.patch.object(path_selector, '_run_path', run_path):
+            return path_selector.analyze(b'%PDF', rng=mock.Mock(random=lambda: 1.0)), paths
+
+    def test_mismatches_are_reported_not_retried(self):
+        tampered = _rows(10.0, 20.0)
+        tampered[1]['balance'] = 500.0
+        data, paths = self._analyze({'text': {'transactions': tampered}, 'vision': {'transactions': _rows(10.0)}})
+        self.assertEqual(paths, ['text'])
+        self.assertIs(data['transactions'], tampered)
+        run = PipelineRun.objects.get()
+        self.assertTrue(run.passed)
+        self.assertEqual(run.mismatch_count, 1)
+
+    def test_unreadable_rows_fall_back(self):
+        garbled = _rows(10.0, 20.0)
+        garbled[1]['amount'] = 'N/A'
+        data, paths = self._analyze({'text': {'transactions': garbled}, 'vision': {'transactions': _rows(10.0)}})
+        self.assertEqual(paths, ['text', 'vision'])
+        self.assertEqual(len(data['transactions']), 1)
+        self.assertEqual(list(PipelineRun.objects.order_by('attempt').values_list('passed', flat=True)), [False, True])
+
+    def test_nothing_usable_keeps_the_most_readable(self):
+        worse, better = _rows(1.0, 2.0, 3.0), _rows(1.0, 2.0, 3.0)
+        worse[0]['amount'] = worse[1]['amount'] = 'N/A'
+        better[2]['balance'] = 'N/A'
+        data, _ = self._analyze({'text': {'transactions': worse}, 'vision': {'transactions': better}})
+        self.assertIs(data['transactions'], better)
+
+
+def _pdf(*pages):
+    doc = repair.fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    return doc.tobytes()
+
+
+def _probe_pdf(*kinds):
+    """
+    A PDF with one page per kind: 'text', 'scan' (an image only), 'stamped'
+    (a scan with a short stamp), 'captioned' (a scan with a text layer) or
+    'empty'.
+    """
+    fitz = repair.fitz
+    pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 8, 8), False)
+    pixmap.clear_with(200)
+    image = pixmap.tobytes('png')
+    doc = fitz.open()
+    for kind in kinds:
+        page = doc.new_page()
+        if kind in ('scan', 'stamped', 'captioned'):
+            page.insert_image(fitz.Rect(72, 72, 300, 300), stream=image)
+        if kind == 'text':
+            page.insert_text((72, 72), 'Opening balance 100.00')
+        elif kind == 'stamped':
+            page.insert_text((72, 400), 'COPY')
+        elif kind == 'captioned':
+            page.insert_text((72, 400), '01-02-2024 Salary credit 1,200.00 balance 1,300.00 ' * 2)
+    return doc.tobytes()
+
+
+class PdfProbeTests(SimpleTestCase):
+    def test_page_verdicts(self):
+        pdf = _probe_pdf('text', 'scan', 'empty', 'stamped', 'captioned')
+        with pdf_extractor.PdfProbe.open(pdf) as probe:
+            self.assertEqual([verdict for _, verdict in probe.verdicts()],
+                             ['text', 'image', 'empty', 'image', 'text'])
+
+    def test_one_kind_stops_after_the_sample_size(self):
+        self.assertEqual(pdf_extractor.PROBE_SAMPLE_SIZE, 29)
+        with pdf_extractor.PdfProbe.open(_probe_pdf(*['text'] * 60)) as probe:
+            self.assertEqual((probe.layout, probe.sampled, probe.text_pages), ('text', 29, 29))
+            self.assertEqual(probe.order[:2], [0, 59])
+            self.assertEqual(sorted(probe.order), list(range(60)))
+        with pdf_extractor.PdfProbe.open(_probe_pdf(*['scan'] * 5), sample_size=3) as probe:
+            self.assertEqual((probe.layout, probe.sampled), ('scanned', 3))
+            self.assertEqual(probe.verdict(4), 'image')
+
+    def test_both_kinds_make_a_hybrid(self):
+        with pdf_extractor.PdfProbe.open(_probe_pdf('text', 'text', 'text', 'scan')) as probe:
+            self.assertEqual((probe.layout, probe.sampled), ('hybrid', 2))
+        with pdf_extractor.PdfProbe.open(_probe_pdf('empty', 'empty')) as probe:
+            self.assertEqual(probe.layout, 'text')
+
+    def test_opens_bytes_paths_and_file_objects(self):
+        pdf = _probe_pdf('scan', 'scan')
+        upload = io.BytesIO(pdf)
+        upload.seek(5)
+        self.assertTrue(pdf_extractor.is_image_based_pdf(upload))
+        self.assertEqual(upload.tell(), 0)
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+            f.write(_probe_pdf('text'))
+            f.flush()
+            self.assertFalse(pdf_extractor.is_image_based_pdf(f.name))
+
+
+@override_settings(LLM_ROUTING='fixed')
+class OfflineTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'a.pdf')
+        with open(self.path, 'wb') as f:
+            f.write(_pdf('Statement'))
+
+    def test_file_hash_matches_document_hash(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(offline.file_hash(self.path), mongo_store.document_hash(f.read()))
+
+    def test_rows_are_checked_like_uploads(self):
+        rows = [{'id': 1, 'date': '01-02-2024', 'details': 'Opening', 'amount': 0, 'balance': None},
+                {'id': 2, 'date': '02-02-2024', 'details': 'Garbled', 'amount': 'N/A', 'balance': 100.0},
+                {'id': 3, 'date': '03-02-2024', 'details': 'Fee', 'amount': -10.0, 'balance': 90.0}]
+        parser = mock.Mock(**{'extract__from_text_transactions_gpt.return_value': {'transactions': rows}})
+        with mock.patch.object(pdf_extractor, 'extract_text_from_bytes', return_value='text'), \
+                mock.patch.object(offline, '_parser', parser):
+            result = offline.process_file(self.path, 'hash')
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['mismatch_count'], 1)
+        self.assertEqual([row['mismatch'] for row in result['transactions']], [False, True, False])
+
+    def test_text_extraction_removes_its_temp_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.object(tempfile, 'tempdir', directory.name):
+            self.assertIn('Statement', pdf_extractor.extract_using_pdfplumber(io.BytesIO(_pdf('Statement'))))
+        self.assertEqual(os.listdir(directory.name), [])
+
+
+class LlmJsonTests(SimpleTestCase):
+    ANSWER = ('```json\n{"account_info": {"holder_name": "A {B}"}, "transactions": ['
+              '{"id": 1, "details": "Paid \\"Joe\\" {rent} [May]", "amount": -12.5, "balance": 87.5}, '
+              '{"id": 2, "details": "back\\\\slash }", "amount": 2, "balance": 89.5}]}\n```')
+
+    def test_truncated_objects_and_arrays_are_closed(self):
+        self.assertEqual(close_truncated('{"a": [1, {"b": 2}, {"c": '), '{"a": [1, {"b": 2}]}')
+        self.assertEqual(loads_lenient('[{"a": 1}, {"a": 2}, {"a"'), [{'a': 1}, {'a': 2}])
+        self.assertIsNone(close_truncated('{"a": "no close'))
+
+    def test_strings_with_braces_and_escapes(self):
+        data, complete = parse_statement(self.ANSWER)
+        self.assertTrue(complete)
+        self.assertEqual(data['account_info'], {'holder_name': 'A {B}'})
+        self.assertEqual([row['details'] for row in data['transactions']],
+                         ['Paid "Joe" {rent} [May]', 'back\\slash }'])
+
+    def test_stream_emits_rows_as_they_close(self):
+        parser = StatementStreamParser()
+        events = []
+        for c in self.ANSWER:
+            events.extend(kind for kind, _ in parser.feed(c))
+        self.assertEqual(events, ['account_info', 'transaction', 'transaction'])
+        self.assertTrue(parser.complete)
+
+    def test_number_cut_off_drops_the_row(self):
+        cut = self.ANSWER.index('"amount": 2') + len('"amount": 2')
+        data, complete = parse_statement(self.ANSWER[:cut])
+        self.assertFalse(complete)
+        self.assertEqual([row['id'] for row in data['transactions']], [1])
+
+    def test_malformed_row_is_skipped(self):
+        parser = StatementStreamParser()
+        parser.feed('{"transactions": [{"id": 1}, {"id": 2,}, {"id": 3}]}')
+        self.assertEqual([row['id'] for row in parser.transactions], [1, 3])
+        self.assertEqual(parser.skipped, 1)
+
+    def test_continuation_drops_overlap_and_renumbers(self):
+        rows = [{'id': 1, 'date': '01-02-2024', 'amount': 1.0, 'balance': 101.0},
+                {'id': 2, 'date': '02-02-2024', 'amount': 2.0, 'balance': 103.0}]
+        tail = [{'id': 1, 'date': '01-02-2024', 'amount': 1.0, 'balance': 101.0},
+                {'id': 2, 'date': '02-02-2024', 'amount': 2.0, 'balance': 103.0},
+                {'id': 3, 'date': '03-02-2024', 'amount': 3.0, 'balance': 106.0}]
+        self.assertEqual(continuation_rows(rows, tail), [tail[2]])
+        restarted = [{'id': 1, 'date': '03-02-2024', 'amount': 3.0, 'balance': 106.0},
+                     {'id': 2, 'date': '04-02-2024', 'amount': 4.0, 'balance': 110.0}]
+        self.assertEqual([row['id'] for row in continuation_rows(rows, restarted)], [3, 4])
+
+
+class _StreamingBackend(LLMBackend):
+    """
+    Streams ``answer`` a few characters at a time; complete() returns the
+    continuation answers in turn.
+    """
+
+    def __init__(self, answer, *continuations):
+        self.answer = answer
+        self.continuations = list(continuations)
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        return LLMResponse(self.continuations.pop(0), model, 'openai')
+
+    def stream(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        for i in range(0, len(self.answer), 7):
+            yield LLMResponse(self.answer[i:i + 7], model, 'openai')
+        yield LLMResponse('', model, 'openai', finish_reason='stop')
+
+
+class StreamingExtractionTests(TransactionTestCase):
+    ANSWER = ('{"account_info": {"account_number": "42", "final_balance": "1,000.00"}, "transactions": ['
+              '{"id": 1, "date": "01-02-2024", "amount": "-1,000.50", "balance": "2,000.00"}, '
+              '{"id": 2, "date": "02-02-2024", "amount": "N/A", "balance": "2,000.00"}]}')
+
+    def _events(self, backend):
+        return list(BankStatementParser(backend=backend).stream_transactions_gpt('statement text'))
+
+    def test_streamed_rows_are_validated_and_stored_as_shown(self):
+        events = self._events(_StreamingBackend(self.ANSWER))
+        self.assertEqual([kind for kind, _ in events], ['account_info', 'transaction', 'transaction', 'done'])
+        self.assertEqual(events[0][1]['final_balance'], 1000.0)
+        self.assertEqual((events[1][1]['amount'], events[1][1]['balance']), (-1000.5, 2000.0))
+        self.assertEqual(events[2][1]['amount'], 'N/A')
+        done = events[-1][1]
+        self.assertEqual(done['account_info'], events[0][1])
+        self.assertEqual(done['transactions'], [events[1][1], events[2][1]])
+
+    def test_cut_off_answer_continues_with_validated_rows(self):
+        cut = self.ANSWER.index('{"id": 2')
+        rest = ('{"transactions": [{"id": 1, "date": "01-02-2024", "amount": "-1,000.50", "balance": "2,000.00"}, '
+                '{"id": 2, "date": "02-02-2024", "amount": "5", "balance": "2,005.00"}]}')
+        events = self._events(_StreamingBackend(self.ANSWER[:cut], rest))
+        rows = [value for kind, value in events if kind == 'transaction']
+        self.assertEqual([(row['id'], row['amount']) for row in rows], [(1, -1000.5), (2, 5.0)])
+        self.assertEqual(events[-1][1]['transactions'], rows)
+
+    def test_upload_stream_sends_the_stored_rows(self):
+        backend = _StreamingBackend(self.ANSWER)
+        stored = {}
+
+        def store(file_bytes, data, filename=''):
+            stored.update(data)
+            return mock.Mock(row_count=len(data['transactions']))
+
+        with mock.patch.object(pipeline, 'extract_text', return_value='statement text'), \
+                mock.patch.object(pipeline, 'BankStatementParser', lambda: BankStatementParser(backend=backend)), \
+                mock.patch.object(pipeline, 'store_statement', store), \
+                mock.patch.object(statement_store, 'remember_statement'):
+            response = self.client.post(reverse('statement_analyzer:upload_stream'),
+                                        {'file': io.BytesIO(b'%PDF-1.4')})
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            body = b''.join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.splitlines())
+            events.append((lines['event'], json.loads(lines['data'])))
+        self.assertEqual([kind for kind, _ in events],
+                         ['status', 'status', 'account_info', 'transaction', 'transaction', 'done'])
+        rows = [value for kind, value in events if kind == 'transaction']
+        self.assertEqual([row['mismatch'] for row in rows], [False, True])
+        self.assertEqual([{k: v for k, v in row.items() if k not in ('index', 'mismatch')} for row in rows],
+                         stored['transactions'])
+        self.assertEqual(events[-1][1]['rows'], 2)
+        self.assertEqual(events[-1][1]['mismatches'], 1)
+
+
+class CassetteTests(SimpleTestCase):
+    MESSAGES = [{'role': 'user', 'content': 'statement text'}]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.inner = mock.Mock(spec=LLMBackend)
+        self.inner.complete.side_effect = lambda model, *args: LLMResponse('{"n": %d}' % self.inner.complete.call_count,
+                                                                           model, 'openai')
+        self.inner.stream.side_effect = lambda model, *args: iter([
+            LLMResponse('{"streamed"', model, 'openai', prompt_tokens=5),
+            LLMResponse(': true}', model, 'openai', completion_tokens=3, finish_reason='stop'),
+        ])
+
+    def test_modes_need_a_known_mode_and_an_inner_backend_to_record(self):
+        with self.assertRaises(ValueError):
+            CassetteBackend(self.directory, inner=self.inner, mode='rewind')
+        with self.assertRaises(ValueError):
+            CassetteBackend(self.directory, mode='once')
+
+    def test_replay_misses_once_records_and_record_overwrites(self):
+        with self.assertRaises(CassetteMissError):
+            CassetteBackend(self.directory).complete('gpt-4o', self.MESSAGES)
+        once = CassetteBackend(self.directory, inner=self.inner, mode='once')
+        self.assertEqual(once.complete('gpt-4o', self.MESSAGES).text, '{"n": 1}')
+        self.assertEqual(once.complete('gpt-4o', self.MESSAGES).text, '{"n": 1}')
+        key = prompt_key('gpt-4o', self.MESSAGES)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, key[:2], f'{key}.json')))
+        # max_tokens is part of the key, response_format is not.
+        self.assertEqual(once.complete('gpt-4o', self.MESSAGES, max_tokens=10).text, '{"n": 2}')
+        self.assertEqual(once.complete('gpt-4o', self.MESSAGES, response_format={'type': 'json_object'}).text,
+                         '{"n": 1}')
+
+        CassetteBackend(self.directory, inner=self.inner, mode='record').complete('gpt-4o', self.MESSAGES)
+        self.assertEqual(CassetteBackend(self.directory).complete('gpt-4o', self.MESSAGES).text, '{"n": 3}')
+        self.assertEqual(self.inner.complete.call_count, 3)
+
+    def test_stream_records_the_joined_pieces_and_replays_them_whole(self):
+        recorder = CassetteBackend(self.directory, inner=self.inner, mode='record')
+        self.assertEqual(len(list(recorder.stream('gpt-4o', self.MESSAGES))), 2)
+        replayed = list(CassetteBackend(self.directory).stream('gpt-4o', self.MESSAGES))
+        self.assertEqual(replayed, [LLMResponse('{"streamed": true}', 'gpt-4o', 'openai', 5, 3, 'stop')])
+
+
+class StandInTests(SimpleTestCase):
+    MESSAGES = [{'role': 'user', 'content': 'Extract the transactions'}]
+
+    def _backend(self, **config):
+        server = llm_standin.make_server(port=0, config=llm_standin.StandInConfig(seed=1, **config))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return StandInBackend(f'http://127.0.0.1:{server.server_port}/v1', max_retries=0)
+
+    def test_canned_statement_complete_and_streamed(self):
+        backend = self._backend()
+        response = backend.complete('gemini-1.5-flash', self.MESSAGES)
+        self.assertEqual(response.provider, 'gemini')
+        self.assertEqual(json.loads(response.text), llm_standin.DEFAULT_EXTRACTION_RESPONSE)
+        self.assertGreater(response.prompt_tokens, 0)
+        streamed = join_pieces(list(backend.stream('gpt-4o', self.MESSAGES)))
+        self.assertEqual((streamed.text, streamed.provider, streamed.finish_reason), (response.text, 'openai', 'stop'))
+        self.assertEqual(streamed.completion_tokens, response.completion_tokens)
+
+    def test_recorded_answers_and_fraud_prompts(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        CassetteBackend(directory.name).save(prompt_key('gpt-4o', self.MESSAGES), 'gpt-4o',
+                                             LLMResponse('{"recorded": 1}', 'gpt-4o', 'openai'))
+        backend = self._backend(cassette_dir=directory.name, fraud_response='[{"issue_type": "x"}]')
+        self.assertEqual(backend.complete('gpt-4o', self.MESSAGES).text, '{"recorded": 1}')
+        fraud = [{'role': 'user', 'content': 'Look for signs of tampering'}]
+        self.assertEqual(backend.complete('gpt-4o', fraud).text, '[{"issue_type": "x"}]')
+
+    def test_rpm_limit_answers_429_with_retry_after(self):
+        from openai import RateLimitError
+
+        backend = self._backend(rpm_limit=1)
+        backend.complete('gpt-4o', self.MESSAGES)
+        with self.assertRaises(RateLimitError) as caught:
+            backend.complete('gpt-4o', self.MESSAGES)
+        self.assertGreater(float(caught.exception.response.headers['retry-after']), 59)
+
+
+def _box(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+
+def _ocr_page(rows, top=300, wrapped=()):
+    """
+    Line boxes of a 1000 x 1400 pixel statement page: two header lines, a
+    table of ``rows`` rows of date, details and amount, with the details of
+    the rows in ``wrapped`` running onto a second line, and a footer.
+    """
+    boxes = [_box(50, 50, 400, 70), _box(50, 100, 300, 120)]
+    y = top
+    for row in range(rows):
+        boxes += [_box(50, y, 150, y + 20), _box(200, y, 500, y + 20), _box(700, y, 800, y + 20)]
+        y += 40
+        if row in wrapped:
+            boxes.append(_box(200, y, 450, y + 20))
+            y += 40
+    return boxes + [_box(50, 1300, 600, 1320)]
+
+
+class RapidOcrLayoutTests(SimpleTestCase):
+    def test_rows_and_columns_are_rebuilt_from_boxes(self):
+        lines = [(_box(300, 141, 400, 161), '10.00'), (_box(100, 100, 180, 120), 'Date'),
+                 (_box(300, 100, 420, 120), 'Amount'), (_box(100, 140, 180, 160), '01-02'),
+                 (_box(0, 0, 10, 10), '  ')]
+        self.assertEqual(rapid_ocr.layout_text(lines), 'Date      Amount\n01-02     10.00')
+        self.assertEqual(rapid_ocr.layout_text([]), '')
+
+    def test_skew_is_taken_out_before_grouping_rows(self):
+        # Each row drifts 8px down per column: more than half a line across the page.
+        lines = [(_box(300 * column, y + 8 * column, 300 * column + 100, y + 8 * column + 20), text)
+                 for y, texts in ((90, 'ABC'), (130, 'DEF')) for column, text in enumerate(texts)]
+        items = [rapid_ocr._item(box, text) for box, text in lines]
+        self.assertAlmostEqual(rapid_ocr._skew(items), 8 / 300)
+        self.assertEqual(len(rapid_ocr._group_rows(items, 0.0)), 4)
+        self.assertEqual(rapid_ocr.layout_text(lines), 'A  B  C\nD  E  F')
+
+    def test_table_is_the_longest_run_of_multi_line_rows(self):
+        rows, _ = rapid_ocr._rows(_ocr_page(4, wrapped=(1, 3)))
+        # Wrapped details inside the table are bridged; the last one joins it.
+        self.assertEqual(rapid_ocr._find_table(rows), (2, 7))
+        rows, _ = rapid_ocr._rows(_ocr_page(2))
+        self.assertIsNone(rapid_ocr._find_table(rows))
+
+    def test_template_columns_are_shares_of_the_page_width(self):
+        rows, slope = rapid_ocr._rows(_ocr_page(4))
+        first, last = rapid_ocr._find_table(rows)
+        self.assertEqual(rapid_ocr._columns(rows[first:last + 1], slope, 1000), ((0.0, 0.15, 0.65), (0.1, 0.45, 0.75)))
+        self.assertEqual(rapid_ocr._bounds(rows[first:last + 1]), (50, 300, 800, 440))
+
+
+@override_settings(OCR_ROI=True, OCR_LAYOUT_CACHE=2)
+class RoiCacheTests(SimpleTestCase):
+    IMAGE = mock.Mock(shape=(1400, 1000, 3))
+
+    def setUp(self):
+        for name, value in (('_layouts', []), ('OCR_TABLE_REGIONS', mock.Mock())):
+            patcher = mock.patch.object(rapid_ocr, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.regions = []
+
+    def _find(self, boxes, layout=None, header=False):
+        def detect(engine, image, region=None):
+            self.regions.append(region)
+            x0, y0, x1, y1 = region or (0, 0, 1000, 1400)
+            return [box for box in boxes if x0 <= box[0][0] and box[2][0] <= x1 and y0 <= box[0][1] and box[2][1] <= y1]
+
+        with mock.patch.object(rapid_ocr, 'detect', detect):
+            return rapid_ocr.find_lines(None, self.IMAGE, layout, header=header)
+
+    def _results(self):
+        return [call.kwargs['result'] for call in rapid_ocr.OCR_TABLE_REGIONS.inc.call_args_list]
+
+    def test_first_page_learns_the_template_and_keeps_its_header(self):
+        boxes = _ocr_page(4)
+        kept, skipped, layout = self._find(boxes, header=True)
+        self.assertEqual((len(kept), skipped), (14, 1))
+        self.assertEqual(layout.bounds, (0.05, 300 / 1400, 0.8, 440 / 1400))
+        self.assertEqual(rapid_ocr._layouts, [layout])
+        self.assertEqual((self.regions, self._results()), ([None], ['miss']))
+
+    def test_later_pages_hit_the_region_until_the_table_outgrows_it(self):
+        _, _, layout = self._find(_ocr_page(4), header=True)
+        kept, skipped, same = self._find(_ocr_page(4), layout)
+        self.assertIs(same, layout)
+        self.assertEqual((len(kept), skipped), (12, 0))
+        self.assertEqual(self.regions[1], (20, 258, 831, 483))
+
+        # Two more rows run past the bottom of the region: the page is detected again.
+        kept, skipped, same = self._find(_ocr_page(6), layout)
+        self.assertIs(same, layout)
+        self.assertEqual((len(kept), skipped), (18, 3))
+        self.assertEqual(self.regions[2:], [(20, 258, 831, 483), None])
+        self.assertEqual(layout.bounds[3], 520 / 1400)
+        self.assertEqual(self._results(), ['miss', 'hit', 'stale'])
+
+    def test_templates_are_matched_by_columns_and_evicted_least_recent_first(self):
+        first = rapid_ocr.learn_layout(((0.0, 0.5), (0.1, 0.6)), (0.1, 0.2, 0.8, 0.5))
+        second = rapid_ocr.learn_layout(((0.0, 0.3), (0.1, 0.4)), (0.1, 0.2, 0.8, 0.5))
+        self.assertIs(rapid_ocr.learn_layout(((0.0, 0.505), (0.1, 0.6)), (0.05, 0.3, 0.8, 0.6)), first)
+        self.assertEqual(first.bounds, (0.05, 0.2, 0.8, 0.6))
+        third = rapid_ocr.learn_layout(((0.0, 0.7), (0.1, 0.8)), (0.1, 0.2, 0.8, 0.5))
+        self.assertEqual(rapid_ocr._layouts, [third, first])
+        self.assertNotIn(second, rapid_ocr._layouts)
+
+    @override_settings(OCR_ROI=False)
+    def test_without_roi_every_line_is_kept(self):
+        boxes = _ocr_page(4)
+        self.assertEqual(self._find(boxes), (boxes, 0, None))
+        self.assertEqual(self._results(), [])
+
+
+class _HttpError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+        self.response = mock.Mock(headers={} if retry_after is None else {'retry-after': str(retry_after)})
+
+
+class _ScriptedBackend(LLMBackend):
+    """
+    Raises or returns the given outcomes in turn.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, response_format=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class RateLimitTests(SimpleTestCase):
+    MESSAGES = [{'role': 'user', 'content': 'x' * 400}]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = rate_limit.TokenBucketStore(os.path.join(directory.name, 'buckets.sqlite3'), burst_seconds=60)
+        sleep = mock.patch.object(rate_limit.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def _backend(self, inner, tpm=0, **kwargs):
+        limiter = rate_limit.RateLimiter(self.store, {}, {'openai': tpm})
+        return rate_limit.ResilientBackend(inner, limiter, **kwargs)
+
+    def _response(self, tokens=0):
+        return LLMResponse(text='ok', model='gpt-4o', provider='openai', prompt_tokens=tokens)
+
+    def test_backoff_is_capped_and_jittered(self):
+        rng = mock.Mock(uniform=lambda low, high: high)
+        self.assertEqual([rate_limit.backoff_delay(n, 1.0, 5.0, rng) for n in range(5)], [1.0, 2.0, 4.0, 5.0, 5.0])
+
+    def test_retries_honour_retry_after_up_to_the_cap(self):
+        inner = _ScriptedBackend(_HttpError(429, retry_after=2), _HttpError(503, retry_after=3600), self._response())
+        self.assertEqual(self._backend(inner, backoff_max=30.0).complete('gpt-4o', self.MESSAGES).text, 'ok')
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [2.0, 30.0])
+
+    def test_gives_up_and_never_returns_none(self):
+        for attempts in (0, 2):
+            inner = _ScriptedBackend(*[_HttpError(429)] * 2)
+            with self.assertRaises(LLMUnavailableError):
+                self._backend(inner, max_attempts=attempts).complete('gpt-4o', self.MESSAGES)
+        with self.assertRaises(_HttpError):
+            self._backend(_ScriptedBackend(_HttpError(400))).complete('gpt-4o', self.MESSAGES)
+
+    def test_bucket_takes_all_or_nothing(self):
+        self.assertEqual(self.store.take([('b', 60, 50)]), 0)
+        # b has 10 of the 50 left, about 40s of refill; a is not charged meanwhile.
+        self.assertAlmostEqual(self.store.take([('a', 60, 30), ('b', 60, 50)]), 40, places=0)
+        self.assertEqual(self.store.take([('a', 60, 30)]), 0)
+        self.assertEqual(self.store.take([('a', 60, 30)]), 0)
+        self.assertGreater(self.store.take([('a', 60, 30)]), 0)
+        self.store.give([('a', 60, 30)])
+        self.assertEqual(self.store.take([('a', 60, 30)]), 0)
+
+    def test_failed_attempts_refund_their_tokens(self):
+        estimate = rate_limit.estimate_tokens(self.MESSAGES)
+        inner = _ScriptedBackend(_HttpError(500), self._response(tokens=estimate))
+        self._backend(inner, tpm=60 * estimate).complete('gpt-4o', self.MESSAGES)
+        level = self.store._connection().execute("SELECT level FROM buckets WHERE name = 'openai:tokens'").fetchone()[0]
+        # Started full (one minute's worth); only the successful call was charged.
+        self.assertAlmostEqual(level, 59 * estimate, delta=estimate * 0.01)
+
+    def test_hedge_fires_past_p95_and_keeps_the_primary_latency(self):
+        release = threading.Event()
+
+        class Inner(LLMBackend):
+            calls = 0
+
+            def complete(inner, model, *args):
+                inner.calls += 1
+                if inner.calls == 1:
+                    release.wait(5)
+                    return LLMResponse(text='primary', model=model, provider='openai')
+                return LLMResponse(text='backup', model=model, provider='openai')
+
+        latency = rate_limit.LatencyTracker(min_samples=1)
+        latency.observe('gpt-4o', 0.01)
+        backend = self._backend(Inner(), hedge=True, latency=latency)
+        self.assertEqual(backend.complete('gpt-4o', self.MESSAGES).text, 'backup')
+        self.assertEqual(latency.p95('gpt-4o'), 0.01)  # the backup's quick answer is not recorded
+        release.set()
+        backend._hedge_pool.shutdown(wait=True)
+        self.assertGreater(latency.p95('gpt-4o'), 0.01)  # the primary's, once it finished
+
+
+class RouterTests(SimpleTestCase):
+    def _route(self, name, *outcomes):
+        outcomes = list(outcomes)
+
+        def extract(parser, text):
+            outcome = outcomes.pop(0) if len(outcomes) > 1 else outcomes[0]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return llm_router.Route(name, 'openai', extract)
+
+    def _router(self, *routes, explore=0.0, rng=None):
+        return llm_router.Router(list(routes), backend=LLMBackend(), explore=explore, rng=rng, min_samples=3)
+
+    def _record(self, route, seconds, cost=0.0, ok=True, times=3):
+        for _ in range(times):
+            route.stats.record(ok, seconds, cost)
+
+    def test_scores_rank_latency_errors_and_cost(self):
+        fast, slow, cheap = self._route('fast', {}), self._route('slow', {}), self._route('cheap', {})
+        self._record(fast, 1.0, cost=0.01)
+        self._record(slow, 3.0, cost=0.01)
+        self._record(cheap, 2.0, cost=0.0)
+        router = self._router(slow, fast, cheap)
+        self.assertEqual(router.score(fast), 1.0 + 20 * 0.01)
+        self.assertEqual([route.name for route in router.ranked()], ['fast', 'cheap', 'slow'])
+        self._record(fast, 1.0, ok=False, times=1)  # one failure in four: 1s * (1 + 4 * 0.25) + 0.2
+        self.assertEqual([route.name for route in router.ranked()], ['cheap', 'fast', 'slow'])
+
+    def test_unsampled_routes_stay_behind_the_first(self):
+        router = self._router(self._route('first', {}), self._route('second', {}))
+        self.assertEqual([route.name for route in router.ranked()], ['first', 'second'])
+
+    def test_failover_and_cooldown(self):
+        data = {'transactions': [{'id': 1}]}
+        broken = self._route('broken', LLMUnavailableError('busy'))
+        spare = self._route('spare', data)
+        router = self._router(broken, spare)
+        for _ in range(3):
+            self.assertEqual(router.extract('text'), data)
+        self.assertFalse(router.healthy(broken))
+        self.assertEqual([route.name for route in router.ranked()], ['spare', 'broken'])
+        router.cooldown = 0
+        self.assertTrue(router.healthy(broken))
+
+    def test_every_route_unavailable_raises(self):
+        router = self._router(self._route('a', LLMUnavailableError('a')), self._route('b', None))
+        with self.assertRaises(LLMUnavailableError):
+            router.extract('text')
+        self.assertIsNone(self._router(self._route('a', None), self._route('b', {})).extract('text'))
+
+    def test_exploration_picks_another_healthy_route(self):
+        calls = []
+        first, second = self._route('first', {}), self._route('second', {})
+        for route in (first, second):
+            route.extract = lambda parser, text, name=route.name: calls.append(name) or {'transactions': [{}]}
+        rng = mock.Mock(random=lambda: 0.0, choice=lambda routes: routes[0])
+        self._router(first, second, explore=0.1, rng=rng).extract('text')
+        self._router(first, second, explore=0.0, rng=rng).extract('text')
+        self.assertEqual(calls, ['second', 'first'])
+
+
+class CpuBudgetTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cpu_budget, '_slots', cpu_budget._Slots(1))
+        self.slots = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(CPU_THREADS=8, CPU_PROCESSES=2, CPU_THREADS_PER_TASK=2)
+    def test_budget_arithmetic(self):
+        self.assertEqual(cpu_budget.process_threads(), 4)
+        self.assertEqual(cpu_budget.threads_per_task(), 2)
+        self.assertEqual(cpu_budget.task_slots(), 2)
+        self.assertEqual(cpu_budget.task_slots(processes=8), 1)
+
+    @override_settings(CPU_QUEUE_TIMEOUT=0.05)
+    def test_busy_slot_turns_uploads_away(self):
+        self.slots.acquire()
+        with self.assertRaises(cpu_budget.ServerBusyError):
+            with cpu_budget.cpu_slot():
+                pass
+        self.slots.release()
+        with cpu_budget.cpu_slot(), cpu_budget.cpu_slot():  # nested: one slot
+            pass
+
+    def test_uploads_go_before_queued_background_work(self):
+        order = []
+        self.slots.acquire()
+
+        def take(name, background):
+            self.slots.acquire(background=background)
+            order.append(name)
+            self.slots.release()
+
+        threads = [threading.Thread(target=take, args=(f'batch{n}', True)) for n in range(3)]
+        threads.append(threading.Thread(target=take, args=('upload', False)))
+        for queued, thread in enumerate(threads, 1):
+            thread.start()
+            while len(self.slots._waiters) + len(self.slots._background) < queued:  # queue in this order
+                time.sleep(0.001)
+        self.slots.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['upload', 'batch0', 'batch1', 'batch2'])
+
+
+class MetricsViewTests(TestCase):
+    def setUp(self):
+        self.url = reverse('statement_analyzer:metrics')
+
+    def test_disabled_by_default(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN='s3cret')
+    def test_needs_staff_or_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE http_request_seconds histogram', response.content)
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN='')
+    def test_empty_token_is_not_a_password(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class InstrumentationTests(SimpleTestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = instrumentation.Histogram('h', 'Test.', ('stage',), buckets=(1, 5))
+        for value in (0.5, 2, 10):
+            histogram.observe(value, stage='a"b')
+        lines = histogram.collect()
+        self.assertIn('h_bucket{stage="a\\"b",le="1"} 1', lines)
+        self.assertIn('h_bucket{stage="a\\"b",le="5"} 2', lines)
+        self.assertIn('h_bucket{stage="a\\"b",le="+Inf"} 3', lines)
+        self.assertIn('h_count{stage="a\\"b"} 3', lines)
+
+    def test_nested_spans_are_traced_with_their_outcome(self):
+        token = instrumentation.start_trace()
+        with instrumentation.span('test_outer', pages=2) as outer:
+            with self.assertRaises(KeyError):
+                with instrumentation.span('test_inner'):
+                    raise KeyError('x')
+            outer.add(pages=1, rows=0)
+        spans = instrumentation.end_trace(token)
+        self.assertEqual([(s.stage, s.outcome) for s in spans], [('test_inner', 'error'), ('test_outer', 'ok')])
+        self.assertEqual(outer.counts, {'pages': 3})
+        self.assertGreaterEqual(spans[1].duration, spans[0].duration)
+
+    @override_settings(TRACE_STAGE_MEMORY=True)
+    def test_memory_peaks_include_nested_spans(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+        with instrumentation.span('test_outer') as outer:
+            with instrumentation.span('test_inner') as inner:
+                block = bytearray(4 * 1024 * 1024)
+                del block
+        self.assertGreaterEqual(inner.peak_memory, 4 * 1024 * 1024)
+        self.assertGreaterEqual(outer.peak_memory, inner.peak_memory)
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_middleware_times_requests_and_logs_slow_ones(self):
+        from .middleware import RequestTimingMiddleware
+
+        def view(request):
+            with instrumentation.span('test_stage'):
+                pass
+            return HttpResponse(status=201)
+
+        request = mock.Mock(method='GET', path='/x/', resolver_match=mock.Mock(view_name='test:view'))
+        with self.assertLogs('statement_analyzer.middleware', 'WARNING') as logs:
+            self.assertEqual(RequestTimingMiddleware(view)(request).status_code, 201)
+        self.assertIn("'stage': 'test_stage'", logs.output[0])
+        rendered = instrumentation.render_metrics()
+        self.assertIn('http_request_seconds_count{view="test:view",status="2xx"} 1', rendered)
+        self.assertIn('http_slow_requests_total{view="test:view"} 1', rendered)
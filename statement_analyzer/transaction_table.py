@@ -0,0 +1,287 @@
+"""
+Compact, column-oriented storage for extracted transactions.
+
+Money is kept as integer cents and dates as proleptic ordinals, each column in
+a typed ``array``. Descriptions and ids are interned into one string pool, so a
+statement that repeats "Instant payment fee" a thousand times stores it once.
+
+The rest of the app still speaks lists of dicts; ``from_dicts``/``to_dicts``
+convert at the edges (LLM output in, templates out).
+"""
+import struct
+import sys
+from array import array
+from datetime import date, datetime
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+# Sentinel for rows without a balance column.
+NO_BALANCE = -(2 ** 63)
+# Bits of the mismatch column. UNREADABLE marks a row whose amount or balance
+# could not be read; it stays set until the row is edited, whatever the
+# running-balance check finds.
+MISMATCH = 1
+UNREADABLE = 2
+
+_MAGIC = b"TXT1"
+_HEADER = struct.Struct("<4sHI")
+_DATE_FORMATS = ("%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%d.%m.%Y")
+_CENT = Decimal("0.01")
+
+
+def to_cents(value):
+    """
+    Converts an extracted monetary value (float, int or string such as
+    "1,025.50 Cr" / "450.75 Dr") into integer cents. The Cr/Dr suffix is
+    dropped and does not change the sign, as in mongo_store._to_float; the
+    extractor gives debits and overdrawn balances as negative numbers.
+    Returns None for empty placeholders and raises ValueError for garbage.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value * 100
+    if isinstance(value, float):
+        # repr() gives the shortest string that round-trips, i.e. what the LLM wrote.
+        text = repr(value)
+    else:
+        text = str(value).replace(",", "").replace("Cr", "").replace("Dr", "").strip()
+        if text in ("", "-", "nan", "null", "None"):
+            return None
+    try:
+        cents = int((Decimal(text) / _CENT).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f"Not a monetary value: {value!r}")
+    return cents
+
+
+def _read_cents(value):
+    """
+    (cents, readable): to_cents, with garbage read as None instead of raising.
+    Values that do not fit the int64 columns (or collide with NO_BALANCE)
+    are unreadable too.
+    """
+    try:
+        cents = to_cents(value)
+    except ValueError:
+        return None, False
+    if cents is not None and not NO_BALANCE < cents < 2 ** 63:
+        return None, False
+    return cents, True
+
+
+def from_cents(cents):
+    return cents / 100
+
+
+def to_ordinal(value):
+    """
+    Returns the date ordinal of a DD-MM-YYYY style string, or None if unparseable.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).toordinal()
+        except ValueError:
+            continue
+    return None
+
+
+def _little_endian(column):
+    if sys.byteorder == "little":
+        return column.tobytes()
+    swapped = array(column.typecode, column)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def _read_column(typecode, data, offset, count):
+    column = array(typecode)
+    size = column.itemsize * count
+    column.frombytes(data[offset:offset + size])
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column, offset + size
+
+
+class TransactionTable:
+    """
+    Transactions of one statement, one typed array per field.
+
+    ``dates`` holds ordinals for parsed dates. A date the parser did not
+    understand is kept verbatim in the string pool and stored as a negative
+    pool reference (-(index + 1)), so nothing is lost on the way through.
+    """
+
+    __slots__ = ("ids", "dates", "details", "amounts", "balances", "mismatch", "strings", "_string_index")
+
+    def __init__(self):
+        self.ids = array("I")
+        self.dates = array("q")
+        self.details = array("I")
+        self.amounts = array("q")
+        self.balances = array("q")
+        self.mismatch = bytearray()
+        self.strings = []
+        self._string_index = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def _intern(self, text):
+        text = "" if text is None else str(text)
+        index = self._string_index.get(text)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(text)
+            self._string_index[text] = index
+        return index
+
+    def _encode(self, entry, index):
+        amount, amount_readable = _read_cents(entry.get("amount"))
+        balance, balance_readable = _read_cents(entry.get("balance"))
+        flags = MISMATCH if entry.get("mismatch") else 0
+        if not (amount_readable and balance_readable):
+            flags |= MISMATCH | UNREADABLE
+        raw_date = entry.get("date")
+        ordinal = to_ordinal(raw_date)
+        if ordinal is None:
+            ordinal = -(self._intern(raw_date) + 1)
+        raw_id = entry.get("id")
+        return (
+            self._intern(index if raw_id is None else raw_id),
+            ordinal,
+            self._intern(entry.get("details")),
+            amount or 0,
+            NO_BALANCE if balance is None else balance,
+            flags,
+        )
+
+    def append(self, entry):
+        """
+        Appends one transaction dict as produced by the extractor. An amount
+        or balance that cannot be read is stored as 0 or NO_BALANCE and the
+        row is flagged UNREADABLE, so one garbled cell does not lose the statement.
+        """
+        id_ref, ordinal, details_ref, amount, balance, mismatch = self._encode(entry, len(self))
+        self.ids.append(id_ref)
+        self.dates.append(ordinal)
+        self.details.append(details_ref)
+        self.amounts.append(amount)
+        self.balances.append(balance)
+        self.mismatch.append(mismatch)
+
+    def set_row(self, index, entry):
+        """
+        Overwrites row ``index`` in place with the values of ``entry``.
+        """
+        (self.ids[index], self.dates[index], self.details[index],
+         self.amounts[index], self.balances[index], self.mismatch[index]) = self._encode(entry, index)
+
+    def extend(self, other):
+        """
+        Appends all rows of another table, re-interning its strings into this pool.
+        """
+        remap = array("I", (self._intern(text) for text in other.strings))
+        self.ids.extend(remap[ref] for ref in other.ids)
+        self.dates.extend(ordinal if ordinal >= 0 else -(remap[-ordinal - 1] + 1) for ordinal in other.dates)
+        self.details.extend(remap[ref] for ref in other.details)
+        self.amounts.extend(other.amounts)
+        self.balances.extend(other.balances)
+        self.mismatch.extend(other.mismatch)
+
+    @classmethod
+    def from_dicts(cls, transactions):
+        table = cls()
+        for entry in transactions:
+            table.append(entry)
+        return table
+
+    # --- Zero-copy access for the verifier ---
+    def amounts_view(self):
+        return memoryview(self.amounts)
+
+    def balances_view(self):
+        return memoryview(self.balances)
+
+    def mismatch_view(self):
+        return memoryview(self.mismatch)
+
+    def unreadable(self, index):
+        return bool(self.mismatch[index] & UNREADABLE)
+
+    # --- Dict adapters for templates and JSON ---
+    def date_string(self, index):
+        ordinal = self.dates[index]
+        if ordinal < 0:
+            return self.strings[-ordinal - 1] or None
+        return date.fromordinal(ordinal).strftime("%d-%m-%Y")
+
+    def row(self, index):
+        raw_id = self.strings[self.ids[index]]
+        balance = self.balances[index]
+        return {
+            "id": int(raw_id) if raw_id.isdigit() else raw_id,
+            "details": self.strings[self.details[index]],
+            "date": self.date_string(index),
+            "amount": from_cents(self.amounts[index]),
+            "balance": None if balance == NO_BALANCE else from_cents(balance),
+            "mismatch": bool(self.mismatch[index]),
+        }
+
+    def iter_rows(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for index in range(start, stop):
+            yield self.row(index)
+
+    def to_dicts(self):
+        return list(self.iter_rows())
+
+    # --- Binary serialization ---
+    def to_bytes(self):
+        """
+        Serializes the table into a compact little-endian binary blob.
+        """
+        encoded = [s.encode("utf-8") for s in self.strings]
+        lengths = array("I", (len(s) for s in encoded))
+        parts = [
+            _HEADER.pack(_MAGIC, 1, len(self)),
+            _little_endian(self.ids),
+            _little_endian(self.dates),
+            _little_endian(self.details),
+            _little_endian(self.amounts),
+            _little_endian(self.balances),
+            bytes(self.mismatch),
+            struct.pack("<I", len(encoded)),
+            _little_endian(lengths),
+        ]
+        parts.extend(encoded)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuilds a table written by to_bytes. Raises ValueError on foreign data.
+        """
+        data = memoryview(data)
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != 1:
+            raise ValueError("Not a serialized TransactionTable.")
+        table = cls()
+        offset = _HEADER.size
+        table.ids, offset = _read_column("I", data, offset, count)
+        table.dates, offset = _read_column("q", data, offset, count)
+        table.details, offset = _read_column("I", data, offset, count)
+        table.amounts, offset = _read_column("q", data, offset, count)
+        table.balances, offset = _read_column("q", data, offset, count)
+        table.mismatch = bytearray(data[offset:offset + count])
+        offset += count
+        (string_count,) = struct.unpack_from("<I", data, offset)
+        lengths, offset = _read_column("I", data, offset + 4, string_count)
+        for length in lengths:
+            text = bytes(data[offset:offset + length]).decode("utf-8")
+            table._string_index[text] = len(table.strings)
+            table.strings.append(text)
+            offset += length
+        return table
@@ -46,37 +46,41 @@
 #     return (len(flagged_entries) == 0), flagged_entries
 
 
+import logging
+
+from .instrumentation import span
+from .transaction_table import MISMATCH, NO_BALANCE, UNREADABLE, from_cents, to_cents
+
+logger = logging.getLogger(__name__)
+
+
+@span("verification")
 def verify_transactions(transactions_list):
     """
     Verifies the integrity of transactions based on running balances.
+    Amounts and balances are compared as integer cents, so no float tolerance
+    is needed. Dict-based and kept for the benchmarks; the app checks a
+    TransactionTable with verify_table, which also flags unreadable cells.
     Args:
         transactions_list: A list of transaction dictionaries.
-                           Each dict may have 'credit', 'debit', and optionally 'balance' keys.
+                           Each dict may have 'amount' and optionally 'balance' keys.
+                           Their 'mismatch' key is set in place.
     Returns:
-        A tuple: (all_good, flagged_entries)
+        A tuple: (flagged_entries, transactions_list)
     """
     if not transactions_list:
-        print("Verifier: No transactions provided.")
-        return True, []
+        logger.info("Verifier: No transactions provided.")
+        return [], transactions_list
 
+    debug = logger.isEnabledFor(logging.DEBUG)
     flagged_entries = []
     previous_running_balance = None
 
     for i, entry in enumerate(transactions_list):
         try:
             entry['mismatch'] = False
-            balance_raw = entry.get('balance')
-            if balance_raw is not None:
-                if isinstance(balance_raw, (int, float)):
-                    current_running_balance = float(balance_raw)
-                else:
-                    balance_str = str(balance_raw).replace('Cr', '').replace('Dr', '').replace(',', '').strip()
-                    current_running_balance = float(balance_str)
-            else:
-                current_running_balance = None
-
-            amount = float(entry.get('amount', 0.0)) if entry.get('amount') not in [None, 'nan', ''] else 0.0
-            # debit_amount = float(entry.get('debit', 0.0)) if entry.get('debit') not in [None, 'nan', ''] else 0.0
+            current_running_balance = to_cents(entry.get('balance'))
+            amount = to_cents(entry.get('amount')) or 0
             description = entry.get('details', 'N/A')
             date = entry.get('date', 'N/A')
 
@@ -88,21 +92,17 @@ def verify_transactions(transactions_list):
             if i == 0:
                 previous_running_balance = current_running_balance
                 continue
-            print(entry.get("id"))
-            
             expected_balance = previous_running_balance + amount
-            tolerance = 0.015
-            print(f"previous_running_balance: {previous_running_balance}")
-            print(f"current_running_balance: {current_running_balance}")
-            print(f"expected_balance: {expected_balance}")
-            print(f"amount: {amount}")
-
-            if abs(expected_balance - current_running_balance) > tolerance:
-                flagged_entries.append(
-                    f"Mismatch at Entry #{i + 1} (Date: {date}, Desc: {description}): "
-                    f"Expected Balance = {expected_balance:.2f}, Actual Balance = {current_running_balance:.2f}, "
-                    f"Prev Balance = {previous_running_balance:.2f}, +Amount = {amount:.2f}"
+            if debug:
+                logger.debug(
+                    "Row %s: previous %s, current %s, expected %s, amount %s",
+                    entry.get("id"), from_cents(previous_running_balance), from_cents(current_running_balance),
+                    from_cents(expected_balance), from_cents(amount),
                 )
+
+            if expected_balance != current_running_balance:
+                flagged_entries.append(_mismatch_message(i, date, description, expected_balance,
+                                                         current_running_balance, previous_running_balance, amount))
                 entry['mismatch'] = True
 
             previous_running_balance = current_running_balance
@@ -117,3 +117,86 @@ def verify_transactions(transactions_list):
     return flagged_entries, transactions_list
 
 
+class RunningBalanceCheck:
+    """
+    The running-balance check fed one row at a time, for callers that never
+    hold the whole statement (streaming exports, incremental extraction).
+    Amounts and balances are integer cents; NO_BALANCE marks a missing balance.
+    """
+
+    __slots__ = ('previous',)
+
+    def __init__(self, previous=None):
+        self.previous = previous
+
+    def feed(self, amount, balance):
+        """
+        Checks one row and advances the carried balance.
+        Returns (mismatch, expected_balance, previous_balance); expected is None
+        when the row could not be checked.
+        """
+        previous = self.previous
+        if balance == NO_BALANCE:
+            if previous is not None:
+                self.previous = previous + amount
+            return False, None, previous
+        self.previous = balance
+        if previous is None:
+            return False, None, None
+        expected = previous + amount
+        return expected != balance, expected, previous
+
+
+def carried_balance(table, start):
+    """
+    The balance carried into row ``start``: the last stated balance before it
+    plus the amounts in between, or None if no earlier row has a balance.
+    """
+    amounts = table.amounts_view()
+    balances = table.balances_view()
+    for i in range(min(start, len(amounts)) - 1, -1, -1):
+        if balances[i] != NO_BALANCE:
+            return balances[i] + sum(amounts[i + 1:start])
+    return None
+
+
+@span("verification")
+def verify_table(table, start=0):
+    """
+    Running-balance check over a TransactionTable, working directly on its
+    cent columns. Sets table.mismatch in place and returns the flagged
+    messages. Rows whose amount or balance could not be read stay flagged.
+
+    With ``start`` > 0 only rows from ``start`` on are re-checked; the balance
+    carried into that row is taken from the rows before it, which is what an
+    edit of a single row needs.
+    """
+    amounts = table.amounts_view()
+    balances = table.balances_view()
+    mismatch = table.mismatch_view()
+    flagged_entries = []
+    start = min(start, len(amounts))
+
+    check = RunningBalanceCheck(carried_balance(table, start))
+    for i in range(start, len(amounts)):
+        is_mismatch, expected_balance, previous_running_balance = check.feed(amounts[i], balances[i])
+        unreadable = mismatch[i] & UNREADABLE
+        mismatch[i] = unreadable | (MISMATCH if is_mismatch or unreadable else 0)
+        if unreadable:
+            row = table.row(i)
+            flagged_entries.append(f"Unreadable amount or balance at Entry #{i + 1} "
+                                   f"(Date: {row['date']}, Desc: {row['details']})")
+        elif is_mismatch:
+            row = table.row(i)
+            flagged_entries.append(_mismatch_message(i, row['date'], row['details'], expected_balance,
+                                                     balances[i], previous_running_balance, amounts[i]))
+
+    return flagged_entries
+
+
+def _mismatch_message(i, date, description, expected_balance, current_running_balance, previous_running_balance, amount):
+    return (
+        f"Mismatch at Entry #{i + 1} (Date: {date}, Desc: {description}): "
+        f"Expected Balance = {from_cents(expected_balance):.2f}, Actual Balance = {from_cents(current_running_balance):.2f}, "
+        f"Prev Balance = {from_cents(previous_running_balance):.2f}, +Amount = {from_cents(amount):.2f}"
+    )
@@ -5,7 +5,19 @@ app_name = 'statement_analyzer' # Optional: for namespacing URLs
 
 urlpatterns = [
     path('upload/', views.upload_and_analyze_statement, name='upload_statement'),
+    path('upload/stream/', views.upload_stream, name='upload_stream'),
+    path('batch/', views.upload_batch, name='upload_batch'),
+    path('batch/<uuid:key>/', views.view_batch, name='view_batch'),
+    path('batch/<uuid:key>/status/', views.batch_status, name='batch_status'),
+    path('batch/<uuid:key>/items/<int:index>/', views.open_batch_item, name='open_batch_item'),
+    path('batch/<uuid:key>/export/csv/', views.export_batch_csv, name='export_batch_csv'),
     path('transactions/', views.view_transactions_data, name='view_transactions_data'),
+    path('transactions/rows/', views.transaction_rows, name='transaction_rows'),
+    path('export/csv/', views.export_transactions_csv, name='export_transactions_csv'),
+    path('export/xlsx/', views.export_transactions_xlsx, name='export_transactions_xlsx'),
     path('revalidate/', views.revalidate_transactions, name='revalidate_transactions'),
-    path('issues/', views.view_other_issue, name='view_other_issue')
+    path('repair/', views.repair_transactions, name='repair_transactions'),
+    path('issues/', views.view_other_issue, name='view_other_issue'),
+    path('api/transactions/', views.query_transactions, name='query_transactions'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,157 +1,60 @@
-from io import BytesIO
+import hmac
 import json
-import base64
-from PIL import Image # Make sure Pillow is installed: pip install Pillow
-from django.shortcuts import render
+import logging
+import math
+from django.shortcuts import get_object_or_404, redirect, render
 from django.conf import settings
-from pymongo import MongoClient, errors as pymongo_errors
-from .forms import UploadFileForm
-from pdf2image import convert_from_bytes, exceptions
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-
+from pymongo import errors as pymongo_errors
+from .forms import BatchUploadForm, UploadFileForm
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.gzip import gzip_page
+from django.urls import reverse
 
 from .data_extractor import BankStatementParser
-# from .fraud_detector import detect_fraud_from_bank_images  # your GPT-based analyzer
-
-import io
-import traceback
-
-# --- Import your custom scripts (adjust paths/names as needed) ---
-# Option 1: If they are simple .py files in the same directory
-from . import pdf_extractor
 from . import transaction_verifier
-
-# Option 2: If they are structured as modules or you prefer explicit calls
-# import statement_analyzer.pdf_extractor as pdf_extractor_module
-# import statement_analyzer.transaction_verifier as transaction_verifier_module
+from . import mongo_store
+from . import statement_store
+from . import exporter
+from . import cpu_budget
+from . import pipeline
+from . import repair
+from . import batch as batch_processing
+from .models import BatchItem, StatementBatch
+from . import instrumentation
+from .instrumentation import span
+from .llm_backends import LLMUnavailableError
+from .lazy import lazy_import
+from .streaming import EventStream
+from .transaction_table import NO_BALANCE, to_cents
+
+# Loaded on first use; see lazy.py
+pdf2image = lazy_import("pdf2image")
+
+logger = logging.getLogger(__name__)
 
 
 # --- Helper function to connect to MongoDB ---
 def get_mongo_collection():
     try:
-        client = MongoClient(settings.MONGO_URI, serverSelectionTimeoutMS=5000) # Added timeout
-        # The ismaster command is cheap and does not require auth.
-        client.admin.command('ismaster') # Verify connection
-        db = client[settings.MONGO_DATABASE_NAME]
-        collection = db[settings.MONGO_COLLECTION_NAME]
-        return collection
-    except pymongo_errors.ServerSelectionTimeoutError as err:
-        # Handle connection error to MongoDB
-        print(f"MongoDB Connection Error: {err}")
-        return None
+        # Shared, pooled client; see mongo_store.get_mongo_client
+        return mongo_store.get_transactions_collection()
     except Exception as e:
-        print(f"An unexpected error occurred with MongoDB connection: {e}")
+        logger.error("An unexpected error occurred with MongoDB connection: %s", e)
         return None
 
-# def upload_and_analyze_statement(request):
-#     form = UploadFileForm()
-#     result_message = None
-#     error_message = None
-#     doctored_transactions_list = []
-
-#     if request.method == 'POST':
-#         form = UploadFileForm(request.POST, request.FILES)
-#         if form.is_valid():
-#             uploaded_file = request.FILES['file']
-
-#             # --- 0. Basic File Check (Optional but good) ---
-#             # if not uploaded_file.name.lower().endswith('.pdf'):
-#             #     error_message = "Invalid file type. Please upload a PDF file."
-#             #     return render(request, 'statement_analyzer/upload_statement.html', {
-#             #         'form': form, 'error': error_message
-#             #     })
-
-#             try:
-#                 # --- 1. PDF Extraction (Using your script) ---
-#                 # Assuming your pdf_extractor.py has a function like `extract_data_from_pdf`
-#                 # that takes a file object.
-#                 final_data = pdf_extractor.extract_data_from_pdf_2(uploaded_file)
-#                 # Example: raw_text_data = pdf_extractor_module.your_function(uploaded_file)
-
-#                 if not final_data: # Check if extraction yielded anything
-#                     error_message = "Could not extract text from the PDF. It might be empty or an image-based PDF without OCR."
-#                     # No point proceeding if no raw data
-#                     return render(request, 'statement_analyzer/upload_statement.html', {
-#                         'form': form, 'error': error_message
-#                     })
-
-#                 # --- 2. Data Cleaning and Structuring ---
-#                 # Assuming your pdf_extractor.py (or another script) also has a function
-#                 # to clean and structure this raw text.
-#                 # For this example, let's say it's also in pdf_extractor.
-#                 # structured_transactions = pdf_extractor.clean_and_structure_data(raw_text_data)
-#                 # transaction_new = pdf_extractor.extract_transactions_from_text(raw_text_data) # If you have a specific function for this
-#                 # # Example: structured_transactions = data_parser_module.your_function(raw_text_data)
-#                 # print("Parsed Transactions: ", transaction_new)
-
-#                 # if not transaction_new:
-#                 #     error_message = "Could not structure any transactions from the extracted data. Please check the PDF content and format."
-#                 # else:
-#                 #     # --- 3. Store in MongoDB ---
-#                 #     collection = get_mongo_collection()
-#                 #     if collection is None:
-#                 #         message = "Database connection failed. Please try again later."
-#                 #         print(message)
-
-#                     # Optional: Clear previous data for this user/statement if needed
-#                     # collection.delete_many({'statement_id': some_unique_id_for_this_upload})
-                    
-#                     # Add a unique upload ID to each transaction if you want to group them
-#                     # import uuid
-#                     # upload_id = str(uuid.uuid4())
-#                     # for t in structured_transactions:
-#                     #    t['upload_id'] = upload_id
-
-#                     # insert_result = collection.insert_many(list(transaction_new)) # Ensure it's a list
-#                     # You might want to confirm insert_result.inserted_ids count matches
-
-#                     # --- 4. Run Verification Logic ---
-#                     # Pass the structured_transactions (which are now also in DB)
-#                     # to your verification script.
-#                     # Ensure your verifier can handle the exact structure.
-#                 all_good, flagged_entries = transaction_verifier.verify_transactions(final_data.get('transactions', [])) # Adjust based on your actual data structure
-
-#                 if all_good:
-#                     result_message = "All good, check passed!"
-#                 else:
-#                     result_message = "Edited/Doctored statement suspected."
-#                     doctored_transactions_list = flagged_entries
-
-#             except FileNotFoundError: # If your script expects a path and can't find it
-#                 error_message = "Error: A required file for processing was not found."
-#                 # Log the details for yourself
-#             except IsADirectoryError: # If a file operation was attempted on a directory
-#                 error_message = "Error: Expected a file but found a directory during processing."
-#             except Exception as e:
-#                 error_message = f"An unexpected error occurred during processing: {str(e)}"
-#                 # It's good to log the full traceback for debugging
-#                 import traceback
-#                 print(f"Error in upload_and_analyze_statement: {e}")
-#                 traceback.print_exc()
-
-#     return render(request, 'statement_analyzer/upload_statement.html', {
-#         'form': form,
-#         'result': result_message,
-#         'error': error_message,
-#         'doctored_transactions': doctored_transactions_list
-#     })
 
+LLM_UNAVAILABLE_MESSAGE = "The AI service is busy or unavailable right now. Please try again in a minute."
+SERVER_BUSY_MESSAGE = "The server is busy with other statements right now. Please try again in a minute."
+
+# Kept here for callers of the old name; see pipeline.py
+persist_extracted_statement = pipeline.persist_extracted_statement
 
 
 def upload_and_analyze_statement(request):
     form = UploadFileForm()
-    result_message = None
     error_message = None
-    fraud_issues = []
-    # dummy_data = r"C:\Fraud_detection\bankstatement_project\statement_analyzer\dummy_data.json"
-    # with open(dummy_data ,"r") as f:
-    #     extracted_data = json.load(f)
-    
-    # extracted_data = {'account_info': {'bank_name': 'Nedbank', 'branch_code': 'null', 'branch_address': 'null', 'holder_name': 'MR GEORGE VAN DEVENTER', 'account_number': '1285935551', 'period': '18/12/2024 - 18/01/2025', 'final_balance': 43.57}, 'transactions': [{'id': 1, 'details': 'Openingbalance', 'date': '19-12-2024', 'amount': 0.0, 'balance': 2649.13}, {'id': 2, 'details': 'Prepaid electricity for George', 'date': '19-12-2024', 'amount': -50.0, 'balance': 2599.13}, {'id': 3, 'details': 'SASOL DAVEST 518103XXXXXX0883', 'date': '19-12-2024', 'amount': -312.0, 'balance': 2287.13}, {'id': 4, 'details': 'S2S*FRANCISLIQ518103XXXXXX0883', 'date': '19-12-2024', 'amount': -121.0, 'balance': 2166.13}, {'id': 5, 'details': 'S2S*FRANCISLIQ518103XXXXXX0883', 'date': '19-12-2024', 'amount': -40.0, 'balance': 2126.13}, {'id': 6, 'details': 'Instant payment fee', 'date': '19-12-2024', 'amount': -10.0, 'balance': 2116.13}, {'id': 7, 'details': 'SS-AFRIMOB32053900827024241220', 'date': '20-12-2024', 'amount': -582.95, 'balance': 1533.18}, {'id': 8, 'details': 'Prepaid electricity for George', 'date': '20-12-2024', 'amount': -50.0, 'balance': 1483.18}, {'id': 9, 'details': 'CORGI HARDWARE518103XXXXXX0883', 'date': '20-12-2024', 'amount': -286.5, 'balance': 1196.68}, {'id': 10, 'details': 'HPY*SA FRIENDL518103XXXXXX0883', 'date': '20-12-2024', 'amount': -100.0, 'balance': 1096.68}]}
-    extracted_data = {}
     transactions_extracted = False  # Flag to indicate if transactions were extracted
-    
 
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
@@ -162,83 +65,338 @@ def upload_and_analyze_statement(request):
             # --- Read file content once ---
             file_bytes = uploaded_file.read()
 
-            # Encode the bytes to Base64
-            encoded_file_bytes = base64.b64encode(file_bytes).decode('utf-8')
-            # Store the Base64 encoded string in the session
-            request.session['file_bytes'] = encoded_file_bytes
-            if not extracted_data:
-                extracted_text = pdf_extractor.extract_data_from_pdf_2(BytesIO(file_bytes))
-                extracted_data = BankStatementParser().extract__from_text_transactions_gpt(extracted_text)
-            # request.session['fraud_issues'] = []
-            if 'fraud_issues' in request.session:
-                value = request.session.pop('fraud_issues')
-            print(f"Extracted Data: {extracted_data}")
-
-
-            # --- 3. Store extracted transaction data ---
-            if extracted_data:
-                request.session['extracted_transactions_data'] = extracted_data
+            # --- 2./3. Extract and store the transaction data ---
+            statement = pipeline.analyze_and_store(file_bytes, filename=uploaded_file.name)
+            logger.info("Extracted %d transactions from %s",
+                        statement.row_count if statement else 0, uploaded_file.name)
+
+            if statement:
+                # The session only keeps a reference; see statement_store
+                statement_store.remember_statement(request.session, statement)
                 transactions_extracted = True
             else:
                 error_message = "Failed to extract transaction data."
 
+        except LLMUnavailableError as e:
+            logger.warning("Upload analysis of %s gave up: %s", uploaded_file.name, e)
+            error_message = LLM_UNAVAILABLE_MESSAGE
+        except cpu_budget.ServerBusyError as e:
+            logger.warning("Upload of %s turned away: %s", uploaded_file.name, e)
+            error_message = SERVER_BUSY_MESSAGE
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception("Upload analysis failed for %s", uploaded_file.name)
             error_message = f"An unexpected error occurred: {str(e)}"
 
-    # in_progress = request.session.get('in_progress', False)
     return render(request, 'statement_analyzer/new_viewer.html', {
         'form': form,
-        # 'result': result_message,
+        'batch_form': BatchUploadForm(),
         'error': error_message,
-        # 'fraud_issues': fraud_issues,
         'transactions_extracted': transactions_extracted, # Pass this to the template
-        # 'in_progress': in_progress,
     })
 
+
+def _row_mismatch(check, row):
+    """
+    Feeds one streamed row to the running-balance check; unreadable amounts count as mismatches.
+    """
+    try:
+        amount = to_cents(row.get('amount')) or 0
+        balance = to_cents(row.get('balance'))
+    except ValueError:
+        return True
+    return check.feed(amount, NO_BALANCE if balance is None else balance)[0]
+
+
+@require_POST
+def upload_stream(request):
+    """
+    upload_and_analyze_statement as server-sent events, used by the upload
+    page when the browser supports it. Account info and transactions are
+    sent as the LLM writes them, each row already validated (see
+    BankStatementParser._statement_events) and checked against the running
+    balance, and a final "done" event carries the viewer URL.
+    """
+    form = UploadFileForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    uploaded_file = request.FILES['file']
+    file_bytes = uploaded_file.read()
+    # The session cookie goes out with the response headers, before the statement exists.
+    if request.session.session_key is None:
+        request.session.save()
+    request.session.modified = True
+
+    def work(emit):
+        try:
+            emit('status', {'message': 'Reading the PDF'})
+            with cpu_budget.cpu_slot():
+                text = pipeline.extract_text(file_bytes)
+            emit('status', {'message': 'Extracting transactions'})
+            check = transaction_verifier.RunningBalanceCheck()
+            rows = mismatches = 0
+            for kind, value in pipeline.stream_statement(text):
+                if kind == 'account_info':
+                    emit('account_info', value)
+                elif kind == 'transaction':
+                    mismatch = _row_mismatch(check, value)
+                    mismatches += mismatch
+                    emit('transaction', dict(value, index=rows, mismatch=mismatch))
+                    rows += 1
+                elif value:
+                    statement = pipeline.store_statement(file_bytes, value, filename=uploaded_file.name)
+                    statement_store.remember_statement(request.session, statement)
+                    request.session.save()
+                    emit('done', {
+                        'url': reverse('statement_analyzer:view_transactions_data'),
+                        'rows': statement.row_count,
+                        'mismatches': mismatches,
+                    })
+                else:
+                    emit('error', {'message': "Failed to extract transaction data."})
+        except LLMUnavailableError as e:
+            logger.warning("Streamed analysis of %s gave up: %s", uploaded_file.name, e)
+            emit('error', {'message': LLM_UNAVAILABLE_MESSAGE})
+        except cpu_budget.ServerBusyError as e:
+            logger.warning("Streamed analysis of %s turned away: %s", uploaded_file.name, e)
+            emit('error', {'message': SERVER_BUSY_MESSAGE})
+
+    response = StreamingHttpResponse(EventStream(work).response_content(request), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_POST
+def upload_batch(request):
+    """
+    Accepts several PDFs or a ZIP of PDFs, queues them for processing (see
+    batch.py) and redirects to the batch page, which fills in as files finish.
+    """
+    batch_form = BatchUploadForm(request.POST, request.FILES)
+    error_message = None
+    if batch_form.is_valid():
+        try:
+            files = batch_processing.expand_uploads(batch_form.cleaned_data['files'])
+            batch = batch_processing.create_batch(files)
+            batch_processing.submit_batch(batch, files)
+            return redirect('statement_analyzer:view_batch', key=batch.key)
+        except batch_processing.BatchError as e:
+            error_message = str(e)
+    return render(request, 'statement_analyzer/new_viewer.html', {
+        'form': UploadFileForm(),
+        'batch_form': batch_form,
+        'error': error_message,
+    })
+
+
+def view_batch(request, key):
+    batch = get_object_or_404(StatementBatch, key=key)
+    batch_processing.expire_stale_items(batch)
+    return render(request, 'statement_analyzer/batch_viewer.html', {
+        'batch': batch,
+        'summary': batch_processing.batch_summary(batch),
+    })
+
+
+@require_GET
+def batch_status(request, key):
+    """
+    Per-file progress and combined totals of a batch, polled by the batch page.
+    """
+    batch = get_object_or_404(StatementBatch, key=key)
+    batch_processing.expire_stale_items(batch)
+    return JsonResponse(batch_processing.batch_summary(batch))
+
+
+def open_batch_item(request, key, index):
+    """
+    Makes one finished statement of a batch the session statement and opens it
+    in the transaction viewer. 404s once the statement itself has been deleted.
+    """
+    item = get_object_or_404(BatchItem, batch__key=key, index=index, status=BatchItem.DONE,
+                             statement__isnull=False)
+    statement_store.remember_statement(request.session, item.statement)
+    return redirect('statement_analyzer:view_transactions_data')
+
+
+@require_GET
+def export_batch_csv(request, key):
+    batch = get_object_or_404(StatementBatch, key=key)
+    items = (batch.items.filter(status=BatchItem.DONE, statement__isnull=False)
+             .select_related('statement').defer('statement__source_pdf'))
+    response = StreamingHttpResponse(
+        exporter.iter_batch_csv((item.filename, item.statement) for item in items),
+        content_type='text/csv',
+    )
+    response['Content-Disposition'] = f'attachment; filename="batch_{batch.key}_transactions.csv"'
+    return response
+
+
 def view_transactions_data(request):
     """
-    Renders the extracted account information and transactions in a table.
-    Retrieves data from the session.
+    Renders the account information and an empty, virtualized transaction
+    table. The rows themselves are fetched page by page from transaction_rows,
+    so the page size does not depend on the statement length.
     """
-    extracted_data = request.session.get('extracted_transactions_data')
+    statement = statement_store.get_session_statement(request.session)
 
-    if not extracted_data:
+    if not statement:
         # Handle case where no data is found (e.g., user navigated directly or session expired)
         error_message = "No transaction data found. Please upload and analyze a statement first."
         return render(request, 'statement_analyzer/transaction_viewer.html', {'error': error_message})
 
-    account_info = extracted_data.get('account_info', {})
-    transactions = extracted_data.get('transactions', [])
-    _, transactions = transaction_verifier.verify_transactions(transactions)
-    print(f"Extracted Data in view_transactions_data: {transactions}")
+    return render(request, 'statement_analyzer/transaction_viewer.html', {
+        'account_info': statement.account_info,
+        'row_count': statement.row_count,
+        'statement_version': statement.version,
+        'page_size': ROWS_PAGE_SIZE,
+    })
 
 
-    return render(request, 'statement_analyzer/transaction_viewer.html', {
-        'account_info': account_info,
-        'transactions': transactions,
+ROWS_PAGE_SIZE = 200
+ROWS_MAX_PAGE_SIZE = 1000
+
+
+def _verified_page(statement, offset, limit, mismatches_only):
+    """
+    Returns (rows, total) for one page of a stored statement, with the
+    running-balance check applied. Each row carries its absolute 'index'.
+    """
+    if mismatches_only:
+        table, _ = statement_store.load_table(statement)
+        transaction_verifier.verify_table(table)
+        flagged = [i for i, flag in enumerate(table.mismatch) if flag]
+        rows = [dict(table.row(i), index=i) for i in flagged[offset:offset + limit]]
+        return rows, len(flagged)
+
+    # Load one chunk of history so the balance carried into the page is known.
+    table, first_row = statement_store.load_table(
+        statement, max(0, offset - statement.chunk_rows), offset + limit,
+    )
+    start = max(0, offset - first_row)
+    transaction_verifier.verify_table(table, start=start)
+    rows = [dict(row, index=first_row + start + i) for i, row in enumerate(table.iter_rows(start, start + limit))]
+    return rows, statement.row_count
+
+
+@require_GET
+@gzip_page
+def transaction_rows(request):
+    """
+    JSON page of the session statement's transactions with mismatch flags.
+    Query params: offset, limit, and mismatches_only=1 to list flagged rows only.
+    """
+    statement = statement_store.get_session_statement(request.session)
+    if not statement:
+        return JsonResponse({'error': 'No statement in session. Please upload a statement first.'}, status=404)
+
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = max(1, min(int(request.GET.get('limit', ROWS_PAGE_SIZE)), ROWS_MAX_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': "'offset' and 'limit' must be integers."}, status=400)
+    mismatches_only = request.GET.get('mismatches_only') in ('1', 'true')
+
+    rows, total = _verified_page(statement, offset, limit, mismatches_only)
+    return JsonResponse({
+        'version': statement.version,
+        'total': total,
+        'offset': offset,
+        'rows': rows,
     })
 
 
-@csrf_exempt
+def _export_statement(request):
+    """
+    The statement to export: ?key=<statement key> or the one in the session.
+    """
+    if request.GET.get('key'):
+        return statement_store.get_statement(request.GET['key'])
+    return statement_store.get_session_statement(request.session)
+
+
+def _streaming_export(request, rows, content_type, extension):
+    statement = _export_statement(request)
+    if not statement:
+        return JsonResponse({'error': 'No statement found. Please upload a statement first.'}, status=404)
+    response = StreamingHttpResponse(rows(statement), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{exporter.export_filename(statement, extension)}"'
+    return response
+
+
+@require_GET
+def export_transactions_csv(request):
+    return _streaming_export(request, exporter.iter_csv, 'text/csv', 'csv')
+
+
+@require_GET
+def export_transactions_xlsx(request):
+    return _streaming_export(
+        request,
+        exporter.iter_xlsx,
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'xlsx',
+    )
+
+
+@require_POST
 def revalidate_transactions(request):
-    if request.method == 'POST':
-        data = json.loads(request.body)
-        print("found the edited data \n", data)
-        transactions = data.get('transactions', [])
+    """
+    Saves edited rows and re-runs verification.
+
+    Accepts either {"edits": [{"index": ..., "date": ..., ...}], "version": n},
+    which writes only the edited rows, or the older full
+    {"transactions": [...]} list.
+    """
+    data = json.loads(request.body)
+
+    statement = statement_store.get_session_statement(request.session)
+    if not statement:
+        return JsonResponse({'error': 'No statement in session. Please upload a statement first.'}, status=404)
+
+    # Only the chunks holding edited rows are rewritten
+    try:
+        if 'edits' in data:
+            edits = {int(edit['index']): edit for edit in data['edits']}
+            statement_store.update_rows(statement, edits, data.get('version'))
+        else:
+            statement_store.apply_transactions(statement, data.get('transactions', []), data.get('version'))
+    except statement_store.StaleStatementError as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    except (KeyError, ValueError, IndexError) as e:
+        return JsonResponse({'error': f"Invalid edit: {e}"}, status=400)
+    statement_store.remember_statement(request.session, statement)
 
-        # Revalidate
-        _, transactions = transaction_verifier.verify_transactions(transactions)
+    # Revalidate
+    table, _ = statement_store.load_table(statement)
+    flagged_entries = transaction_verifier.verify_table(table)
 
-        #  Update the session with new values
-        extracted_data = request.session.get('extracted_transactions_data', {})
-        extracted_data['transactions'] = transactions
-        request.session['extracted_transactions_data'] = extracted_data
-        request.session.modified = True  # Force save
+    if 'edits' in data:
+        return JsonResponse({'version': statement.version, 'mismatch_count': len(flagged_entries)})
+    return JsonResponse(table.to_dicts(), safe=False)
 
-        return JsonResponse(transactions, safe=False)
 
+@require_POST
+def repair_transactions(request):
+    """
+    Re-extracts only the PDF pages behind the statement's balance mismatches
+    (see repair.py) and reports what changed.
+    """
+    statement = statement_store.get_session_statement(request.session)
+    if not statement:
+        return JsonResponse({'error': 'No statement in session. Please upload a statement first.'}, status=404)
+    try:
+        result = repair.repair_statement(statement)
+    except repair.RepairError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except statement_store.StaleStatementError as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    except LLMUnavailableError:
+        return JsonResponse({'error': LLM_UNAVAILABLE_MESSAGE}, status=503)
+    except cpu_budget.ServerBusyError:
+        return JsonResponse({'error': SERVER_BUSY_MESSAGE}, status=503)
+    statement_store.remember_statement(request.session, statement)
+    return JsonResponse(result)
 
 
 def view_other_issue(request):
@@ -246,55 +404,41 @@ def view_other_issue(request):
     Renders the extracted account information and transactions in a table.
     Retrieves data from the session.
     """
-    # Retrieve the SINGLE Base64 encoded string from the session
-    fraud_issues = request.session.get('fraud_issues', [])
-    print("fraud issue from cache ", fraud_issues)
-    if fraud_issues:
-        if fraud_issues != "N/A":
-            return render(request, 'statement_analyzer/doctored.html', {
+    statement = statement_store.get_session_statement(request.session)
+    fraud_issues = statement.fraud_issues if statement else None
+    if fraud_issues is not None:
+        return render(request, 'statement_analyzer/doctored.html', {
             'result': f"Found {len(fraud_issues)} issues with this statement",
             'fraud': fraud_issues,
         })
 
-        else:
-            return render(request, 'statement_analyzer/doctored.html', {
-            'result': f"Found {len(fraud_issues)} issues with this statement",
-            'fraud': [],
-        })
-
     else:
 
-        encoded_pdf_bytes_str = request.session.get('file_bytes')
-
         # Initialize list for PIL images (this will be populated by BankStatementParser)
         pil_images_list = [] 
 
         # --- Step 1: Handle the case where no data is found in the session initially ---
-        if not encoded_pdf_bytes_str:
+        if not statement:
             result_message = "No statement data found in session. Please upload a statement first."
             # Render doctored.html with a clear message and an empty fraud list
             return render(request, 'statement_analyzer/doctored.html', {'result': result_message, 'fraud': []})
 
-        pdf_bytes = None
-        try:
-            # 2. Base64 decode the SINGLE string back to raw PDF bytes
-            # The .encode('utf-8') is crucial here to convert the string back to bytes for b64decode
-            pdf_bytes = base64.b64decode(encoded_pdf_bytes_str.encode('utf-8'))
-        except Exception as e:
-            print(f"Error decoding Base64 PDF data from session: {e}")
-            result_message = "Corrupted statement data found in session. Please re-upload."
-            return render(request, 'statement_analyzer/doctored.html', {'result': result_message, 'fraud': []})
+        pdf_bytes = statement_store.get_source_pdf(statement)
 
-        # Ensure PDF bytes were successfully decoded
+        # Ensure PDF bytes were successfully retrieved
         if not pdf_bytes:
             result_message = "Failed to retrieve statement data. Please re-upload."
             return render(request, 'statement_analyzer/doctored.html', {'result': result_message, 'fraud': []})
 
         try:
-            pil_images_list = convert_from_bytes(pdf_bytes, fmt='PNG')
+            with span("rendering", bytes=len(pdf_bytes)) as s, cpu_budget.cpu_slot():
+                pil_images_list = pdf2image.convert_from_bytes(bytes(pdf_bytes), fmt='PNG')
+                s.add(pages=len(pil_images_list))
             
+        except cpu_budget.ServerBusyError:
+            return render(request, 'statement_analyzer/doctored.html', {'result': SERVER_BUSY_MESSAGE, 'fraud': []})
         except Exception as e:
-            print(f"Error converting PDF bytes to PIL images: {e}")
+            logger.error("Error converting PDF bytes to PIL images: %s", e)
             result_message = "Error processing document for image extraction. Please check document format."
             return render(request, 'statement_analyzer/doctored.html', {'result': result_message, 'fraud': []})
 
@@ -306,17 +450,101 @@ def view_other_issue(request):
 
 
         # Pass the list of PIL Image objects to your parser
-        fraud_issues = BankStatementParser().detect_fraud_from_bank_images(pil_images_list)
-        # fraud_issues = BankStatementParser().detect_frauds(pil_images_list)
-
-        print(f"Extracted Data in view_other_issue: {fraud_issues}")
+        try:
+            with span("fraud_detection", pages=len(pil_images_list)) as s:
+                fraud_issues = BankStatementParser().detect_fraud_from_bank_images(pil_images_list)
+                s.add(issues=len(fraud_issues))
+        except LLMUnavailableError as e:
+            # Not cached: an empty result would read as "no issues found".
+            logger.warning("Fraud detection for statement %s gave up: %s", statement.key, e)
+            return render(request, 'statement_analyzer/doctored.html', {'result': LLM_UNAVAILABLE_MESSAGE, 'fraud': []})
+
+        logger.info("Found %d fraud issues in statement %s", len(fraud_issues), statement.key)
         result_message = f"Found {len(fraud_issues)} issues with this statement"
-        if not len(fraud_issues):
-            request.session['fraud_issues'] = "N/A"
-        else:
-            request.session['fraud_issues'] = fraud_issues
+        statement_store.set_fraud_issues(statement, fraud_issues)
 
         return render(request, 'statement_analyzer/doctored.html', {
             'result': result_message,
             'fraud': fraud_issues,
-        })
\ No newline at end of file
+        })
+
+
+def _parse_query_params(params):
+    """
+    Reads the filters of query_transactions from request.GET.
+    Raises ValueError with a user-facing message on bad input.
+    """
+    filters = {}
+    for name in ('date_from', 'date_to'):
+        if params.get(name):
+            value = mongo_store.parse_statement_date(params[name])
+            if value is None:
+                raise ValueError(f"'{name}' must be a date like DD-MM-YYYY.")
+            filters[name] = value
+    for name in ('amount_min', 'amount_max'):
+        if params.get(name):
+            try:
+                filters[name] = float(params[name])
+            except ValueError:
+                raise ValueError(f"'{name}' must be a number.")
+            if not math.isfinite(filters[name]):
+                raise ValueError(f"'{name}' must be a finite number.")
+    if params.get('account_number'):
+        filters['account_number'] = params['account_number'].strip()
+    if params.get('q'):
+        filters['text'] = params['q'].strip()
+    return filters
+
+
+@require_GET
+def query_transactions(request):
+    """
+    JSON search over stored transactions across all statements, for staff
+    users only, as it reaches every account's rows.
+
+    Filters: account_number, date_from, date_to, amount_min, amount_max and q
+    (description keywords). Paginate with the returned next_cursor; limit caps
+    the page size and fields selects the returned columns (comma separated).
+    """
+    if not (request.user.is_active and request.user.is_staff):
+        return JsonResponse({'error': 'Staff login required.'}, status=403)
+    try:
+        filters = _parse_query_params(request.GET)
+        limit = int(request.GET.get('limit', mongo_store.DEFAULT_QUERY_LIMIT))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    fields = None
+    if request.GET.get('fields'):
+        fields = [f.strip() for f in request.GET['fields'].split(',') if f.strip()]
+
+    try:
+        results, next_cursor = mongo_store.find_transactions(
+            filters,
+            cursor=request.GET.get('cursor'),
+            limit=limit,
+            fields=fields,
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except pymongo_errors.PyMongoError as err:
+        logger.error("MongoDB query failed: %s", err)
+        return JsonResponse({'error': 'Transaction store is unavailable.'}, status=503)
+
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+
+@require_GET
+def metrics(request):
+    """
+    Stage, LLM and request metrics in the Prometheus text format, for staff
+    users and for scrapers that send METRICS_TOKEN as a bearer token.
+    """
+    if not settings.METRICS_ENABLED:
+        return JsonResponse({'error': 'Metrics are disabled.'}, status=404)
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(settings.METRICS_TOKEN) and hmac.compare_digest(
+        authorization.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode())
+    if not (token_ok or (request.user.is_active and request.user.is_staff)):
+        return JsonResponse({'error': 'Staff login or metrics token required.'}, status=403)
+    return HttpResponse(instrumentation.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')